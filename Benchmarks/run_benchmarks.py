@@ -0,0 +1,252 @@
+"""
+Benchmarks for the search and featurisation hot paths, run on synthetic data (see `synthetic.py`) - CPU only and
+without network access:
+    - search: `SimilaritySearch` construction time & peak RSS and p50/p99 latency of "knn", "cosine" and
+      metadata-filtered "cosine" searches for feature sets of 1k to 1M rows
+    - render: p50/p99 latency of `get_image_grid` with cold & warm caches - reading the thumbnails from their own
+      files and from a packed archive - and of PNG encoding the grid
+    - featurise: images/sec of decoding alone and of `get_bottleneck_features` end-to-end (needs tensorflow - the
+      model is built without pre-trained weights so nothing is downloaded)
+
+Every benchmark runs in a fresh process so its peak RSS isn't inflated by the ones before it. The results are
+written to `<OUTDIR>/benchmark_<timestamp>.json` along with the environment they were measured in - pass the
+results of an earlier run as `BASELINE_RESULTS` to see the change of every metric.
+
+Run this from the `Benchmarks` folder.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import subprocess
+from datetime import datetime
+from io import BytesIO
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List
+import numpy as np
+import pandas as pd
+
+# make the repo's `utils` package & the app's `viz_utils` importable when run from this folder
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(REPO_DIR)
+sys.path.append(os.path.join(REPO_DIR, "Visualisation"))
+
+from synthetic import make_synthetic_feature_store, make_synthetic_flags, get_synthetic_keys
+from utils.thumbnail_archive import pack_thumbnail_archive, get_thumbnail_archive_fpath
+
+THUMBNAIL_SIZE = 192 # size of the packed thumbnail archive the render benchmark reads from
+
+try:
+    import resource
+except ImportError: # not available on Windows - peak RSS is reported as None there
+    resource = None
+
+
+def get_peak_rss_mb() -> float:
+    """
+    Peak resident set size of the current process so far
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return peak_rss / 2**20 if sys.platform == "darwin" else peak_rss / 2**10
+
+
+def get_latency_stats(prefix: str, seconds: List[float]) -> Dict[str, float]:
+    return {f"{prefix}_p50_ms": 1000 * float(np.percentile(seconds, 50))
+            , f"{prefix}_p99_ms": 1000 * float(np.percentile(seconds, 99))}
+
+
+def time_calls(fn: Callable, args_list: List[tuple]) -> List[float]:
+    seconds = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def run_in_fresh_process(fn: Callable, *args) -> Any:
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(fn, *args).result()
+
+
+def bench_search(store_fpath: str, knn_k: int, n_queries: int, seed: int = 0) -> Dict[str, float]:
+    from viz_utils import SimilaritySearch
+
+    baseline_rss_mb = get_peak_rss_mb()
+    start = time.perf_counter()
+    sim_state = SimilaritySearch(store_fpath, knn_k)
+    load_seconds = time.perf_counter() - start
+    peak_rss_mb = get_peak_rss_mb()
+
+    featureset_name = sim_state.featureset_names[0]
+    territory_names = sim_state.get_feature_df(featureset_name).index.get_level_values("territory_name")
+    queries = [(territory_names[i], ) for i in np.random.default_rng(seed).integers(0, len(territory_names)
+                                                                                    , n_queries)]
+
+    return {"load_seconds": load_seconds, "baseline_rss_mb": baseline_rss_mb, "peak_rss_mb": peak_rss_mb
+            , **get_latency_stats("knn", time_calls(lambda q: sim_state.search(q, "knn"), queries))
+            , **get_latency_stats("cosine", time_calls(lambda q: sim_state.search(q, "cosine"), queries))
+            # leaving the query out filters its pre-computed top-k, so these go through the filtered search
+            , **get_latency_stats("cosine_filtered", time_calls(
+                lambda q: sim_state.search(q, "cosine", filters=[("territory_name", "!=", q)]), queries))}
+
+
+def bench_render(img_dir: str, archive_dir: str, font_path: str, n_models: int, knn_k: int, n_renders: int
+                 , seed: int = 0) -> Dict[str, float]:
+    """
+    :param img_dir: folder of thumbnail files
+    :param archive_dir: folder holding the same thumbnails packed into an archive
+    """
+    from viz_utils import get_image_grid, clear_render_caches
+
+    keys = get_synthetic_keys(0, len(os.listdir(img_dir)))
+    rng = np.random.default_rng(seed)
+    search_results_list = [{f"Model{m}": [[*keys[i], float(rng.random())] for i in rng.choice(len(keys), knn_k)]
+                            for m in range(n_models)}
+                           for _ in range(n_renders)]
+
+    def render_cold(search_results, thumbnail_dir=img_dir):
+        clear_render_caches()
+        return get_image_grid(search_results, thumbnail_dir, font_path, THUMBNAIL_SIZE)
+
+    def encode_png(img):
+        img.save(BytesIO(), format="PNG")
+
+    def render_warm(search_results):
+        return get_image_grid(search_results, img_dir, font_path, THUMBNAIL_SIZE)
+
+    # the cold renders clear the caches, so the warm renders are timed first - right after a pass filling the caches
+    clear_render_caches()
+    grids = [render_warm(search_results) for search_results in search_results_list]
+    return {**get_latency_stats("render_warm", time_calls(render_warm, [(r, ) for r in search_results_list]))
+            , **get_latency_stats("render_cold", time_calls(render_cold, [(r, ) for r in search_results_list]))
+            , **get_latency_stats("render_cold_archive", time_calls(render_cold, [(r, archive_dir)
+                                                                                  for r in search_results_list]))
+            , **get_latency_stats("png_encode", time_calls(encode_png, [(g, ) for g in grids]))
+            , "peak_rss_mb": get_peak_rss_mb()}
+
+
+def bench_featurise(img_fpaths: List[str], model_name: str, batch_size: int, n_workers: int) -> Dict[str, float]:
+    os.environ["CUDA_VISIBLE_DEVICES"] = "-1" # CPU only
+    import tensorflow as tf
+    from utils.dl_utils import PrefetchingSequence, get_bottleneck_features
+    from FeatureExtraction.featuriser import model_list
+
+    # same wiring as `featuriser.build_featuriser_model` but without pre-trained weights so nothing is downloaded
+    core = getattr(tf.keras.applications, model_name)(weights=None, include_top=False, input_shape=(256, 256, 3)
+                                                      , pooling="avg")
+    preproc = eval(model_list[model_name][1])
+    i = tf.keras.layers.Input([None, None, 3], dtype=tf.uint8)
+    model = tf.keras.Model(inputs=[i], outputs=[core(preproc(tf.cast(i, tf.float32)))])
+
+    seq = PrefetchingSequence(img_fpaths, batch_size=batch_size, return_filenames=True, n_workers=n_workers)
+    start = time.perf_counter()
+    for idx in range(len(seq)):
+        seq[idx]
+    decode_images_per_sec = len(img_fpaths) / (time.perf_counter() - start)
+    seq.on_epoch_end()
+
+    model(seq[0][1]) # warm-up so graph building isn't counted
+    seq.on_epoch_end()
+    start = time.perf_counter()
+    get_bottleneck_features(seq, model)
+    images_per_sec = len(img_fpaths) / (time.perf_counter() - start)
+    seq.close()
+
+    return {"decode_images_per_sec": decode_images_per_sec, "featurise_images_per_sec": images_per_sec
+            , "peak_rss_mb": get_peak_rss_mb()}
+
+
+def get_environment() -> Dict[str, Any]:
+    try:
+        git_commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True
+                                    , check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        git_commit = None
+    return {"timestamp": datetime.now().isoformat(timespec="seconds"), "git_commit": git_commit
+            , "python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform()
+            , "cpu_count": os.cpu_count()}
+
+
+def save_results(results: List[Dict], output_dir: str) -> str:
+    os.makedirs(output_dir, exist_ok=True)
+    environment = get_environment()
+    output_fpath = os.path.join(output_dir, f"benchmark_{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(output_fpath, "w") as f:
+        json.dump({"environment": environment, "results": results}, f, indent=2)
+    return output_fpath
+
+
+def compare_results(baseline_fpath: str, results: List[Dict]) -> pd.DataFrame:
+    """
+    :param baseline_fpath: results file of an earlier run
+    :param results:
+    :return: one row per (benchmark, metric) with the baseline & current values and their ratio
+    """
+    with open(baseline_fpath) as f:
+        baseline = json.load(f)["results"]
+
+    def to_long(results):
+        df = pd.DataFrame(results).melt(id_vars=["benchmark", "case"], var_name="metric").dropna()
+        return df.set_index(["benchmark", "case", "metric"])["value"]
+
+    comparison = pd.concat([to_long(baseline).rename("baseline"), to_long(results).rename("current")], axis=1)
+    comparison["ratio"] = comparison["current"] / comparison["baseline"]
+    return comparison
+
+
+if __name__ == "__main__":
+    # config:
+    logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.INFO)
+    WORK_DIR = "./synthetic_data" # synthetic data is generated here once and re-used by later runs
+    OUTDIR = "./results"
+    BASELINE_RESULTS = None # path to the results of an earlier run to compare against
+    FULL_RUN = False # also benchmark 1M rows - pre-computing its cosine top-k table takes a long time
+    N_ROWS_LIST = [1000, 10000, 100000] + ([1000000] if FULL_RUN else [])
+    N_FEATURES = 512
+    KNN_K = 10
+    N_QUERIES = 200
+    N_IMAGES = 256
+    N_MODELS = 5 # number of result rows in a rendered grid
+    N_RENDERS = 50
+    FONT_FILE = os.path.join(REPO_DIR, "Visualisation", "Fonts", "UbuntuMono-Regular.ttf")
+    FEATURISER_MODEL = "VGG16"
+    BATCH_SIZE = 32
+    N_LOADER_WORKERS = 4
+
+    results = []
+    for n_rows in N_ROWS_LIST:
+        store_fpath = make_synthetic_feature_store(os.path.join(WORK_DIR, f"synthetic_{n_rows}x{N_FEATURES}.npy")
+                                                   , n_rows, N_FEATURES)
+        logging.info(f"Benchmarking search over {n_rows:,} rows...")
+        results.append({"benchmark": "search", "case": f"{n_rows}x{N_FEATURES}"
+                        , **run_in_fresh_process(bench_search, store_fpath, KNN_K, N_QUERIES)})
+
+    img_fpaths = make_synthetic_flags(os.path.join(WORK_DIR, "flags"), N_IMAGES)
+    archive_dir = os.path.join(WORK_DIR, "flags_archive")
+    os.makedirs(archive_dir, exist_ok=True)
+    pack_thumbnail_archive(img_fpaths, get_thumbnail_archive_fpath(archive_dir, THUMBNAIL_SIZE))
+    logging.info("Benchmarking rendering...")
+    results.append({"benchmark": "render", "case": f"{N_MODELS}x{KNN_K}"
+                    , **run_in_fresh_process(bench_render, os.path.join(WORK_DIR, "flags"), archive_dir, FONT_FILE
+                                             , N_MODELS, KNN_K, N_RENDERS)})
+
+    logging.info("Benchmarking featurisation...")
+    try:
+        results.append({"benchmark": "featurise", "case": f"{FEATURISER_MODEL}_batch{BATCH_SIZE}"
+                        , **run_in_fresh_process(bench_featurise, img_fpaths, FEATURISER_MODEL, BATCH_SIZE
+                                                 , N_LOADER_WORKERS)})
+    except ImportError as e:
+        logging.warning(f"Skipping the featurisation benchmark: {e}")
+
+    print(pd.DataFrame(results).set_index(["benchmark", "case"]).T.to_string())
+    logging.info(f"Results saved to {save_results(results, OUTDIR)}")
+
+    if BASELINE_RESULTS is not None:
+        print(compare_results(BASELINE_RESULTS, results).to_string())
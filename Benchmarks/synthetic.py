@@ -0,0 +1,93 @@
+"""
+Synthetic data for the benchmarks - feature-stores of any size and simple striped flag images - so the benchmarks
+are reproducible and run without the real flags, pre-trained weights or network access.
+"""
+import os
+import logging
+from typing import List, Tuple
+import numpy as np
+from PIL import Image, ImageDraw
+from utils.feature_store import FeatureStoreWriter, is_store_complete
+
+FLAG_COLOURS = [(206, 17, 38), (0, 56, 147), (255, 255, 255), (0, 122, 61), (252, 209, 22), (0, 0, 0)
+                , (0, 114, 198), (239, 51, 64), (255, 130, 0), (117, 170, 219)]
+
+
+def get_synthetic_keys(start: int, stop: int) -> List[Tuple[str, str]]:
+    return [(f"Flag_of_Synthetic_{i:07d}.jpg", f"Synthetic {i:07d}") for i in range(start, stop)]
+
+
+def make_synthetic_feature_store(store_fpath: str, n_rows: int, n_features: int = 512, n_clusters: int = 100
+                                 , seed: int = 0, chunk_size: int = 65536) -> str:
+    """
+    Writes a feature-store of clustered, non-negative (ReLU-like) features - rows are generated & written a chunk at a
+    time so 1M+ row stores don't have to fit in memory. Existing stores are re-used.
+    :param store_fpath: path to the .npy file of the feature-store
+    :param n_rows:
+    :param n_features:
+    :param n_clusters: number of clusters the rows are drawn around - gives the searches realistic neighbourhoods
+    :param seed:
+    :param chunk_size: number of rows generated at a time
+    :return: store_fpath
+    """
+    if is_store_complete(store_fpath):
+        return store_fpath
+
+    os.makedirs(os.path.dirname(os.path.abspath(store_fpath)), exist_ok=True)
+    logging.info(f"Generating a synthetic feature-store of {n_rows:,} x {n_features:,} at {store_fpath}...")
+    rng = np.random.default_rng(seed)
+    centres = rng.random((n_clusters, n_features), dtype=np.float32)
+    writer = FeatureStoreWriter(store_fpath, n_rows, chunk_size, resume=False)
+    for start in range(0, n_rows, chunk_size):
+        stop = min(start + chunk_size, n_rows)
+        X = centres[rng.integers(0, n_clusters, stop - start)]
+        X = np.maximum(X + 0.3 * rng.standard_normal(X.shape, dtype=np.float32), 0)
+        writer.append(X, get_synthetic_keys(start, stop))
+
+    return writer.finalise()
+
+
+def draw_synthetic_flag(rng: np.random.Generator, size: Tuple[int, int]) -> Image:
+    """
+    Draws a flag made of 2-4 horizontal or vertical stripes, sometimes with a disc in the middle
+    """
+    width, height = size
+    img = Image.new("RGB", size)
+    draw = ImageDraw.Draw(img)
+    n_stripes = int(rng.integers(2, 5))
+    colours = [FLAG_COLOURS[c] for c in rng.choice(len(FLAG_COLOURS), n_stripes + 1, replace=False)]
+    vertical = rng.random() < 0.5
+
+    for s in range(n_stripes):
+        if vertical:
+            draw.rectangle([s * width // n_stripes, 0, (s + 1) * width // n_stripes, height], fill=colours[s])
+        else:
+            draw.rectangle([0, s * height // n_stripes, width, (s + 1) * height // n_stripes], fill=colours[s])
+
+    if rng.random() < 0.3:
+        r = height // 4
+        draw.ellipse([width // 2 - r, height // 2 - r, width // 2 + r, height // 2 + r], fill=colours[-1])
+    return img
+
+
+def make_synthetic_flags(output_dir: str, n_images: int, size: Tuple[int, int] = (288, 192), seed: int = 0)\
+        -> List[str]:
+    """
+    Writes `n_images` synthetic flags as jpgs named like the real ones (Flag_of_<name>.jpg) - existing images are
+    re-used
+    :param output_dir:
+    :param n_images:
+    :param size: (width, height) of the images
+    :param seed:
+    :return: paths to the images
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    img_fpaths = []
+    for filename, _ in get_synthetic_keys(0, n_images):
+        img_fpath = os.path.join(output_dir, filename)
+        img = draw_synthetic_flag(rng, size) # always drawn so that the images don't depend on what's on disk
+        if not os.path.exists(img_fpath):
+            img.save(img_fpath, quality=90)
+        img_fpaths.append(img_fpath)
+    return img_fpaths
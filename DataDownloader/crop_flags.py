@@ -4,36 +4,93 @@ layer - we use the `autocrop_image` function below to crop out unnecessary pixel
 """
 
 import os
+import time
 import logging
+from typing import List, Dict, Tuple
+import numpy as np
 from tqdm import tqdm
 from PIL import Image
 from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+
+
+def get_alpha_bbox(image: Image) -> Tuple[int, int, int, int]:
+    """
+    Bounding box of the non-transparent pixels of an image - computed on the alpha channel only, with numpy.
+    Images without an alpha channel fall back to `Image.getbbox`.
+    :param image:
+    :return: (left, upper, right, lower) or None if the image is fully transparent
+    """
+    if "A" not in image.getbands():
+        return image.getbbox()
+
+    alpha = np.asarray(image.getchannel("A"))
+    rows = np.flatnonzero(alpha.any(axis=1))
+    cols = np.flatnonzero(alpha.any(axis=0))
+    if len(rows) == 0:
+        return None
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
 
 def autocrop_image(image: Image) -> Image:
     """
     This function is adapted from https://gist.github.com/odyniec/3470977
 
+    The transparent pixels outside of the flag are cropped out and the alpha channel is dropped - the crop is
+    converted straight to RGB rather than pasted onto an intermediate RGBA canvas first.
     :param image: input png image to crop to content
     :return: cropped Image object in jpg format
     """
 
-    # Get the bounding box
-    bbox = image.getbbox()
+    # Get the bounding box & crop the image to its contents
+    bbox = get_alpha_bbox(image)
+    return image.crop(bbox).convert("RGB")
+
+
+def is_up_to_date(input_fpath: str, output_fpath: str) -> bool:
+    return os.path.exists(output_fpath) and os.path.getmtime(output_fpath) >= os.path.getmtime(input_fpath)
 
-    # Crop the image to the contents of the bounding box
-    image = image.crop(bbox)
 
-    # Determine the width and height of the cropped image
-    (width, height) = image.size
+def crop_file(input_fpath: str, output_fpath: str, overwrite: bool = False) -> Dict:
+    """
+    Crops a single png to content and saves it as a jpg - skipped if the jpg is newer than the png
+    :return: {"file", "status", "seconds"}
+    """
+    start = time.perf_counter()
+    if not overwrite and is_up_to_date(input_fpath, output_fpath):
+        return {"file": input_fpath, "status": "skipped", "seconds": time.perf_counter() - start}
+
+    with Image.open(input_fpath) as image:
+        autocrop_image(image).save(output_fpath)
+    return {"file": input_fpath, "status": "cropped", "seconds": time.perf_counter() - start}
+
 
-    # Create a new image object for the output image
-    cropped_image = Image.new("RGBA", (width, height), (0,0,0,0))
+def crop_files(png_fpaths: List[str], output_dir: str, n_workers: int = None, overwrite: bool = False) -> List[Dict]:
+    """
+    Crops pngs to content on a pool of `n_workers` processes, writing `<output_dir>/<name>.jpg` for each png.
+    Per-image timings are returned and the total throughput is logged.
+    :param png_fpaths:
+    :param output_dir:
+    :param n_workers: defaults to the number of cores
+    :param overwrite: re-crop images whose jpg is already up to date
+    :return: one {"file", "status", "seconds"} per png
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    output_fpaths = [os.path.join(output_dir, f"{os.path.splitext(os.path.basename(p))[0]}.jpg") for p in png_fpaths]
 
-    # Paste the cropped image onto the new image
-    cropped_image.paste(image)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = list(tqdm(executor.map(crop_file, png_fpaths, output_fpaths, [overwrite] * len(png_fpaths)
+                                         , chunksize=4), total=len(png_fpaths)))
+    total_seconds = time.perf_counter() - start
 
-    # Done!
-    return cropped_image.convert("RGB")
+    cropped_seconds = [r["seconds"] for r in results if r["status"] == "cropped"]
+    if cropped_seconds:
+        logging.info(f"Cropped {len(cropped_seconds):,} images in {total_seconds:.2f}s "
+                     f"({len(cropped_seconds) / total_seconds:,.1f} images/sec) - per image: "
+                     f"median {1000 * np.median(cropped_seconds):.1f}ms, max {1000 * np.max(cropped_seconds):.1f}ms")
+    logging.info(f"Skipped {len(results) - len(cropped_seconds):,} images which were already up to date")
+    return results
 
 
 if __name__ == "__main__":
@@ -41,13 +98,7 @@ if __name__ == "__main__":
     logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.INFO)
     FLAG_SVG_LOC = "./flags/svg/*.png" #glob pattern for png formatted flags
     OUTDIR= "./flags/cropped_jpgs"
+    N_WORKERS = None # one process per core
 
-    os.makedirs(OUTDIR, exist_ok=True)
     png_flags = glob(FLAG_SVG_LOC)
-
-    for p in tqdm(png_flags):
-        filename = os.path.splitext(os.path.basename(p))[0]
-
-        image = Image.open(p)
-        image = autocrop_image(image)
-        image.save(os.path.join(OUTDIR, f"{filename}.jpg"))
\ No newline at end of file
+    crop_files(png_flags, OUTDIR, n_workers=N_WORKERS)
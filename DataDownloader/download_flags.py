@@ -4,14 +4,144 @@ https://en.wikipedia.org/wiki/Gallery_of_sovereign_state_flags
 """
 
 import os
+import json
+import time
 import logging
+from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import wikipedia
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from io import open as iopen
 from urllib.parse import unquote
 
-def download_svgs(wikipage_name: str, file_pattern: str, output_dir: str) -> None:
+MANIFEST_FILENAME = "download_manifest.json"
+MANIFEST_FLUSH_EVERY = 100 # the manifest is saved after this many completed downloads...
+MANIFEST_FLUSH_SECONDS = 5 # ...or this many seconds since it was last saved, and once at the end
+
+
+def make_session(pool_size: int = 8, retries: int = 5, backoff_factor: float = 0.5) -> requests.Session:
+    """
+    Creates a session whose connections are pooled & re-used across downloads, failed requests (connection errors
+    and 429/5xx responses) are retried with exponential backoff
+    :param pool_size: max number of connections kept open per host - should match the number of download workers
+    :param retries:
+    :param backoff_factor: sleeps backoff_factor * 2^(retry number - 1) seconds between retries
+    :return:
+    """
+    retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def download_file(session: requests.Session, url: str, output_dir: str, previous: Dict = None
+                  , revalidate: bool = False) -> Dict:
+    """
+    Downloads a single file into `output_dir` (named after the unquoted basename of the url).
+
+    Files that are already on disk are skipped, unless `revalidate=True` in which case a conditional request is made
+    using the ETag/Last-Modified recorded when the file was last fetched - the file is only re-downloaded if it
+    changed on the server.
+    :param session:
+    :param url:
+    :param output_dir:
+    :param previous: the file's entry in the manifest of a previous run, if any
+    :param revalidate:
+    :return: manifest entry for the file
+    """
+    filename = unquote(os.path.basename(url))
+    local_file = os.path.join(output_dir, filename)
+    previous = previous or {}
+    entry = {"url": url, "path": local_file, "etag": previous.get("etag")
+             , "last_modified": previous.get("last_modified")}
+
+    if os.path.exists(local_file) and not revalidate:
+        return {**entry, "status": "skipped"}
+
+    headers = {}
+    if os.path.exists(local_file):
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    response = session.get(url, headers=headers, timeout=60)
+    if response.status_code == 304:
+        return {**entry, "status": "not_modified"}
+    response.raise_for_status()
+
+    # write to a temporary file first so an interrupted download never leaves a truncated file behind
+    with iopen(local_file + ".part", "wb") as f:
+        f.write(response.content)
+    os.replace(local_file + ".part", local_file)
+
+    return {**entry, "status": "fetched", "bytes": len(response.content), "etag": response.headers.get("ETag")
+            , "last_modified": response.headers.get("Last-Modified")}
+
+
+def download_files(urls: List[str], output_dir: str, n_workers: int = 8, session: requests.Session = None
+                   , revalidate: bool = False) -> Dict[str, Dict]:
+    """
+    Downloads files concurrently over a pooled session with `n_workers` threads.
+
+    A manifest of what was fetched (`download_manifest.json`) is kept in `output_dir` and saved periodically as
+    downloads complete (see `MANIFEST_FLUSH_EVERY`), so an interrupted run can simply be re-run - files already on
+    disk are skipped. A failed download (network or disk error) is logged and doesn't stop the others.
+    :param urls:
+    :param output_dir:
+    :param n_workers:
+    :param session: defaults to `make_session(n_workers)`
+    :param revalidate: re-check files already on disk with conditional requests (see `download_file`)
+    :return: {url: manifest entry}
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    session = session or make_session(n_workers)
+    manifest_fpath = os.path.join(output_dir, MANIFEST_FILENAME)
+    manifest = {}
+    if os.path.exists(manifest_fpath):
+        with open(manifest_fpath) as f:
+            manifest = json.load(f)
+
+    def save_manifest():
+        with open(manifest_fpath + ".part", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_fpath + ".part", manifest_fpath)
+
+    results = {}
+    n_unsaved, last_saved = 0, time.monotonic()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(download_file, session, url, output_dir, manifest.get(url), revalidate): url
+                   for url in urls}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            url = futures[future]
+            try:
+                results[url] = future.result()
+            except (requests.RequestException, OSError) as e:
+                logging.error(f"Failed to download {url}: {e}")
+                results[url] = {"url": url, "status": "failed", "error": str(e)}
+                continue
+
+            manifest[url] = {k: v for k, v in results[url].items() if k != "status"}
+            n_unsaved += 1
+            if n_unsaved >= MANIFEST_FLUSH_EVERY or time.monotonic() - last_saved >= MANIFEST_FLUSH_SECONDS:
+                save_manifest()
+                n_unsaved, last_saved = 0, time.monotonic()
+
+    if n_unsaved:
+        save_manifest()
+
+    statuses = [r["status"] for r in results.values()]
+    logging.info(", ".join(f"{statuses.count(s):,} {s}" for s in ["fetched", "not_modified", "skipped", "failed"]))
+    return results
+
+
+def download_svgs(wikipage_name: str, file_pattern: str, output_dir: str, n_workers: int = 8
+                  , revalidate: bool = False) -> Dict[str, Dict]:
     """
     Downloads images from wikipage.
 
@@ -19,19 +149,15 @@ def download_svgs(wikipage_name: str, file_pattern: str, output_dir: str) -> Non
                         eg: "Gallery_of_sovereign_state_flags"
     :param file_pattern: the pattern in the image links to look for eg: "Flag_of_"s
     :param output_dir: the path where the downloaded files will stored eg: "./flags/svg"
-    :return: None
+    :param n_workers: number of concurrent downloads
+    :param revalidate: re-check files already on disk with conditional requests rather than skipping them
+    :return: {url: manifest entry} of the downloaded files (see `download_files`)
     """
     wikipage_img_list = wikipedia.page(wikipage_name).images
     # only keep links which have the FLAGFILE_PATTERN
     filtered_img_list = [i for i in wikipage_img_list if file_pattern in i]
 
-    for p in tqdm(filtered_img_list):
-        svgfilename = unquote(os.path.basename(p))
-        img = requests.get(p)
-
-        local_svgfile=os.path.join(f"./flags/svg/{svgfilename}")
-        with iopen(local_svgfile, "wb") as f:
-            f.write(img.content)
+    return download_files(filtered_img_list, output_dir, n_workers=n_workers, revalidate=revalidate)
 
 
 if __name__ == "__main__":
@@ -42,12 +168,13 @@ if __name__ == "__main__":
     FLAGS_PAGE = "Gallery_of_sovereign_state_flags"
     FLAGFILE_PATTERN = "Flag_of_"
     FLAG_SVG_LOC = "./flags/svg"
+    N_WORKERS = 8
 
 
     os.makedirs(FLAG_SVG_LOC, exist_ok=True)
 
     logging.info(f"Downloading SVG images from Wikipage: {FLAGS_PAGE}")
 
-    download_svgs(FLAGS_PAGE,FLAGFILE_PATTERN,FLAG_SVG_LOC )
+    download_svgs(FLAGS_PAGE,FLAGFILE_PATTERN,FLAG_SVG_LOC, n_workers=N_WORKERS)
 
-    logging.info(f"Download complete!")
\ No newline at end of file
+    logging.info(f"Download complete!")
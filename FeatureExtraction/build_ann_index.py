@@ -0,0 +1,44 @@
+"""
+Builds ANN indexes (see `utils/ann_index.py`) for the feature-stores in `./data`, saves them to `./data/ann` and
+reports their recall and latency against a brute-force search for a range of `n_probe` values.
+"""
+import os
+import logging
+import numpy as np
+import pandas as pd
+from glob import glob
+from utils.feature_store import load_feature_store, get_index_fingerprint
+from utils.similarity import normalise_rows
+from utils.ann_index import ANN_BACKENDS, recall_report
+
+if __name__ == "__main__":
+    # config:
+    logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.INFO)
+    FEATURE_STORE_LOC = "./data/*.npy"
+    OUTDIR = "./data/ann"
+    ANN_BACKEND = "ivf"
+    ANN_PARAMS = {"n_probe": 8}
+    N_PROBE_LIST = [1, 2, 4, 8, 16, 32]
+    N_QUERIES = 1000
+    K = 10
+
+    os.makedirs(OUTDIR, exist_ok=True)
+    reports = []
+    for p in glob(FEATURE_STORE_LOC):
+        featureset_name = os.path.splitext(os.path.basename(p))[0]
+        logging.info(f"Building {ANN_BACKEND} index using {featureset_name} features...")
+
+        features_df = load_feature_store(p)
+        X_norm = normalise_rows(features_df.values)
+        index = ANN_BACKENDS[ANN_BACKEND](**ANN_PARAMS).build(X_norm)
+        index.fingerprint = get_index_fingerprint(features_df.index)
+        index.save(os.path.join(OUTDIR, f"{featureset_name}.{ANN_BACKEND}.npz"))
+
+        queries = np.random.default_rng(0).choice(X_norm.shape[0], min(N_QUERIES, X_norm.shape[0]), replace=False)
+        report = recall_report(index, X_norm[queries], K, N_PROBE_LIST)
+        report.insert(0, "featureset", featureset_name)
+        reports.append(report)
+
+    report = pd.concat(reports, ignore_index=True)
+    print(report.to_string(index=False))
+    report.to_csv(os.path.join(OUTDIR, f"{ANN_BACKEND}_recall_report.csv"), index=False)
@@ -0,0 +1,47 @@
+"""
+Computes the colour signature of every cropped flag (see `utils/colour_signature.py`) - no TensorFlow needed - into
+`./data/signatures`, then reports the recall@k and per-query latency of the cascade search (shortlist by colour
+signature, re-rank with a backbone's features) against the full search, for every feature-store in `./data` and a
+range of shortlist sizes.
+
+Point `COLOUR_SIGNATURE_FILE` of the app at the signatures and set `SIMILARITY_METHOD = "cascade"` to use it.
+"""
+import os
+import logging
+import pandas as pd
+from glob import glob
+from utils.feature_store import load_feature_store, save_feature_store
+from utils.similarity import normalise_rows
+from utils.colour_signature import compute_colour_signatures, get_signature_fpath, get_signature_to_row, cascade_report
+
+if __name__ == "__main__":
+    # config:
+    logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.INFO)
+    JPG_DIR = r"..\DataDownloader\flags\cropped_jpgs\*.jpg"
+    FEATURE_STORE_LOC = "./data/*.npy"
+    DATA_DIR = "./data"
+    SHORTLIST_SIZES = [20, 50, 100, 200, 500]
+    N_QUERIES = 1000
+    K = 10
+    N_WORKERS = None # None uses all the CPUs
+
+    signature_fpath = get_signature_fpath(DATA_DIR)
+    os.makedirs(os.path.dirname(signature_fpath), exist_ok=True)
+    logging.info(f"Computing colour signatures into {signature_fpath}...")
+    signatures_df = compute_colour_signatures(sorted(glob(JPG_DIR)), N_WORKERS)
+    save_feature_store(signatures_df, signature_fpath)
+
+    reports = []
+    for p in glob(FEATURE_STORE_LOC):
+        featureset_name = os.path.splitext(os.path.basename(p))[0]
+        logging.info(f"Comparing the cascade search against the full search using {featureset_name} features...")
+        features_df = load_feature_store(p)
+        report = cascade_report(signatures_df.values, normalise_rows(features_df.values)
+                                , get_signature_to_row(signatures_df.index, features_df.index), K
+                                , SHORTLIST_SIZES, N_QUERIES)
+        report.insert(0, "featureset", featureset_name)
+        reports.append(report)
+
+    report = pd.concat(reports, ignore_index=True)
+    print(report.to_string(index=False))
+    report.to_csv(os.path.join(os.path.dirname(signature_fpath), "cascade_report.csv"), index=False)
@@ -0,0 +1,38 @@
+"""
+Compresses the feature-stores in `./data` (see `utils/compression.py`) - optional PCA followed by float16/int8
+quantisation - into `./data/compressed` and reports recall@k and score drift against the uncompressed cosine search
+for each compression setting, so the memory/accuracy trade-off can be picked per model.
+
+Point `FEATURE_DATA_DIR` of the app at the compressed feature-stores to search them directly.
+"""
+import os
+import logging
+import pandas as pd
+from glob import glob
+from utils.feature_store import load_feature_store
+from utils.compression import compress_feature_store, compression_report
+
+if __name__ == "__main__":
+    # config:
+    logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.INFO)
+    FEATURE_STORE_LOC = "./data/*.npy"
+    OUTDIR = "./data/compressed"
+    COMPRESSION_SETTINGS = [(None, "float16"), (None, "int8"), (256, "float16"), (256, "int8"), (128, "int8")]
+    N_QUERIES = 1000
+    K = 10
+
+    os.makedirs(OUTDIR, exist_ok=True)
+    reports = []
+    for p in glob(FEATURE_STORE_LOC):
+        featureset_name = os.path.splitext(os.path.basename(p))[0]
+        X = load_feature_store(p).values
+
+        for n_components, dtype in COMPRESSION_SETTINGS:
+            tag = dtype if n_components is None else f"pca{n_components}_{dtype}"
+            codec = compress_feature_store(p, os.path.join(OUTDIR, f"{featureset_name}.{tag}.npy")
+                                           , n_components=n_components, dtype=dtype)
+            reports.append({"featureset": featureset_name, **compression_report(X, codec, K, N_QUERIES)})
+
+    report = pd.DataFrame(reports)
+    print(report.to_string(index=False))
+    report.to_csv(os.path.join(OUTDIR, "compression_report.csv"), index=False)
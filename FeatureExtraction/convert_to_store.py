@@ -0,0 +1,15 @@
+"""
+One-shot conversion of the csv files in `./data` into binary feature-stores (see `utils/feature_store.py`)
+"""
+import logging
+from tqdm import tqdm
+from glob import glob
+from utils.feature_store import convert_csv_to_store
+
+if __name__ == "__main__":
+    # config:
+    logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.INFO)
+    CSV_LOC = "./data/*.csv"
+
+    for p in tqdm(glob(CSV_LOC)):
+        convert_csv_to_store(p)
@@ -1,11 +1,19 @@
 import os
 import logging
+from typing import Callable, Dict, List
+import numpy as np
 import pandas as pd
 import tensorflow as tf
 from tensorflow import keras
 from skimage.io import imread
 import PIL
-from utils.dl_utils import MySequence, get_bottleneck_features
+from utils.dl_utils import PrefetchingSequence, get_bottleneck_features, get_bottleneck_features_multi, load_batch
+from utils.feature_store import (is_store_complete, hash_file, load_manifest, save_manifest, get_manifest_changes
+                                 , merge_feature_store, get_store_paths, load_index, get_checkpoint_batch_size)
+from utils.ann_index import delete_ann_indexes
+from utils.inference import configure_cpu_threads, optimise_model, tune_batch_size, validate_model
+from utils import metrics
+from utils.metrics import timer, SamplingProfiler
 from glob import glob
 
 # All images are re-sized to 256x256
@@ -14,6 +22,44 @@ IMG_WIDTH=256
 CHANNELS=3
 IMG_SHAPE=(IMG_WIDTH, IMG_HEIGHT, CHANNELS)
 
+# features are streamed to disk batch by batch - on a re-run unfinished models resume from their
+# last checkpointed batch. Set to False to start over and re-featurise every image.
+RESUME=True
+
+# each feature-store keeps a manifest of the content hash of every image it was extracted from - a re-run
+# only featurises new/modified images, drops the rows of deleted images and merges the result into the feature-store
+
+# decode & resize each batch of images once and feed it to all the models, rather than
+# making one pass over the images per model
+MULTI_MODEL=True
+
+# number of threads decoding images and how many batches they decode ahead of the model
+N_LOADER_WORKERS=4
+N_PREFETCH_BATCHES=8
+# decode JPEGs at a reduced scale before resizing them (faster on large images) - it changes the pixels the models see,
+# so after changing it re-featurise every image (delete the feature-stores) rather than merging into them
+USE_DRAFT_DECODE=False
+
+# optimised CPU inference (see utils/inference.py) - the models are compiled into graphs, or converted with
+# TensorFlow Lite when INFERENCE_PRECISION is "float16" or "int8". An optimised model is only used if its features
+# on a sample of the images agree with the float32 model's within tolerance, otherwise the float32 model is used.
+OPTIMISED_INFERENCE=True
+INFERENCE_PRECISION="float32"
+USE_XLA=False
+INTRA_OP_THREADS=None # None leaves TensorFlow's defaults
+INTER_OP_THREADS=None
+BATCH_SIZE=None # None picks the fastest of BATCH_SIZE_CANDIDATES with OPTIMISED_INFERENCE, 8 otherwise
+BATCH_SIZE_CANDIDATES=[8, 16, 32, 64]
+N_VALIDATION_IMAGES=128 # top-10 agreement within too small a sample is a weak check
+MIN_COSINE_AGREEMENT=0.99
+MIN_TOPK_OVERLAP=0.9
+
+# time the decode, inference, write & merge stages and log a summary at the end of the run
+METRICS_ENABLED=True
+# set to a file path to sample the Python stacks during the run and save them there as collapsed stacks (flame graph
+# input) - off by default as sampling every thread adds a little overhead
+PROFILE_OUTPUT=None
+
 
 # we will using the following pre-trained models along with their respective input preprocessors
 model_list = {
@@ -31,31 +77,148 @@ model_list = {
 
 
 
+def build_featuriser_model(model_name: str) -> tf.keras.Model:
+    """
+    Wraps the pre-trained model with its input preprocessor so that it takes a batch of uint8 images
+    :param model_name: one of the keys in `model_list`
+    :return:
+    """
+    _model, _preproc = model_list[model_name]
+    model = eval(_model)
+    preproc = eval(_preproc)
+
+    i = tf.keras.layers.Input([None, None, 3], dtype=tf.uint8)
+    x = tf.cast(i, tf.float32)
+    x = preproc(x)
+    core = model
+    x = core(x)
+
+    return tf.keras.Model(inputs=[i], outputs=[x])
+
+
+def build_inference_models(model_names: List[str], sample_images: np.ndarray) -> Dict[str, Callable]:
+    """
+    Builds the featuriser models - optimised for CPU inference when OPTIMISED_INFERENCE, as long as the optimised
+    model's features on `sample_images` are within tolerance of the float32 model's
+    :param model_names:
+    :param sample_images: uint8 batch of images to validate the optimised models on
+    :return: {model_name: model}
+    """
+    models = {}
+    for model_name in model_names:
+        models[model_name] = build_featuriser_model(model_name)
+        if not OPTIMISED_INFERENCE:
+            continue
+
+        optimised_model = optimise_model(models[model_name], INFERENCE_PRECISION, USE_XLA, INTRA_OP_THREADS)
+        is_valid, report = validate_model(models[model_name], optimised_model, sample_images
+                                          , min_cosine=MIN_COSINE_AGREEMENT, min_topk_overlap=MIN_TOPK_OVERLAP)
+        if is_valid:
+            logging.info(f"Using the optimised {INFERENCE_PRECISION} {model_name} model: {report}")
+            models[model_name] = optimised_model
+        else:
+            logging.warning(f"Optimised {INFERENCE_PRECISION} {model_name} model is out of tolerance - using the "
+                            f"float32 model instead: {report}")
+    return models
+
+
+def choose_batch_size(models: Dict[str, Callable], store_fpaths: List[str]) -> int:
+    """
+    Re-uses the batch size of any checkpointed feature-store (so that it can be resumed), otherwise BATCH_SIZE or
+    the fastest of BATCH_SIZE_CANDIDATES
+    """
+    checkpointed_batch_sizes = [get_checkpoint_batch_size(f) for f in store_fpaths]
+    checkpointed_batch_sizes = [b for b in checkpointed_batch_sizes if b is not None]
+    if RESUME and checkpointed_batch_sizes:
+        return checkpointed_batch_sizes[0]
+    if BATCH_SIZE is not None:
+        return BATCH_SIZE
+    if not OPTIMISED_INFERENCE:
+        return 8
+    return tune_batch_size(models, BATCH_SIZE_CANDIDATES, (IMG_WIDTH, IMG_HEIGHT))
+
 
 if __name__=="__main__":
     logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.INFO)
-    img_list = glob(r"C:\Users\sashi\PycharmProjects\SearchDeep\DataDownloader\flags\cropped_jpgs\*.jpg")
+    if METRICS_ENABLED:
+        metrics.enable()
+    configure_cpu_threads(INTRA_OP_THREADS, INTER_OP_THREADS)
+    profiler = SamplingProfiler().start() if PROFILE_OUTPUT is not None else None
 
-    # create a folder to store the bottleneck features as csv files
+    # sorted so that the order of the images (and therefore of the batches) is the same on every re-run
+    img_list = sorted(glob(r"C:\Users\sashi\PycharmProjects\SearchDeep\DataDownloader\flags\cropped_jpgs\*.jpg"))
+
+    # create a folder to store the bottleneck features as feature-stores (.npy + .index.tsv)
     output_dir = os.path.join("data")
     os.makedirs(output_dir, exist_ok=True)
 
-    # set up a Sequence to generate images from disk and feed to the model
-    data_seq = MySequence(img_list,batch_size=8, target_size = (256,256),return_filenames=True)
+    with timer("featurise.hash"):
+        img_hashes = {os.path.basename(p): hash_file(p) for p in img_list}
+
+    # work out which images need (re-)featurising for each model
+    output_fpaths, delta_fpaths, deleted_filenames, changed_filenames = {}, {}, {}, set()
+    for model_name in model_list.keys():
+        output_fpath = os.path.join(output_dir, f"{model_name}.npy")
+        manifest = load_manifest(output_fpath) if RESUME else {}
+        changed, deleted = get_manifest_changes(manifest, img_hashes)
+        if is_store_complete(output_fpath) and not manifest:
+            # no manifest to go by - every row not in the re-featurised images has to go
+            deleted = list(set(load_index(get_store_paths(output_fpath)[1]).get_level_values("filename"))
+                           - set(img_hashes.keys()))
+
+        if not changed and not deleted:
+            logging.info(f"Skipping {model_name} - {output_fpath} is up to date")
+            continue
+
+        logging.info(f"{model_name}: {len(changed):,} new/modified and {len(deleted):,} deleted images")
+        output_fpaths[model_name] = output_fpath
+        delta_fpaths[model_name] = os.path.join(output_dir, f"{model_name}.delta.npy")
+        deleted_filenames[model_name] = deleted
+        changed_filenames.update(changed)
+
+    changed_img_list = [p for p in img_list if os.path.basename(p) in changed_filenames]
+
+    def get_data_seq(batch_size: int) -> PrefetchingSequence:
+        # set up a Sequence to generate images from disk and feed to the model
+        return PrefetchingSequence(changed_img_list, batch_size=batch_size, target_size = (256,256)
+                                   ,return_filenames=True, n_workers=N_LOADER_WORKERS, prefetch=N_PREFETCH_BATCHES
+                                   ,use_draft=USE_DRAFT_DECODE)
+
+    if len(changed_img_list) == 0:
+        # nothing to featurise - only deletions to merge
+        delta_fpaths = {model_name: None for model_name in delta_fpaths.keys()}
+
+    else:
+        sample_images = load_batch(changed_img_list[:N_VALIDATION_IMAGES], (256,256), use_draft=USE_DRAFT_DECODE)[1]
 
-    # iterate over each pre-trained model and extract features.
-    for (model_name, (_model, _preproc)) in model_list.items():
-        logging.info(f"Extracting Bottleneck Features using {model_name}...")
-        model = eval(_model)
-        preproc = eval(_preproc)
+        if MULTI_MODEL:
+            logging.info(f"Extracting Bottleneck Features using {', '.join(delta_fpaths.keys())} in a single pass...")
+            featuriser_models = build_inference_models(list(delta_fpaths.keys()), sample_images)
+            data_seq = get_data_seq(choose_batch_size(featuriser_models, list(delta_fpaths.values())))
+            get_bottleneck_features_multi(data_seq, featuriser_models, delta_fpaths, resume=RESUME)
+            data_seq.close()
 
-        i = tf.keras.layers.Input([None, None, 3], dtype=tf.uint8)
-        x = tf.cast(i, tf.float32)
-        x = preproc(x)
-        core = model
-        x = core(x)
+        else:
+            # iterate over each pre-trained model and extract features.
+            for model_name, delta_fpath in delta_fpaths.items():
+                logging.info(f"Extracting Bottleneck Features using {model_name}...")
+                featuriser_models = build_inference_models([model_name], sample_images)
+                data_seq = get_data_seq(choose_batch_size(featuriser_models, [delta_fpath]))
+                get_bottleneck_features(data_seq, featuriser_models[model_name], output_fpath=delta_fpath
+                                        , stream=True, resume=RESUME)
+                data_seq.close()
 
-        featuriser_model = tf.keras.Model(inputs=[i], outputs=[x])
+    # merge the new features into each model's feature-store and record what it was extracted from
+    for model_name, output_fpath in output_fpaths.items():
+        if delta_fpaths[model_name] is not None or deleted_filenames[model_name]:
+            with timer("featurise.merge"):
+                merge_feature_store(output_fpath, delta_fpaths[model_name], deleted_filenames[model_name])
+            # the merge drops & moves rows so the model's ANN indexes no longer match its feature-store
+            delete_ann_indexes(output_fpath)
+        save_manifest(img_hashes, output_fpath)
 
-        features_df = get_bottleneck_features(data_seq, featuriser_model)
-        features_df.to_csv(os.path.join(output_dir, f"{model_name}.csv"), header=True, index=True)
+    if profiler is not None:
+        profiler.stop().save(PROFILE_OUTPUT)
+        logging.info(f"Saved {profiler.n_samples:,} profiler samples to {PROFILE_OUTPUT}")
+    if METRICS_ENABLED:
+        logging.info(f"Stage timings:\n{metrics.METRICS.summary()}")
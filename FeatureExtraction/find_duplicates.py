@@ -0,0 +1,41 @@
+"""
+Finds the near-duplicate flags of each feature-store in `./data` with the all-pairs job in `utils/all_pairs.py`, and
+groups them into clusters - the connected components of the similarity graph at each of `CLUSTER_THRESHOLDS`.
+
+The similarity graph of each model is saved to `./data/duplicates/<model>/graph.npz` and its clusters to
+`./data/duplicates/<model>.clusters.tsv`. Interrupted runs resume from where they stopped.
+"""
+import os
+import logging
+from glob import glob
+from utils.feature_store import get_store_paths, load_index
+from utils.all_pairs import find_all_pairs, load_similarity_graph, get_clusters
+
+if __name__ == "__main__":
+    # config:
+    logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.INFO)
+    FEATURE_STORE_LOC = "./data/*.npy"
+    OUTDIR = "./data/duplicates"
+    THRESHOLD = 0.9 # min cosine similarity of a pair of near-duplicates
+    K = None # keep only the top-k neighbours of each flag (above THRESHOLD, if set) - None keeps every pair
+    CLUSTER_THRESHOLDS = [0.9, 0.95, 0.98] # should be >= THRESHOLD
+    BLOCK_ROWS = 4096 # number of rows per task
+    N_WORKERS = None # None uses all the CPUs
+
+    for p in glob(FEATURE_STORE_LOC):
+        featureset_name = os.path.splitext(os.path.basename(p))[0]
+        logging.info(f"Finding near-duplicates using {featureset_name} features...")
+        graph_fpath = find_all_pairs(p, os.path.join(OUTDIR, featureset_name), THRESHOLD, K, BLOCK_ROWS
+                                     , n_workers=N_WORKERS)
+        graph = load_similarity_graph(graph_fpath)
+
+        clusters_df = load_index(get_store_paths(p)[1]).to_frame(index=False)
+        for threshold in CLUSTER_THRESHOLDS:
+            column = f"cluster_{threshold}"
+            clusters_df[column] = get_clusters(graph, threshold)
+            cluster_sizes = clusters_df[column].map(clusters_df[column].value_counts())
+            logging.info(f"{featureset_name} @ {threshold}: {(cluster_sizes > 1).sum():,} of {len(clusters_df):,} "
+                         f"flags are in {clusters_df.loc[cluster_sizes > 1, column].nunique():,} clusters of "
+                         f"near-duplicates")
+
+        clusters_df.to_csv(os.path.join(OUTDIR, f"{featureset_name}.clusters.tsv"), sep="\t", index=False)
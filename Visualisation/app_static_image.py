@@ -1,29 +1,84 @@
+import os
+import sys
+import time
 import base64
 import logging
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from io import BytesIO
 from pprint import pprint
+from urllib.parse import quote
+from typing import Dict, List
 
 import dash
+import flask
 import dash_core_components as dcc
 import dash_html_components as html
 
+# make the repo's `utils` package importable when the app is run from this folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
 from resize_images import THUMBNAIL_SIZE
 from viz_utils import SimilaritySearch, get_image_grid
+from render_cache import LRUCache
+from utils.shared_store import is_published
+from utils import metrics
+from utils.metrics import timer, SamplingProfiler
+from utils.metadata_index import parse_filter, Filter
+from utils.colour_signature import load_colour_signature
 
 # set-up state for performing similarity searches
 IMAGE_DATA_DIR = r"./thumbnails"
+ASSETS_URL_PATH = "/" # the thumbnails are served as static assets from here
 FONT_FILE = r"./Fonts/UbuntuMono-Regular.ttf"
-FEATURE_DATA_DIR = "..\FeatureExtraction\data\*.csv"
+FEATURE_DATA_DIR = "..\FeatureExtraction\data\*.npy" # feature-stores - use *.csv to load the csv files instead
+# or eg: ..\FeatureExtraction\data\compressed\*.pca256_int8.npy to search compressed features
 IMG_GRID_SPACING= 5 # in px
 N_ITEMS_TO_RETRIEVE = 10
-SIMILARITY_METHOD = "knn" # one of "knn" or "cosine"
-sim_state = SimilaritySearch(FEATURE_DATA_DIR, N_ITEMS_TO_RETRIEVE)
+GRID_CACHE_SIZE = 256 # number of rendered result grids kept in memory
+GRID_RENDER_MODE = "client" # "client" lays the thumbnails out in the browser, "png" renders the grid on the server
+SIMILARITY_METHOD = "knn" # one of "knn", "cosine", "ann" or "cascade"
+ANN_BACKEND = "ivf" # only used when SIMILARITY_METHOD is "ann"
+ANN_INDEX_DIR = r"..\FeatureExtraction\data\ann"
+ANN_PARAMS = {"n_probe": 8}
+# colour signatures made by `FeatureExtraction/colour_signatures.py` - "cascade" searches shortlist candidates by them
+# and only re-rank those with each model's features (see its cascade_report.csv to pick the shortlist size)
+COLOUR_SIGNATURE_FILE = r"..\FeatureExtraction\data\signatures\ColourSignature.npy"
+CASCADE_SHORTLIST_SIZE = 200
+# when serving with several worker processes run `publish_search_state.py` once beforehand and point this at its
+# output folder - each worker then memory-maps the published state instead of loading & pre-computing its own copy
+SHARED_STATE_DIR = None # eg: r"..\FeatureExtraction\data\shared_state"
+LAZY_LOADING = True # only load a feature set the first time it's searched - the app starts serving straight away
+MEMORY_BUDGET_MB = None # evict the least recently used feature sets beyond this budget - None means no limit
+WARM_UP = True # load the feature sets in the background (within MEMORY_BUDGET_MB) once the app has started
+METRICS_ENABLED = True # time the load, search, render & encode stages - served as JSON from /api/metrics
+PROFILER_ENABLED = False # serve /api/profile?seconds=N which samples the server's Python stacks for N seconds
+# search by uploaded images - TensorFlow & the featuriser models are loaded by the first upload (which is slow and takes
+# a few GB per worker process) and then kept warm
+QUERY_BY_UPLOAD = False
+UPLOAD_TIMEOUT_SECONDS = 60 # uploads that aren't featurised within this get a 503
+UPLOAD_MAX_BATCH_SIZE = 16 # concurrent uploads are featurised together in batches of up to this many images
+UPLOAD_MAX_WAIT_MS = 10 # ...waiting at most this long for other uploads to join a batch
+
+if METRICS_ENABLED:
+    metrics.enable()
+
+if SHARED_STATE_DIR is not None and is_published(SHARED_STATE_DIR):
+    sim_state = SimilaritySearch.attach(SHARED_STATE_DIR)
+else:
+    sim_state = SimilaritySearch(FEATURE_DATA_DIR, N_ITEMS_TO_RETRIEVE
+                                 , ann_backend=ANN_BACKEND if SIMILARITY_METHOD == "ann" else None
+                                 , ann_index_dir=ANN_INDEX_DIR, ann_params=ANN_PARAMS, lazy=LAZY_LOADING
+                                 , memory_budget_mb=MEMORY_BUDGET_MB, warm_up=WARM_UP
+                                 , signature_fpath=COLOUR_SIGNATURE_FILE if os.path.exists(COLOUR_SIGNATURE_FILE)
+                                 else None, shortlist_size=CASCADE_SHORTLIST_SIZE)
 
 # get the list of territory names
-list_of_models = list(sim_state.feature_dfs.keys())
+list_of_models = list(sim_state.featureset_names)
 N_MODELS=len(list_of_models)
 featureset_name = list_of_models[0] #pick the first feature set - we can use any featureset
-territories = sim_state.feature_dfs[featureset_name].index.to_list()
+# read from the feature set's keys so that lazy loading doesn't have to load it before the app can start
+territories = sim_state.get_featureset_index(featureset_name).to_list()
 territories = sorted(territories, key=lambda country: country[1]) # sorts by proper country name
 territories_dict= dict(territories)
 
@@ -33,7 +88,7 @@ external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets,
                 assets_folder=IMAGE_DATA_DIR,
-                assets_url_path='/')
+                assets_url_path=ASSETS_URL_PATH)
 
 app.layout = html.Div([
     html.Header(
@@ -60,33 +115,252 @@ app.layout = html.Div([
         value='Flag_of_France.jpg'
     ),
     html.Br(),
-    html.Img(
+    html.Div(id='dd-output-container'),
+    *([html.Br(),
+       html.Label('...or upload a flag:'),
+       dcc.Upload(id='flag-upload', children=html.Div(["Drag and drop or ", html.A("select an image")])
+                  , style={"borderWidth": "1px", "borderStyle": "dashed", "borderRadius": "5px", "padding": "20px"
+                           , "textAlign": "center"}),
+       html.Br(),
+       html.Div(id='upload-output-container')] if QUERY_BY_UPLOAD else [])
 
 
 
-     id='dd-output-container', style={'columnCount': 1}
-    )
+], style={'columnCount': 1})
 
 
+def get_query_name(value: str) -> str:
+    """
+    Queries can either be a filename (as used in the dropdown) or a territory name
+    """
+    return territories_dict.get(value, value)
 
-], style={'columnCount': 1})
 
+def to_json_results(search_results: Dict[str, List[List]]) -> Dict[str, List[Dict]]:
+    return {model_name: [{"filename": filename, "territory_name": territory_name, "score": float(score)
+                          , "url": f"{ASSETS_URL_PATH.rstrip('/')}/{quote(filename)}"}
+                         for filename, territory_name, score in matches]
+            for model_name, matches in search_results.items()}
 
-@app.callback(
-    dash.dependencies.Output('dd-output-container', 'src'),
-    [dash.dependencies.Input('territory-dropdown', 'value')])
-def update_output(value):
+
+@app.server.route("/api/search")
+def api_search():
+    """
+    JSON search endpoint eg: /api/search?q=Flag_of_France.jpg&method=cosine&models=VGG16,Xception
+    (models defaults to all of them) - results can be filtered by the flags' metadata with any number of `where`
+    filters eg: &where=variant==&where=territory_name!=France (see `utils.metadata_index.parse_filter`)
+    """
+    query = flask.request.args.get("q", "")
+    method = flask.request.args.get("method", SIMILARITY_METHOD)
+    models = flask.request.args.get("models")
+    try:
+        filters = [parse_filter(f) for f in flask.request.args.getlist("where")]
+        search_results = sim_state.search(get_query_name(query), method
+                                          , featuresets=None if models is None else models.split(",")
+                                          , filters=filters)
+    except (KeyError, AssertionError, ValueError) as e:
+        return flask.jsonify({"error": f"bad query {query!r} or method {method!r}: {e}"}), 400
+
+    return flask.jsonify({"query": query, "method": method, "results": to_json_results(search_results)})
+
+
+@app.server.route("/api/search/batch", methods=["POST"])
+def api_search_batch():
+    """
+    JSON batch search endpoint - POST {"queries": ["Flag_of_France.jpg", "Italy", ...], "method": "cosine"}
+    cosine searches are answered in a single vectorised pass (see `SimilaritySearch.search_batch`). Results can be
+    filtered by the flags' metadata with "filters": [["variant", "==", ""], ...] (see `utils.metadata_index`)
+    """
+    payload = flask.request.get_json(force=True, silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get("queries", []), list)\
+            or not isinstance(payload.get("filters", []), list)\
+            or not all(isinstance(f, list) and len(f) == 3 for f in payload.get("filters", [])):
+        return flask.jsonify({"error": "expected a JSON object with a list of \"queries\" and optional "
+                                       "\"filters\" of [column, op, value] lists"}), 400
+
+    method = payload.get("method", SIMILARITY_METHOD)
+    try:
+        queries = [get_query_name(q) for q in payload.get("queries", [])]
+        filters = [tuple(f) for f in payload.get("filters", [])]
+        if method == "cosine":
+            batch_results = sim_state.search_batch(queries, filters=filters)
+        else:
+            batch_results = [sim_state.search(q, method, filters=filters) for q in queries]
+    except (KeyError, AssertionError, ValueError, TypeError) as e:
+        return flask.jsonify({"error": f"bad queries or method {method!r}: {e}"}), 400
+
+    return flask.jsonify({"method": method, "results": [{"query": q, "results": to_json_results(r)}
+                                                         for q, r in zip(payload.get("queries", []), batch_results)]})
+
+
+def layout_search_results(search_results: Dict[str, List[List]]) -> html.Div:
+    """
+    Lays the results out as one column of thumbnails per model - the browser loads the thumbnails straight from the
+    static assets so the server only sends the layout
+    """
+    columns = []
+    for model_name, matches in search_results.items():
+        cells = [html.Div(model_name, style={"height": "32px", "fontWeight": "bold", "textAlign": "center"})]
+        for match in to_json_results({model_name: matches})[model_name]:
+            cells.append(html.Div(f"{match['territory_name']} [{match['score']:0.3f}]"
+                                  , style={"height": "32px", "fontSize": "12px", "textAlign": "center"}))
+            cells.append(html.Img(src=match["url"], style={"width": f"{THUMBNAIL_SIZE}px"}))
+        columns.append(html.Div(cells, style={"width": f"{THUMBNAIL_SIZE}px", "marginRight": f"{IMG_GRID_SPACING}px"}))
+
+    return html.Div(columns, style={"display": "flex", "alignItems": "flex-start"})
+
+
+# rendered result grids keyed by (query, method, k) - concurrent requests for the same grid only render it once
+grid_cache = LRUCache(GRID_CACHE_SIZE)
+
+
+def render_search_results(value: str) -> str:
     search_results = sim_state.search(territories_dict[value], SIMILARITY_METHOD)
     pprint(search_results)
+    return render_grid_png(search_results)
+
+
+def render_grid_png(search_results: Dict[str, List[List]]) -> str:
+    """
+    :return: the results' grid as a PNG data url
+    """
     flag_grid = get_image_grid(search_results, IMAGE_DATA_DIR, FONT_FILE, THUMBNAIL_SIZE, IMG_GRID_SPACING)
     buffered_flag_grid = BytesIO()
-    flag_grid.save(buffered_flag_grid, format="PNG")
+    with timer("render.encode"):
+        flag_grid.save(buffered_flag_grid, format="PNG")
 
     img_str = base64.b64encode(buffered_flag_grid.getvalue())
 
-    result = 'data:image/png;base64,{}'.format(img_str.decode("ascii"))
+    return 'data:image/png;base64,{}'.format(img_str.decode("ascii"))
+
+
+# the featuriser service & {featureset: name of the model it was extracted with} - set up by the first upload
+upload_state = {}
+upload_state_lock = threading.Lock()
+
+
+def get_upload_state() -> dict:
+    """
+    Builds the featuriser models of the feature sets & starts the service featurising uploads the first time it's
+    called - importing TensorFlow and building the models takes a while so it's kept off the app's start-up
+    """
+    with upload_state_lock:
+        if not upload_state:
+            from FeatureExtraction.featuriser import build_featuriser_model, model_list, USE_DRAFT_DECODE
+            from utils.featurise_service import FeaturiserService
+
+            # feature sets are named after the model they were extracted with (compressed ones have a suffix eg:
+            # VGG16.int8)
+            featuresets = {featureset: featureset.split(".")[0] for featureset in sim_state.featureset_names
+                           if featureset.split(".")[0] in model_list}
+            service = FeaturiserService({model_name: build_featuriser_model(model_name)
+                                         for model_name in set(featuresets.values())}
+                                        , max_batch_size=UPLOAD_MAX_BATCH_SIZE, max_wait_ms=UPLOAD_MAX_WAIT_MS
+                                        , use_draft=USE_DRAFT_DECODE) # decoded like the stored flags
+            upload_state.update(service=service.start(), featuresets=featuresets)
+    return upload_state
+
+
+def search_uploaded_image(image_bytes: bytes, method: str, filters: List[Filter] = None) -> Dict[str, List[List]]:
+    """
+    Featurises an uploaded image with the warm featuriser models and searches for flags similar to it - "cascade"
+    searches also shortlist by the upload's colour signature, which is computed here (with PIL alone)
+    """
+    query_signature = load_colour_signature(BytesIO(image_bytes)) if method == "cascade" else None
+    state = get_upload_state()
+    features = state["service"].featurise(image_bytes, timeout=UPLOAD_TIMEOUT_SECONDS)
+    return sim_state.search_by_vector({featureset: features[model_name]
+                                       for featureset, model_name in state["featuresets"].items()}, method, filters
+                                      , query_signature)
+
+
+@app.server.route("/api/search/upload", methods=["POST"])
+def api_search_upload():
+    """
+    JSON search endpoint for uploaded images eg:
+        curl -F image=@my_flag.png "http://127.0.0.1:8050/api/search/upload?method=cosine"
+    (takes the same `where` filters as /api/search)
+    """
+    if not QUERY_BY_UPLOAD:
+        flask.abort(404)
+    method = flask.request.args.get("method", SIMILARITY_METHOD)
+    image_file = flask.request.files.get("image")
+    image_bytes = image_file.read() if image_file is not None else flask.request.get_data()
+    try:
+        filters = [parse_filter(f) for f in flask.request.args.getlist("where")]
+        search_results = search_uploaded_image(image_bytes, method, filters)
+    except FutureTimeoutError:
+        # (a subclass of OSError since python 3.11 so it has to be caught first)
+        return flask.jsonify({"error": f"the image wasn't featurised within {UPLOAD_TIMEOUT_SECONDS}s - the server "
+                                       f"is busy, try again later"}), 503
+    except OSError as e:
+        return flask.jsonify({"error": f"could not read the uploaded image: {e}"}), 400
+    except (AssertionError, ValueError) as e:
+        return flask.jsonify({"error": f"bad method {method!r} or filters: {e}"}), 400
+
+    return flask.jsonify({"method": method, "results": to_json_results(search_results)})
+
+
+@app.server.route("/api/metrics")
+def api_metrics():
+    """
+    Stage timings & counters recorded since the app started, plus the rendered grid cache's stats
+    """
+    return flask.jsonify({**metrics.METRICS.snapshot(), "grid_cache": {"size": len(grid_cache), "hits": grid_cache.hits
+                                                                       , "misses": grid_cache.misses}})
+
+
+@app.server.route("/api/profile")
+def api_profile():
+    """
+    Samples the Python stacks of the server's threads for `seconds` (default 5, clamped to 0-60) eg:
+    /api/profile?seconds=10 and returns them as collapsed stacks, ready for a flame graph tool - only served when
+    PROFILER_ENABLED
+    """
+    if not PROFILER_ENABLED:
+        flask.abort(404)
+    try:
+        seconds = float(flask.request.args.get("seconds", 5))
+    except ValueError as e:
+        return flask.jsonify({"error": f"bad seconds: {e}"}), 400
+    # (a NaN fails both comparisons and ends up as 0)
+    seconds = max(0, min(seconds, 60))
+    with SamplingProfiler() as profiler:
+        time.sleep(seconds)
+    return flask.Response(profiler.collapsed_stacks(), mimetype="text/plain")
+
+
+@app.callback(
+    dash.dependencies.Output('dd-output-container', 'children'),
+    [dash.dependencies.Input('territory-dropdown', 'value')])
+def update_output(value):
+    if GRID_RENDER_MODE == "client":
+        return layout_search_results(sim_state.search(territories_dict[value], SIMILARITY_METHOD))
+
+    return html.Img(src=grid_cache.get_or_compute((value, SIMILARITY_METHOD, N_ITEMS_TO_RETRIEVE)
+                                                  , lambda: render_search_results(value)))
+
+
+if QUERY_BY_UPLOAD:
+    @app.callback(
+        dash.dependencies.Output('upload-output-container', 'children'),
+        [dash.dependencies.Input('flag-upload', 'contents')])
+    def update_upload_output(contents):
+        if contents is None:
+            return None
+
+        # contents is a data url: data:<mime type>;base64,<data>
+        try:
+            search_results = search_uploaded_image(base64.b64decode(contents.split(",", 1)[1]), SIMILARITY_METHOD)
+        except FutureTimeoutError:
+            return html.Div(f"The image wasn't featurised within {UPLOAD_TIMEOUT_SECONDS}s - try again later"
+                            , style={"color": "red"})
+        except (OSError, ValueError, IndexError, AssertionError) as e:
+            return html.Div(f"Could not search for the uploaded file: {e}", style={"color": "red"})
 
-    return result
+        if GRID_RENDER_MODE == "client":
+            return layout_search_results(search_results)
+        return html.Img(src=render_grid_png(search_results))
 
 
 
@@ -0,0 +1,33 @@
+"""
+Loads the feature sets, pre-computes the search structures once and publishes them to a folder which the app's worker
+processes memory-map on start-up (see `SHARED_STATE_DIR` in `app_static_image.py`) - so memory stays flat as workers
+are added and each worker starts almost instantly.
+
+Run this from the `Visualisation` folder before starting the workers, and again whenever the feature sets change.
+"""
+import os
+import sys
+import logging
+
+# make the repo's `utils` package importable when run from this folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from viz_utils import SimilaritySearch
+
+if __name__ == "__main__":
+    # config - should match the settings in app_static_image.py
+    logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.INFO)
+    FEATURE_DATA_DIR = r"..\FeatureExtraction\data\*.npy"
+    N_ITEMS_TO_RETRIEVE = 10
+    ANN_BACKEND = None # eg: "ivf" to publish ANN indexes too
+    ANN_INDEX_DIR = r"..\FeatureExtraction\data\ann"
+    ANN_PARAMS = {"n_probe": 8}
+    COLOUR_SIGNATURE_FILE = None # eg: r"..\FeatureExtraction\data\signatures\ColourSignature.npy" for "cascade"
+    CASCADE_SHORTLIST_SIZE = 200
+    # any folder works - on Linux a folder in /dev/shm (eg: "/dev/shm/flag_similarity") keeps it in RAM
+    SHARED_STATE_DIR = r"..\FeatureExtraction\data\shared_state"
+
+    sim_state = SimilaritySearch(FEATURE_DATA_DIR, N_ITEMS_TO_RETRIEVE, ann_backend=ANN_BACKEND
+                                 , ann_index_dir=ANN_INDEX_DIR, ann_params=ANN_PARAMS
+                                 , signature_fpath=COLOUR_SIGNATURE_FILE, shortlist_size=CASCADE_SHORTLIST_SIZE)
+    sim_state.publish(SHARED_STATE_DIR)
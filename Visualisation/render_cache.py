@@ -0,0 +1,63 @@
+"""
+Thread-safe LRU cache used to keep rendered results (eg: the PNG grid of a search) around between Dash callbacks.
+
+Concurrent requests for a key that is still being computed wait for that computation instead of starting their own,
+so N identical requests arriving together only render once.
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.in_flight = {} # key -> Event set when the key's computation finishes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """
+        Returns the cached value of `key`, computing (and caching) it with `compute()` if it isn't cached yet
+        :param key:
+        :param compute:
+        :return:
+        """
+        while True:
+            with self.lock:
+                if key in self.items:
+                    self.items.move_to_end(key)
+                    self.hits += 1
+                    return self.items[key]
+
+                event = self.in_flight.get(key)
+                if event is None:
+                    # nobody is computing this key - it's on us
+                    event = self.in_flight[key] = threading.Event()
+                    self.misses += 1
+                    break
+
+            # somebody else is computing this key - wait for them and look again
+            event.wait()
+
+        try:
+            value = compute()
+            with self.lock:
+                self.items[key] = value
+                self.items.move_to_end(key)
+                while len(self.items) > self.maxsize:
+                    self.items.popitem(last=False)
+            return value
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            event.set()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
@@ -1,14 +1,32 @@
 """
 Resize images to have the same short-side for use in Dash app
+
+Every image is decoded once (at reduced scale where possible) to make thumbnails of all of `THUMBNAIL_SIZES`, on a
+pool of processes. The content hash of each source image is kept in a manifest (``thumbnails.manifest.json``) so
+re-runs only resize the images that are new or modified, and drop the thumbnails of deleted images.
+
+The thumbnails of each size are also packed into a single archive (see `utils/thumbnail_archive.py`) which
+`get_image_grid` reads from instead of opening a file per thumbnail.
 """
 import os
+import sys
+import json
 import math
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
 from tqdm import tqdm
 from PIL import Image
 from glob import glob
 
+# make the repo's `utils` package importable when run from this folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils.feature_store import hash_file, get_manifest_changes
+from utils.thumbnail_archive import get_thumbnail_archive_fpath, pack_thumbnail_archive, is_thumbnail_archive
+
 THUMBNAIL_SIZE= 192
+MANIFEST_FNAME = "thumbnails.manifest.json"
 
 def thumbnail(img: Image, size: int) -> Image:
     """
@@ -38,19 +56,121 @@ def thumbnail(img: Image, size: int) -> Image:
 
     return img
 
+
+def get_thumbnail_dir(outdir: str, size: int) -> str:
+    """
+    Thumbnails of `THUMBNAIL_SIZE` (the ones the app serves) go straight into `outdir`, other sizes into a sub-folder
+    """
+    return outdir if size == THUMBNAIL_SIZE else os.path.join(outdir, str(size))
+
+
+def get_thumbnail_shape(img_size: Tuple[int, int], size: int) -> Tuple[int, int]:
+    """
+    (width, height) of the thumbnail `thumbnail` makes of an image of `img_size`
+    """
+    width, height = img_size
+    if height > width:
+        return int(math.floor(float(width) / float(height) * size)), size
+    return size, int(math.floor(float(height) / float(width) * size))
+
+
+def make_thumbnails(img_fpath: str, sizes: List[int], outdir: str, quality: int = 100) -> str:
+    """
+    Decodes an image once and saves its thumbnails of all of `sizes` - JPEGs are decoded at the smallest DCT scale
+    that is still at least as big as the largest thumbnail, other images are box-reduced by a whole factor first
+    :param img_fpath:
+    :param sizes:
+    :param outdir:
+    :param quality:
+    :return: filename of the image
+    """
+    filename = os.path.basename(img_fpath)
+    with Image.open(img_fpath) as image:
+        max_width, max_height = get_thumbnail_shape(image.size, max(sizes))
+        image.draft("RGB", (max_width, max_height))
+        image = image.convert("RGB")
+
+    factor = min(image.width // max(max_width, 1), image.height // max(max_height, 1))
+    if factor >= 2:
+        image = image.reduce(factor)
+
+    for size in sizes:
+        thumb = thumbnail(image, size)
+        thumb.save(os.path.join(get_thumbnail_dir(outdir, size), filename), quality=quality)
+    return filename
+
+
+def load_thumbnail_manifest(outdir: str) -> Dict[str, str]:
+    manifest_fpath = os.path.join(outdir, MANIFEST_FNAME)
+    if not os.path.exists(manifest_fpath):
+        return {}
+    with open(manifest_fpath) as f:
+        return json.load(f)
+
+
+def save_thumbnail_manifest(manifest: Dict[str, str], outdir: str) -> None:
+    manifest_fpath = os.path.join(outdir, MANIFEST_FNAME)
+    with open(manifest_fpath + ".part", "w") as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+    os.replace(manifest_fpath + ".part", manifest_fpath)
+
+
+def build_thumbnails(img_fpaths: List[str], outdir: str, sizes: List[int], n_workers: int = None) -> Dict[str, str]:
+    """
+    Makes the thumbnails of the images that are new or modified (or are missing a thumbnail of any of `sizes`),
+    deletes the thumbnails of deleted images and re-packs the archive of every size
+    :param img_fpaths: source images
+    :param outdir:
+    :param sizes:
+    :param n_workers: number of processes resizing images - None uses all the CPUs
+    :return: {size: archive path}
+    """
+    for size in sizes:
+        os.makedirs(get_thumbnail_dir(outdir, size), exist_ok=True)
+
+    manifest = load_thumbnail_manifest(outdir)
+    img_fpaths = {os.path.basename(p): p for p in img_fpaths}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        img_hashes = dict(zip(img_fpaths.keys(), executor.map(hash_file, img_fpaths.values(), chunksize=16)))
+        changed_filenames, deleted_filenames = get_manifest_changes(manifest, img_hashes)
+        changed_filenames = set(changed_filenames)
+        changed_filenames.update(filename for filename in img_fpaths.keys() for size in sizes
+                                 if not os.path.exists(os.path.join(get_thumbnail_dir(outdir, size), filename)))
+        logging.info(f"{len(changed_filenames)} new or modified images, {len(deleted_filenames)} deleted images"
+                     f" - {len(img_fpaths) - len(changed_filenames)} unchanged images are skipped")
+
+        jobs = [executor.submit(make_thumbnails, img_fpaths[filename], sizes, outdir)
+                for filename in sorted(changed_filenames)]
+        for job in tqdm(jobs):
+            filename = job.result()
+            manifest[filename] = img_hashes[filename]
+
+    for filename in deleted_filenames:
+        for size in sizes:
+            thumb_fpath = os.path.join(get_thumbnail_dir(outdir, size), filename)
+            if os.path.exists(thumb_fpath):
+                os.remove(thumb_fpath)
+        del manifest[filename]
+    save_thumbnail_manifest(manifest, outdir)
+
+    archive_fpaths = {}
+    for size in sizes:
+        archive_fpaths[size] = get_thumbnail_archive_fpath(outdir, size)
+        if changed_filenames or deleted_filenames or not is_thumbnail_archive(archive_fpaths[size]):
+            logging.info(f"Packing the {size}px thumbnails into {archive_fpaths[size]}...")
+            pack_thumbnail_archive([os.path.join(get_thumbnail_dir(outdir, size), filename)
+                                    for filename in sorted(img_fpaths.keys())], archive_fpaths[size])
+    return archive_fpaths
+
+
 if __name__ == "__main__":
     # config:
     logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.INFO)
     JPG_DIR= r"../DataDownloader/flags/cropped_jpgs/*.jpg"
     OUTDIR = "./thumbnails"
 
-    os.makedirs(OUTDIR, exist_ok=True)
-    jpg_flags = glob(JPG_DIR)
-
+    THUMBNAIL_SIZES = [THUMBNAIL_SIZE, 96, 384] # all made from a single decode of each image
+    N_WORKERS = None # None uses all the CPUs
 
-    for p in tqdm(jpg_flags):
-        filename = os.path.basename(p)
-
-        image = Image.open(p)
-        thumb = thumbnail(image, THUMBNAIL_SIZE)
-        thumb.save(os.path.join(OUTDIR, filename), quality=100)
\ No newline at end of file
+    jpg_flags = glob(JPG_DIR)
+    build_thumbnails(jpg_flags, OUTDIR, THUMBNAIL_SIZES, N_WORKERS)
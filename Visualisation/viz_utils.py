@@ -1,13 +1,37 @@
 import os
 import logging
 import textwrap
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from PIL import Image, ImageFont, ImageDraw
 from glob import glob
 import pandas as pd
 import numpy as np
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Union, Sequence, Optional
 from sklearn.neighbors import NearestNeighbors
-from sklearn.metrics.pairwise import  cosine_similarity
+from utils.feature_store import load_features, load_feature_store, get_feature_columns, get_index_fingerprint\
+    , load_features_index, load_features_shape
+from utils.shared_store import publish_arrays, attach_arrays
+from utils.similarity import normalise_rows, top_k_cosine, masked_top_k_cosine, update_top_k_cosine
+from utils.ann_index import ANN_BACKENDS
+from utils.compression import load_codec, get_codec_fpath, FeatureCodec
+from utils.metrics import timer, timed, increment
+from utils.thumbnail_archive import ThumbnailArchive, get_thumbnail_archive_fpath
+from utils.metadata_index import MetadataIndex, load_metadata, Filter
+from utils.colour_signature import get_signature_to_row, get_signature_mask, shortlist, rerank
+
+# max number of fonts, rendered label tiles and decoded thumbnails kept in memory between renders
+FONT_CACHE_SIZE = 16
+LABEL_CACHE_SIZE = 4096
+THUMBNAIL_CACHE_SIZE = 4096
+ARCHIVE_CACHE_SIZE = 16
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def get_font(fontpath: str, font_size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(fontpath, size=font_size, encoding='utf-8')
+
 
 def does_label_needs_to_be_wrapped(font: ImageFont.FreeTypeFont, label_text:str
                                    , label_width:int) -> Tuple[bool, int]:
@@ -25,10 +49,11 @@ def does_label_needs_to_be_wrapped(font: ImageFont.FreeTypeFont, label_text:str
 
 
 
+@timed("render.label")
 def draw_label(fontpath: str, label_text:str, label_width:int, label_height:int, font_size:int=14) ->Image:
     label_box = Image.new("RGB", (label_width, label_height), (0,0,0))
     draw = ImageDraw.Draw(label_box)
-    font = ImageFont.truetype(fontpath, size=font_size, encoding='utf-8')
+    font = get_font(fontpath, font_size)
 
     # check if the label needs to be wrapped to fit in label_box
     do_wrap, single_line_chars= does_label_needs_to_be_wrapped(font, label_text, label_width)
@@ -54,6 +79,79 @@ def draw_label(fontpath: str, label_text:str, label_width:int, label_height:int,
 
 
 
+@lru_cache(maxsize=LABEL_CACHE_SIZE)
+def get_label_tile(fontpath: str, label_text:str, label_width:int, label_height:int, font_size:int=14) ->Image:
+    """
+    Cached version of `draw_label` - the returned image is shared between callers so it must not be modified
+    """
+    return draw_label(fontpath, label_text, label_width, label_height, font_size)
+
+
+def get_archive_version(img_dir: str, thumbnail_size: int) -> Union[int, None]:
+    """
+    :return: modification time (ns) of the packed archive of the `thumbnail_size` thumbnails in `img_dir` - None if
+    there isn't one. Rebuilding an archive renames a new file into place, which changes it.
+    """
+    try:
+        return os.stat(get_thumbnail_archive_fpath(img_dir, thumbnail_size)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+@lru_cache(maxsize=ARCHIVE_CACHE_SIZE)
+def open_thumbnail_archive(archive_fpath: str, archive_version: int) -> ThumbnailArchive:
+    """
+    Cached on `archive_version` as well as the path, so a rebuilt archive is picked up by a running app
+    """
+    return ThumbnailArchive(archive_fpath)
+
+
+def get_thumbnail_archive(img_dir: str, thumbnail_size: int) -> Union[ThumbnailArchive, None]:
+    """
+    Memory-maps the packed archive of the `thumbnail_size` thumbnails in `img_dir` (see `resize_images.py`) - None if
+    there isn't one
+    """
+    archive_version = get_archive_version(img_dir, thumbnail_size)
+    if archive_version is None:
+        return None
+    return open_thumbnail_archive(get_thumbnail_archive_fpath(img_dir, thumbnail_size), archive_version)
+
+
+@lru_cache(maxsize=THUMBNAIL_CACHE_SIZE)
+@timed("render.thumbnail_io")
+def decode_thumbnail(img_dir: str, filename: str, thumbnail_size: Union[int, None]
+                     , archive_version: Union[int, None]) -> Image:
+    """
+    Cached version of the decode in `load_thumbnail` - keyed on `archive_version` (see `get_archive_version`) so the
+    thumbnails of a rebuilt archive aren't served from the cache
+    """
+    archive = None if archive_version is None \
+        else open_thumbnail_archive(get_thumbnail_archive_fpath(img_dir, thumbnail_size), archive_version)
+    if archive is not None and filename in archive:
+        return archive.open_image(filename)
+
+    with Image.open(os.path.join(img_dir, filename)) as img:
+        img.load()
+        return img
+
+
+def load_thumbnail(img_dir: str, filename: str, thumbnail_size: int = None) -> Image:
+    """
+    Decodes a thumbnail once and keeps it in memory - the returned image is shared between callers so it must not be
+    modified. The thumbnail is read from the packed archive of `thumbnail_size` thumbnails when there is one, and
+    from its own file in `img_dir` otherwise. Renders of many thumbnails should look up the archive's version once
+    and call `decode_thumbnail` - as `get_image_grid` does.
+    """
+    archive_version = get_archive_version(img_dir, thumbnail_size) if thumbnail_size is not None else None
+    return decode_thumbnail(img_dir, filename, thumbnail_size, archive_version)
+
+
+def clear_render_caches() -> None:
+    for cached_function in (get_font, get_label_tile, decode_thumbnail, open_thumbnail_archive):
+        cached_function.cache_clear()
+
+
+@timed("render.grid")
 def get_image_grid(search_results: Dict[str, List[List]], img_dir: str,font_path: str
                        , thumbnail_size: int=192, spacing:int =5):
     # find how many models we have returned results
@@ -78,6 +176,9 @@ def get_image_grid(search_results: Dict[str, List[List]], img_dir: str,font_path
 
     grid_img = Image.new("RGB", (grid_width, grid_height), (0,0,0))
 
+    # look up the thumbnail archive once for the whole grid rather than once per thumbnail
+    archive_version = get_archive_version(img_dir, thumbnail_size)
+
     # below we will fill the grid of images one column at a time
     grid_img_px_tracker = spacing
     for model_name, matches in search_results.items():
@@ -89,28 +190,28 @@ def get_image_grid(search_results: Dict[str, List[List]], img_dir: str,font_path
             if idx==0:
                 # before we add first image to column , set up the column header
                 # header img
-                label_img = draw_label(font_path, model_name, label_box_width, label_box_height, 18)
+                label_img = get_label_tile(font_path, model_name, label_box_width, label_box_height, 18)
                 column_img.paste(label_img, (0,column_img_px_tracker))
 
                 # move down the column to paste the 1st flag
                 column_img_px_tracker+= label_box_height
 
                 # 1st flag
-                label_img = draw_label(font_path, img_caption, label_box_width, label_box_height, 14)
+                label_img = get_label_tile(font_path, img_caption, label_box_width, label_box_height, 14)
                 column_img.paste(label_img, (0, column_img_px_tracker))
                 column_img_px_tracker += label_box_height
 
-                flag_img = Image.open(os.path.join(img_dir,img_to_show))
+                flag_img = decode_thumbnail(img_dir, img_to_show, thumbnail_size, archive_version)
                 column_img.paste(flag_img, (0, column_img_px_tracker))
                 column_img_px_tracker += thumbnail_size
 
 
             else:
-                label_img = draw_label(font_path, img_caption, label_box_width, label_box_height, 14)
+                label_img = get_label_tile(font_path, img_caption, label_box_width, label_box_height, 14)
                 column_img.paste(label_img, (0, column_img_px_tracker))
                 column_img_px_tracker += label_box_height
 
-                flag_img = Image.open(os.path.join(img_dir, img_to_show))
+                flag_img = decode_thumbnail(img_dir, img_to_show, thumbnail_size, archive_version)
                 column_img.paste(flag_img, (0, column_img_px_tracker))
                 column_img_px_tracker += thumbnail_size
 
@@ -121,58 +222,648 @@ def get_image_grid(search_results: Dict[str, List[List]], img_dir: str,font_path
 
 
 class SimilaritySearch:
-    def __init__(self, data_dir:str, knn_k: int):
+    def __init__(self, data_dir:str, knn_k: int, ann_backend: str = None, ann_index_dir: str = None
+                 , ann_params: dict = None, lazy: bool = False, memory_budget_mb: float = None, warm_up: bool = False
+                 , signature_fpath: str = None, shortlist_size: int = 200):
+        """
+        :param data_dir: glob pattern of the feature files to load - either csv files or feature-stores (*.npy)
+        :param knn_k: number of items to return per feature set
+        :param ann_backend: name of the ANN backend to set up for "ann" searches (see `utils.ann_index.ANN_BACKENDS`)
+                            - no ANN indexes are set up when None
+        :param ann_index_dir: folder to load ANN indexes from (or save them to when they have to be built)
+        :param ann_params: keyword arguments passed to the ANN backend when building an index eg: {"n_probe": 16}
+        :param lazy: only load a feature set (and set up its searches) the first time it's searched
+        :param memory_budget_mb: when set, the least recently used feature sets are evicted (and re-loaded when
+                                 searched again) to keep the loaded feature sets within this budget
+        :param warm_up: when lazy, load the feature sets on a background thread (within the memory budget)
+        :param signature_fpath: colour signature feature-store (see `utils.colour_signature`) to shortlist candidates
+                                with in "cascade" searches - "cascade" searches aren't available when None
+        :param shortlist_size: number of candidates a "cascade" search shortlists by colour signature
+        """
         self.csv_filelist = glob(data_dir)
+        self.init_containers(knn_k, ann_backend)
+        self.shortlist_size = shortlist_size
+        if signature_fpath is not None:
+            self.load_signatures(signature_fpath)
+        self.ann_index_dir = ann_index_dir
+        self.ann_params = ann_params or {}
+        self.memory_budget_bytes = None if memory_budget_mb is None else memory_budget_mb * 2**20
+        self.featureset_files = {os.path.splitext(os.path.basename(f))[0]: f for f in self.csv_filelist}
+        self.featureset_names = list(self.featureset_files.keys())
+
+        if not lazy:
+            for featureset_name in self.featureset_names:
+                self.get_state(featureset_name)
+        elif warm_up:
+            threading.Thread(target=self.warm_up, daemon=True).start()
+
+    def init_containers(self, knn_k: int, ann_backend: str = None) -> None:
         self.feature_dfs = {} # contains the bottleneck feature dataframes - one per model
         self.knn = {}
         self.knn_k = knn_k
-        self.cosineSimDFs = {} #stores pre-computed cosine-similarity matrix
-
-        for f in self.csv_filelist:
-            logging.info(f"Loading features from {f}...")
-
-            featureset_name = os.path.splitext(os.path.basename(f))[0]
-
-            self.feature_dfs[featureset_name] = pd.read_csv(f, index_col=("filename", "territory_name"))
-
-        for featureset_name, X in self.feature_dfs.items():
-            logging.info(f"Setting up KNN search using {featureset_name} features...")
-            self.knn[featureset_name] = NearestNeighbors(n_neighbors=knn_k, metric="cosine")
-            self.knn[featureset_name].fit(self.feature_dfs[featureset_name].values)
-
-        for featureset_name, X in self.feature_dfs.items():
-            logging.info(f"Pre-computing Cosine Similarity using {featureset_name} features...")
-            sim_X = cosine_similarity(self.feature_dfs[featureset_name].values)
-            sim_df = pd.DataFrame(sim_X
-                                  ,index = self.feature_dfs[featureset_name].index
-                                  ,columns=self.feature_dfs[featureset_name].index.get_level_values("territory_name"))
-
-            self.cosineSimDFs[featureset_name]=sim_df
-
+        self.normalised_features = {} # L2-normalised feature matrices used for vectorised cosine searches
+        self.cosine_topk = {} # stores pre-computed top-k (indices, scores) of each item - one per model
+        self.name_to_row = {} # maps territory_name to its row position - one per model
+        self.ann_backend = ann_backend
+        self.ann = {} # ANN indexes - one per model
+        self.codecs = {} # codecs of the feature sets loaded from compressed feature-stores
+        self.metadata_indexes = {} # indexes of the items' metadata used to filter searches - one per model
+        self.signatures = None # colour signatures used to shortlist candidates in "cascade" searches
+        self.signature_index = None
+        self.signature_name_to_row = {}
+        self.signature_to_row = {} # the feature set row of each colour signature - one per model
+        self.shortlist_size = 200
+        self.featureset_files = {}
+        self.memory_budget_bytes = None
+        self.last_used = OrderedDict() # loaded feature sets - least recently used first
+        self.load_lock = threading.RLock() # guards the containers - never held while a feature set is being loaded
+        self.featureset_locks = {} # one per feature set so that concurrent searches of it wait for a single load
+
+    def load_featureset(self, featureset_name: str) -> None:
+        """
+        Loads a feature set & sets up its searches - the work is done without holding `load_lock`, which is only
+        taken to add the results to the containers, so searches of the loaded feature sets aren't held up by it
+        """
+        f = self.featureset_files[featureset_name]
+        logging.info(f"Loading features from {f}...")
+        with timer("load.features"):
+            X = load_features(f)
+            codec = load_codec(f)
+
+        logging.info(f"Setting up KNN search using {featureset_name} features...")
+        with timer("load.knn_fit"):
+            knn = NearestNeighbors(n_neighbors=self.knn_k, metric="cosine").fit(X.values)
+
+        logging.info(f"Pre-computing top-{self.knn_k} Cosine Similarity using {featureset_name} features...")
+        with timer("load.cosine_topk"):
+            # compressed codes are normalised already & are searched as they are
+            X_norm = normalise_rows(X.values, dtype=self.get_search_dtype(X.values)) if codec is None else X.values
+            cosine_topk = self.compute_cosine_topk(X_norm)
+            name_to_row = self.get_name_to_row(X.index)
+
+        with timer("load.metadata"):
+            metadata_index = MetadataIndex(load_metadata(f, X.index))
+
+        ann = None
+        if self.ann_backend is not None:
+            with timer("load.ann"):
+                ann = self.get_ann_index(featureset_name, X_norm, X.index, self.ann_backend, self.ann_index_dir
+                                         , self.ann_params)
+
+        with self.load_lock:
+            self.feature_dfs[featureset_name] = X
+            self.knn[featureset_name] = knn
+            self.normalised_features[featureset_name] = X_norm
+            self.cosine_topk[featureset_name] = cosine_topk
+            self.name_to_row[featureset_name] = name_to_row
+            self.metadata_indexes[featureset_name] = metadata_index
+            if codec is not None:
+                self.codecs[featureset_name] = codec
+            if ann is not None:
+                self.ann[featureset_name] = ann
+            if self.signatures is not None:
+                self.signature_to_row[featureset_name] = get_signature_to_row(self.signature_index, X.index)
+
+    def evict_featureset(self, featureset_name: str) -> None:
+        logging.info(f"Evicting {featureset_name} features to stay within the memory budget...")
+        for container in (self.feature_dfs, self.knn, self.normalised_features, self.cosine_topk, self.name_to_row
+                          , self.ann, self.codecs, self.metadata_indexes, self.signature_to_row, self.last_used):
+            container.pop(featureset_name, None)
+
+    def load_signatures(self, signature_fpath: str) -> None:
+        logging.info(f"Loading colour signatures from {signature_fpath}...")
+        signatures_df = load_feature_store(signature_fpath)
+        self.set_signatures(signatures_df.values, signatures_df.index)
+
+    def set_signatures(self, signatures: np.ndarray, signature_index: pd.MultiIndex) -> None:
+        self.signatures = signatures
+        self.signature_index = signature_index
+        self.signature_name_to_row = self.get_name_to_row(signature_index)
+
+    def get_featureset_nbytes(self, featureset_name: str) -> int:
+        arrays = [self.feature_dfs[featureset_name].values, *self.cosine_topk[featureset_name]]
+        if featureset_name not in self.codecs:
+            arrays.append(self.normalised_features[featureset_name])
+        return sum(X.nbytes for X in arrays)
+
+    def estimate_featureset_nbytes(self, featureset_name: str) -> int:
+        """
+        Estimates what `get_featureset_nbytes` will be once the feature set is loaded, without loading it
+        """
+        f = self.featureset_files[featureset_name]
+        (n_rows, n_features), dtype = load_features_shape(f)
+        # the features & the top-k (int32 indices, float32 scores) table...
+        nbytes = n_rows * n_features * dtype.itemsize + n_rows * min(self.knn_k, n_rows) * 8
+        if not os.path.exists(get_codec_fpath(f)):
+            # ...plus the normalised features unless they're compressed codes
+            nbytes += n_rows * n_features * np.dtype(self.get_search_dtype(np.empty(0, dtype=dtype))).itemsize
+        return nbytes
+
+    def get_state(self, featureset_name: str) -> dict:
+        """
+        Loads the feature set if it isn't loaded yet (evicting the least recently used feature sets if that takes us
+        over the memory budget) and returns references to everything needed to search it - searches work off these
+        references so a concurrent eviction can't pull the data out from under them.
+        :param featureset_name:
+        :return: {"df", "knn", "X_norm", "topk", "name_to_row", "ann", "codec", "metadata", "signature_to_row"
+                 , "score_scale"} - multiply search scores with "score_scale" to get cosine similarities (it's 1
+                 unless the feature set is compressed)
+        """
+        with self.load_lock:
+            if featureset_name in self.feature_dfs:
+                return self.use_featureset(featureset_name)
+            featureset_lock = self.featureset_locks.setdefault(featureset_name, threading.Lock())
+
+        with featureset_lock:
+            with self.load_lock:
+                if featureset_name in self.feature_dfs:
+                    # loaded by another search while we were waiting for it
+                    return self.use_featureset(featureset_name)
+            self.load_featureset(featureset_name)
+            with self.load_lock:
+                return self.use_featureset(featureset_name)
+
+    def use_featureset(self, featureset_name: str) -> dict:
+        """
+        Marks a loaded feature set as the most recently used one, evicts the least recently used ones if we are over
+        the memory budget and returns its state (see `get_state`)
+        """
+        with self.load_lock:
+            self.last_used[featureset_name] = True
+            self.last_used.move_to_end(featureset_name)
+
+            state = {"df": self.feature_dfs[featureset_name], "knn": self.knn[featureset_name]
+                     , "X_norm": self.normalised_features[featureset_name], "topk": self.cosine_topk[featureset_name]
+                     , "name_to_row": self.name_to_row[featureset_name], "ann": self.ann.get(featureset_name)
+                     , "codec": self.codecs.get(featureset_name), "metadata": self.metadata_indexes[featureset_name]
+                     , "signature_to_row": self.signature_to_row.get(featureset_name)}
+            state["score_scale"] = 1.0 if state["codec"] is None else state["codec"].score_scale
+
+            if self.memory_budget_bytes is not None:
+                while len(self.last_used) > 1 and self.memory_budget_bytes < sum(
+                        self.get_featureset_nbytes(name) for name in self.last_used.keys()):
+                    self.evict_featureset(next(iter(self.last_used)))
+
+        return state
+
+    def get_feature_df(self, featureset_name: str) -> pd.DataFrame:
+        return self.get_state(featureset_name)["df"]
+
+    def get_featureset_index(self, featureset_name: str) -> pd.MultiIndex:
+        """
+        The (filename, territory_name) keys of a feature set - read from its file rather than loading the feature set
+        if it isn't loaded yet
+        """
+        with self.load_lock:
+            if featureset_name in self.feature_dfs:
+                return self.feature_dfs[featureset_name].index
+        return load_features_index(self.featureset_files[featureset_name])
+
+    def warm_up(self) -> None:
+        """
+        Loads feature sets in order until they are all loaded or the next one would go over the memory budget
+        """
+        for featureset_name in self.featureset_names:
+            with self.load_lock:
+                if featureset_name in self.feature_dfs:
+                    continue
+                loaded_nbytes = sum(self.get_featureset_nbytes(name) for name in self.last_used.keys())
+
+            if self.memory_budget_bytes is not None and self.memory_budget_bytes < \
+                    loaded_nbytes + self.estimate_featureset_nbytes(featureset_name):
+                logging.info(f"Stopped warming up at {featureset_name} as loading it would go over the memory budget")
+                break
+            self.get_state(featureset_name)
+
+    def publish(self, publish_dir: str) -> None:
+        """
+        Publishes the feature matrices, cosine top-k tables and ANN indexes to `publish_dir` so that other processes
+        can `attach` to them instead of loading & pre-computing everything themselves
+        :param publish_dir: put this on a RAM-backed filesystem (eg: /dev/shm) to keep it in shared memory
+        :return:
+        """
+        arrays, indexes = {}, {}
+        for featureset in self.featureset_names:
+            state = self.get_state(featureset)
+            indexes[featureset] = state["df"].index
+            arrays[f"{featureset}.features"] = state["df"].values
+            arrays[f"{featureset}.normalised"] = state["X_norm"]
+            arrays[f"{featureset}.topk_indices"], arrays[f"{featureset}.topk_scores"] = state["topk"]
+            if state["ann"] is not None:
+                for name, X in state["ann"].to_arrays().items():
+                    arrays[f"{featureset}.ann.{name}"] = X
+            if state["codec"] is not None:
+                for name, X in state["codec"].to_arrays().items():
+                    arrays[f"{featureset}.codec.{name}"] = np.asarray(X)
+
+        if self.signatures is not None:
+            arrays["signatures"], indexes["signatures"] = self.signatures, self.signature_index
+
+        publish_arrays(publish_dir, arrays, indexes
+                       , {"files": self.csv_filelist, "knn_k": self.knn_k, "ann_backend": self.ann_backend
+                          , "featuresets": self.featureset_names, "shortlist_size": self.shortlist_size})
+
+    @classmethod
+    def attach(cls, publish_dir: str) -> "SimilaritySearch":
+        """
+        Sets up a SimilaritySearch over the arrays another process has `publish`ed to `publish_dir` - the arrays
+        are memory-mapped read-only so they are shared between all the processes attached to them rather than copied
+        :param publish_dir:
+        :return:
+        """
+        arrays, indexes, metadata = attach_arrays(publish_dir)
+        self = cls.__new__(cls)
+        self.csv_filelist = metadata["files"]
+        self.init_containers(metadata["knn_k"], metadata["ann_backend"])
+        self.featureset_files = {os.path.splitext(os.path.basename(f))[0]: f for f in self.csv_filelist}
+        self.shortlist_size = metadata.get("shortlist_size", self.shortlist_size)
+        if "signatures" in arrays:
+            self.set_signatures(arrays["signatures"], indexes["signatures"])
+
+        for featureset in metadata["featuresets"]:
+            X = arrays[f"{featureset}.features"]
+            self.feature_dfs[featureset] = pd.DataFrame(X, index=indexes[featureset]
+                                                        , columns=get_feature_columns(X.shape[1]), copy=False)
+            self.normalised_features[featureset] = arrays[f"{featureset}.normalised"]
+            self.cosine_topk[featureset] = (arrays[f"{featureset}.topk_indices"], arrays[f"{featureset}.topk_scores"])
+            self.name_to_row[featureset] = self.get_name_to_row(indexes[featureset])
+            self.metadata_indexes[featureset] = MetadataIndex(load_metadata(self.featureset_files[featureset]
+                                                                            , indexes[featureset]))
+            if self.signatures is not None:
+                self.signature_to_row[featureset] = get_signature_to_row(self.signature_index, indexes[featureset])
+
+            # brute-force cosine NearestNeighbors only keeps a reference to the (memory-mapped) data when fitting
+            self.knn[featureset] = NearestNeighbors(n_neighbors=self.knn_k, metric="cosine").fit(X)
+
+            codec_prefix = f"{featureset}.codec."
+            codec_arrays = {name[len(codec_prefix):]: X for name, X in arrays.items() if name.startswith(codec_prefix)}
+            if codec_arrays:
+                self.codecs[featureset] = FeatureCodec.from_arrays(codec_arrays)
+
+            ann_prefix = f"{featureset}.ann."
+            ann_arrays = {name[len(ann_prefix):]: X for name, X in arrays.items() if name.startswith(ann_prefix)}
+            if ann_arrays:
+                self.ann[featureset] = ANN_BACKENDS[self.ann_backend].from_arrays(
+                    ann_arrays, self.normalised_features[featureset])
+
+        self.featureset_names = list(self.feature_dfs.keys())
+        self.last_used.update((featureset, True) for featureset in self.featureset_names)
+        logging.info(f"Attached to {len(self.feature_dfs):,} feature sets published to {publish_dir}")
+        return self
+
+    @staticmethod
+    def get_ann_index(featureset: str, X_norm: np.ndarray, pd_index: pd.MultiIndex, ann_backend: str
+                      , ann_index_dir: str, ann_params: dict):
+        """
+        Loads the featureset's ANN index from `ann_index_dir` if it's there (and was built over the feature set's
+        current rows), otherwise builds it (and saves it)
+        """
+        backend = ANN_BACKENDS[ann_backend]
+        fingerprint = get_index_fingerprint(pd_index)
+        index_fpath = None if ann_index_dir is None \
+            else os.path.join(ann_index_dir, f"{featureset}.{ann_backend}.npz")
+
+        if index_fpath is not None and os.path.exists(index_fpath):
+            logging.info(f"Loading {ann_backend} index from {index_fpath}...")
+            try:
+                index = backend.load(index_fpath, X_norm, fingerprint)
+            except ValueError as e:
+                logging.warning(f"Rebuilding the {ann_backend} index as it's stale: {e}")
+            else:
+                # the saved index holds the query params it was built with - the ones asked for now take precedence
+                for name in backend.query_params:
+                    if name in ann_params:
+                        setattr(index, name, ann_params[name])
+                return index
+
+        logging.info(f"Building {ann_backend} index using {featureset} features...")
+        index = backend(**ann_params).build(X_norm)
+        index.fingerprint = fingerprint
+        if index_fpath is not None:
+            os.makedirs(ann_index_dir, exist_ok=True)
+            index.save(index_fpath)
+        return index
+
+    @staticmethod
+    def get_search_dtype(X: np.ndarray):
+        return X.dtype if X.dtype == np.float64 else np.float32
+
+    def compute_cosine_topk(self, X_norm: np.ndarray):
+        """
+        Instead of the full N x N cosine similarity matrix only keep the `knn_k` most similar items of each item
+        :param X_norm: L2-normalised feature matrix
+        :return: (indices, scores) int32/float32 arrays of shape (N, knn_k)
+        """
+        return top_k_cosine(X_norm, X_norm, self.knn_k)
+
+    @staticmethod
+    def get_name_to_row(pd_index: pd.MultiIndex) -> Dict[str, int]:
+        name_to_row = {}
+        for row, territory_name in enumerate(pd_index.get_level_values("territory_name")):
+            name_to_row.setdefault(territory_name, row)
+        return name_to_row
+
+    def update_featureset(self, featureset: str, added_df: pd.DataFrame, deleted_filenames: Sequence[str] = ())\
+            -> None:
+        """
+        Incrementally updates a feature set (and the KNN, cosine top-k and ANN structures built over it) rather than
+        rebuilding it - eg: after `featuriser.py` has featurised a handful of new/modified images.
+        :param featureset:
+        :param added_df: features of new/modified images indexed by (filename, territory_name) - rows already in the
+                         feature set with the same filename are replaced
+        :param deleted_filenames: filenames of images to remove from the feature set
+        :return:
+        """
+        with self.load_lock:
+            self.get_state(featureset)
+            self._update_featureset(featureset, added_df, deleted_filenames)
+
+    def _update_featureset(self, featureset: str, added_df: pd.DataFrame, deleted_filenames: Sequence[str]) -> None:
+        df = self.feature_dfs[featureset]
+        drop_filenames = set(deleted_filenames) | set(added_df.index.get_level_values("filename"))
+        kept_rows = np.flatnonzero(~df.index.get_level_values("filename").isin(drop_filenames))
+
+        if featureset in self.codecs:
+            # compressed feature sets hold the codes of the added features rather than the features themselves
+            added_df = pd.DataFrame(self.codecs[featureset].encode(added_df.values), index=added_df.index)
+        else:
+            added_norm = normalise_rows(added_df.values, dtype=self.normalised_features[featureset].dtype)
+
+        self.feature_dfs[featureset] = pd.DataFrame(np.vstack([df.values[kept_rows]
+                                                               , added_df.values.astype(df.values.dtype)])
+                                                    , index=df.index[kept_rows].append(added_df.index)
+                                                    , columns=df.columns)
+        X_norm = self.feature_dfs[featureset].values if featureset in self.codecs \
+            else np.vstack([self.normalised_features[featureset][kept_rows], added_norm])
+        self.normalised_features[featureset] = X_norm
+        self.name_to_row[featureset] = self.get_name_to_row(self.feature_dfs[featureset].index)
+        self.metadata_indexes[featureset] = MetadataIndex(load_metadata(self.featureset_files[featureset]
+                                                                        , self.feature_dfs[featureset].index))
+        if self.signatures is not None:
+            self.signature_to_row[featureset] = get_signature_to_row(self.signature_index
+                                                                     , self.feature_dfs[featureset].index)
+
+        logging.info(f"Updating {featureset} with {added_df.shape[0]:,} new/modified items and "
+                     f"{df.shape[0] - len(kept_rows):,} removed rows...")
+        self.cosine_topk[featureset] = update_top_k_cosine(X_norm, *self.cosine_topk[featureset], kept_rows, self.knn_k)
+
+        # brute-force cosine NearestNeighbors only stores the data when fitting so this is cheap
+        self.knn[featureset].fit(self.feature_dfs[featureset].values)
+
+        if featureset in self.ann:
+            self.ann[featureset].update(X_norm, kept_rows)
+            self.ann[featureset].fingerprint = get_index_fingerprint(self.feature_dfs[featureset].index)
 
     def find_knn_items(self, queryPoint: np.ndarray, featureset: str) -> List[List]:
-        most_similar_scores, most_similar_indicies = self.knn[featureset].kneighbors(queryPoint, return_distance=True)
-        most_similar_item_names = self.feature_dfs[featureset].iloc[most_similar_indicies.squeeze()]\
+        state = self.get_state(featureset)
+        with timer("search.kneighbors"):
+            most_similar_scores, most_similar_indicies = state["knn"].kneighbors(queryPoint, return_distance=True)
+        most_similar_item_names = state["df"].iloc[most_similar_indicies.squeeze()]\
                                 .index.values.tolist()
         result = [[a,b,c] for (a,b),c in zip(most_similar_item_names, most_similar_scores.squeeze())]
         return result
 
-    def find_cosinesimilar_items(self, queryPointName: str, featureset: str) -> List[List]:
-        return (1- self.cosineSimDFs[featureset][queryPointName].sort_values(ascending=False).head(self.knn_k))\
-            .reset_index()\
-            .values\
-            .tolist()
-
-    def search(self, queryPointName: str, queryType: str="cosine")-> Dict[str, List[List]]:
+    @timed("search.cosine")
+    def find_cosinesimilar_items(self, queryPointName: str, featureset: str, filters: List[Filter] = None)\
+            -> List[List]:
+        state = self.get_state(featureset)
+        row = state["name_to_row"][queryPointName]
+        indices, scores = state["topk"]
+        mask = self.get_filter_mask(state, filters)
+        if mask is not None and not mask[indices[row]].all():
+            # some of the pre-computed top-k are filtered out - search the items passing the filters instead
+            return self.find_filtered_items(state, state["X_norm"][[row]], mask)
+
+        item_names = state["df"].index[indices[row]]
+        return [[a, b, 1 - float(c) * state["score_scale"]] for (a, b), c in zip(item_names, scores[row])]
+
+    @timed("search.filtered")
+    def find_filtered_items(self, state: dict, Q: np.ndarray, mask: np.ndarray) -> List[List]:
+        """
+        Brute-force cosine search over the items selected by `mask` - "knn" searches use the same cosine distance so
+        filtered "knn" searches are answered by this too
+        :param state: see `get_state`
+        :param Q: (1, n_search_features) query in the same space as the feature set's normalised features (or codes)
+        :param mask: see `get_filter_mask`
+        """
+        indices, scores = masked_top_k_cosine(Q, state["X_norm"], self.knn_k, mask)
+        item_names = state["df"].index[indices[0]]
+        return [[a, b, 1 - float(c) * state["score_scale"]] for (a, b), c in zip(item_names, scores[0])]
+
+    @timed("search.ann")
+    def find_ann_items(self, queryPointName: str, featureset: str, filters: List[Filter] = None) -> List[List]:
+        state = self.get_state(featureset)
+        return self.find_ann_items_by_vector(state["X_norm"][[state["name_to_row"][queryPointName]]], featureset
+                                             , filters)
+
+    def find_ann_items_by_vector(self, Q: np.ndarray, featureset: str, filters: List[Filter] = None) -> List[List]:
+        state = self.get_state(featureset)
+        indices, scores = state["ann"].search(Q, self.knn_k, mask=self.get_filter_mask(state, filters))
+        found = indices[0] >= 0
+        item_names = state["df"].index[indices[0][found]]
+        return [[a, b, 1 - float(c) * state["score_scale"]] for (a, b), c in zip(item_names, scores[0][found])]
+
+    @timed("search.cascade_rerank")
+    def find_cascade_items(self, queryPointName: str, featureset: str, q_signature: np.ndarray
+                           , shortlisted: Optional[np.ndarray], filters: List[Filter] = None) -> List[List]:
+        """
+        Re-ranks the candidates shortlisted by colour signature with the feature set's features
+        :param queryPointName:
+        :param featureset:
+        :param q_signature: (1, signature_length) colour signature of the query
+        :param shortlisted: (1, shortlist_size) signature rows of the candidates (see `utils.colour_signature`) - only
+                            used without filters, filtered searches shortlist among the items passing the filters
+        :param filters: see `search`
+        """
+        state = self.get_state(featureset)
+        return self.find_cascade_items_by_vector(state["X_norm"][[state["name_to_row"][queryPointName]]], featureset
+                                                 , q_signature, shortlisted, filters)
+
+    def find_cascade_items_by_vector(self, Q: np.ndarray, featureset: str, q_signature: np.ndarray
+                                     , shortlisted: Optional[np.ndarray], filters: List[Filter] = None) -> List[List]:
+        state = self.get_state(featureset)
+        mask = self.get_filter_mask(state, filters)
+        if mask is not None or shortlisted is None:
+            # the filters depend on the feature set, so a filtered shortlist can't be shared between feature sets
+            with timer("search.cascade_shortlist"):
+                signature_mask = None if mask is None else get_signature_mask(mask, state["signature_to_row"])
+                shortlisted = shortlist(q_signature, self.signatures, self.shortlist_size, signature_mask)
+        indices, scores = rerank(shortlisted, Q, state["X_norm"], state["signature_to_row"], self.knn_k, mask)
+        found = indices[0] >= 0
+        item_names = state["df"].index[indices[0][found]]
+        return [[a, b, 1 - float(c) * state["score_scale"]] for (a, b), c in zip(item_names, scores[0][found])]
+
+    def get_cascade_shortlist(self, q_signature: np.ndarray, filters: Optional[List[Filter]]) -> Optional[np.ndarray]:
+        """
+        :param q_signature: (1, signature_length) colour signature of the query
+        :param filters: see `search`
+        :return: the unfiltered shortlist, shared by all the feature sets as it only depends on the query's colour
+                 signature - None with filters, which are applied when shortlisting for each feature set
+        """
+        if filters:
+            return None
+        with timer("search.cascade_shortlist"):
+            return shortlist(q_signature, self.signatures, self.shortlist_size)
+
+    @staticmethod
+    def get_filter_mask(state: dict, filters: Optional[List[Filter]]) -> Optional[np.ndarray]:
+        """
+        :param state: see `get_state`
+        :param filters: (column, op, value) filters on the items' metadata - see `utils.metadata_index`
+        :return: bool mask of the items passing all the filters - None if there are no filters
+        """
+        if not filters:
+            return None
+        with timer("search.filter_mask"):
+            return state["metadata"].get_mask(filters)
+
+    def search(self, queryPointName: str, queryType: str="cosine", featuresets: Sequence[str] = None
+               , filters: List[Filter] = None) -> Dict[str, List[List]]:
+        """
+        :param queryPointName: territory name to search for
+        :param queryType: one of "knn", "cosine", "ann" or "cascade" (shortlist by colour signature, then re-rank)
+        :param featuresets: only search these feature sets (defaults to all of them) - with lazy loading, feature sets
+                            that aren't searched are never loaded
+        :param filters: only return items whose metadata passes all of these (column, op, value) filters eg:
+                        [("variant", "==", ""), ("territory_name", "!=", queryPointName)] leaves out the query and
+                        its variants - see `utils.metadata_index`
+        :return: {featureset: [[filename, territory_name, cosine distance], ...]}
+        """
         search_results={}
-        assert queryType in ["knn", "cosine"], "queryType must be one of \"knn\" or \"cosine\""
+        assert queryType in ["knn", "cosine", "ann", "cascade"]\
+            , "queryType must be one of \"knn\", \"cosine\", \"ann\" or \"cascade\""
+        featuresets = self.featureset_names if featuresets is None else featuresets
+        increment(f"search.{queryType}_queries")
         if queryType == "knn":
-            for featureset, df in self.feature_dfs.items():
-                Q = self.feature_dfs[featureset].loc(axis=0)[pd.IndexSlice[:,queryPointName]].values
+            for featureset in featuresets:
+                if filters:
+                    state = self.get_state(featureset)
+                    search_results[featureset] = self.find_filtered_items(
+                        state, state["X_norm"][[state["name_to_row"][queryPointName]]]
+                        , self.get_filter_mask(state, filters))
+                    continue
+                with timer("search.lookup"):
+                    Q = self.get_feature_df(featureset).loc(axis=0)[pd.IndexSlice[:,queryPointName]].values
                 search_results[featureset] = self.find_knn_items(Q, featureset)
+        elif queryType == "ann":
+            assert self.ann_backend is not None, "set up SimilaritySearch with an `ann_backend` to use \"ann\" searches"
+            for featureset in featuresets:
+                search_results[featureset] = self.find_ann_items(queryPointName, featureset, filters)
+        elif queryType == "cascade":
+            assert self.signatures is not None\
+                , "set up SimilaritySearch with a `signature_fpath` to use \"cascade\" searches"
+            q_signature = self.signatures[[self.signature_name_to_row[queryPointName]]]
+            shortlisted = self.get_cascade_shortlist(q_signature, filters)
+            for featureset in featuresets:
+                search_results[featureset] = self.find_cascade_items(queryPointName, featureset, q_signature
+                                                                     , shortlisted, filters)
         else:
-            for featureset, df in self.cosineSimDFs.items():
-                search_results[featureset] = self.find_cosinesimilar_items(queryPointName, featureset)
+            for featureset in featuresets:
+                search_results[featureset] = self.find_cosinesimilar_items(queryPointName, featureset, filters)
 
         return search_results
 
+    @staticmethod
+    def prepare_query_vectors(state: dict, vectors: np.ndarray) -> np.ndarray:
+        """
+        Puts raw query vectors in the same space as the feature set's normalised features (or codes)
+        :param state: see `get_state`
+        :param vectors: (n_features, ) or (n_queries, n_features) raw feature vectors
+        :return: (n_queries, n_search_features) array
+        """
+        if state["codec"] is not None:
+            return state["codec"].to_code_space(np.atleast_2d(vectors))
+        return normalise_rows(np.atleast_2d(vectors), dtype=state["X_norm"].dtype)
+
+    def search_by_vector(self, query_vectors: Dict[str, np.ndarray], queryType: str="cosine"
+                         , filters: List[Filter] = None, query_signature: np.ndarray = None) -> Dict[str, List[List]]:
+        """
+        Searches for the items most similar to raw feature vectors rather than to an item of the feature sets
+        eg: the features of an uploaded image
+        :param query_vectors: {featureset: (n_features, ) raw feature vector} - only these feature sets are searched
+        :param queryType: one of "knn", "cosine", "ann" or "cascade"
+        :param filters: see `search`
+        :param query_signature: colour signature of the query (see `utils.colour_signature`) - needed by "cascade"
+                                searches only
+        :return: {featureset: [[filename, territory_name, cosine distance], ...]}
+        """
+        assert queryType in ["knn", "cosine", "ann", "cascade"]\
+            , "queryType must be one of \"knn\", \"cosine\", \"ann\" or \"cascade\""
+        increment(f"search.{queryType}_vector_queries")
+        if queryType == "cosine":
+            return self.search_batch(query_vectors, filters=filters)[0]
+
+        search_results = {}
+        if queryType == "cascade":
+            assert self.signatures is not None\
+                , "set up SimilaritySearch with a `signature_fpath` to use \"cascade\" searches"
+            assert query_signature is not None, "\"cascade\" searches by vector need the query's colour signature"
+            q_signature = np.atleast_2d(query_signature).astype(self.signatures.dtype)
+            shortlisted = self.get_cascade_shortlist(q_signature, filters)
+            for featureset, vector in query_vectors.items():
+                Q = self.prepare_query_vectors(self.get_state(featureset), vector)
+                with timer("search.cascade_rerank"):
+                    search_results[featureset] = self.find_cascade_items_by_vector(Q, featureset, q_signature
+                                                                                   , shortlisted, filters)
+            return search_results
+
+        assert queryType == "knn" or self.ann_backend is not None\
+            , "set up SimilaritySearch with an `ann_backend` to use \"ann\" searches"
+        for featureset, vector in query_vectors.items():
+            state = self.get_state(featureset)
+            Q = self.prepare_query_vectors(state, vector)
+            if queryType == "knn" and filters:
+                search_results[featureset] = self.find_filtered_items(state, Q, self.get_filter_mask(state, filters))
+            elif queryType == "knn":
+                search_results[featureset] = self.find_knn_items(Q, featureset)
+            else:
+                search_results[featureset] = self.find_ann_items_by_vector(Q, featureset, filters)
+        return search_results
+
+    @timed("search.batch")
+    def search_batch(self, queries: Union[Sequence[str], Dict[str, np.ndarray]], k: int = None
+                     , filters: List[Filter] = None) -> List[Dict[str, List[List]]]:
+        """
+        Answers many queries against every feature set in one vectorised pass - one matrix multiply per feature set
+        followed by a vectorised top-k selection.
+
+        :param queries: either a list of territory names, or a dict mapping feature set name to a
+                        (n_queries, n_features) array of raw query vectors - in which case only those feature sets
+                        are searched
+        :param k: number of items to return per query, defaults to `knn_k`
+        :param filters: see `search`
+        :return: one search result per query - in the same shape as `search` i.e., {featureset: [[filename,
+                 territory_name, cosine distance], ...]}
+        """
+        k = self.knn_k if k is None else k
+        if isinstance(queries, dict):
+            featuresets = list(queries.keys())
+            n_queries = len(np.atleast_2d(queries[featuresets[0]])) if featuresets else 0
+        else:
+            featuresets = self.featureset_names
+            n_queries = len(queries)
+
+        search_results = [{} for _ in range(n_queries)]
+        for featureset in featuresets:
+            state = self.get_state(featureset)
+            X_norm = state["X_norm"]
+            if isinstance(queries, dict):
+                Q = self.prepare_query_vectors(state, queries[featureset])
+            else:
+                Q = X_norm[[state["name_to_row"][name] for name in queries]]
+
+            mask = self.get_filter_mask(state, filters)
+            if mask is None:
+                indices, scores = top_k_cosine(Q, X_norm, k)
+            else:
+                indices, scores = masked_top_k_cosine(Q, X_norm, k, mask)
+
+            pd_index = state["df"].index
+            filenames = pd_index.get_level_values("filename").values[indices].tolist()
+            territory_names = pd_index.get_level_values("territory_name").values[indices].tolist()
+            distances = (1 - scores.astype(np.float64) * state["score_scale"]).tolist()
+
+            for q, result in enumerate(search_results):
+                result[featureset] = [[a, b, c] for a, b, c in zip(filenames[q], territory_names[q], distances[q])]
+
+        return search_results
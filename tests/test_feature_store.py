@@ -0,0 +1,29 @@
+import os
+import numpy as np
+import pandas as pd
+from utils.feature_store import FeatureStoreWriter, load_feature_store, save_feature_store, merge_feature_store\
+    , is_store_complete, INDEX_COLUMNS
+
+
+def make_store(store_fpath: str, n_rows: int, n_features: int = 4) -> pd.DataFrame:
+    index = pd.MultiIndex.from_tuples([(f"Flag_of_T{i}.jpg", f"T{i}") for i in range(n_rows)], names=INDEX_COLUMNS)
+    features_df = pd.DataFrame(np.random.default_rng(0).random((n_rows, n_features), dtype=np.float32), index=index)
+    save_feature_store(features_df, store_fpath)
+    return features_df
+
+
+def test_finalise_empty_store(tmp_path):
+    store_fpath = os.path.join(tmp_path, "Empty.npy")
+    FeatureStoreWriter(store_fpath, 0, 8).finalise()
+
+    assert is_store_complete(store_fpath)
+    assert load_feature_store(store_fpath).shape[0] == 0
+
+
+def test_merge_deleting_every_row(tmp_path):
+    store_fpath = os.path.join(tmp_path, "Model.npy")
+    features_df = make_store(store_fpath, 3)
+    merge_feature_store(store_fpath, None, features_df.index.get_level_values("filename"))
+
+    assert is_store_complete(store_fpath)
+    assert load_feature_store(store_fpath).shape[0] == 0
@@ -0,0 +1,203 @@
+"""
+Offline all-pairs similarity job - finds every pair of near-duplicate items of a feature-store without searching
+for each item separately or materialising the N x N similarity matrix.
+
+The normalised feature matrix is split into blocks of rows and each block is compared with the whole matrix one
+tile at a time, keeping only the pairs scoring at least `threshold` (only the pairs above the diagonal, as the
+scores are symmetric) or the top-k neighbours of each row. Every block is an independent task run on a pool of
+processes that memory-map the matrix, so memory is bounded by the tile size (plus the pairs that are kept), and its
+pairs are saved as soon as it finishes so an interrupted job resumes from the blocks still to do.
+
+The pairs are then assembled into a sparse similarity graph, whose connected components at one or more thresholds
+give the clusters of near-duplicates.
+"""
+import os
+import json
+import logging
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional, Tuple
+import numpy as np
+from numpy.lib.format import open_memmap
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from utils.feature_store import get_store_paths
+from utils.similarity import TILE_SIZE, normalise_rows, as_float, top_k_cosine
+
+NORMALISED_FNAME = "features.norm.npy"
+JOB_FNAME = "job.json"
+BLOCKS_DIRNAME = "blocks"
+GRAPH_FNAME = "graph.npz"
+PARTIAL_EXT = ".part"
+
+
+def normalise_matrix(X: np.ndarray, output_fpath: str, chunk_size: int = 65536) -> str:
+    """
+    Writes the L2-normalised rows of X to a float32 .npy file a chunk at a time
+    """
+    X_norm = open_memmap(output_fpath + PARTIAL_EXT, mode="w+", dtype=np.float32, shape=X.shape)
+    for start in range(0, X.shape[0], chunk_size):
+        X_norm[start:start + chunk_size] = normalise_rows(as_float(X[start:start + chunk_size]))
+    X_norm.flush()
+    del X_norm
+    os.replace(output_fpath + PARTIAL_EXT, output_fpath)
+    return output_fpath
+
+
+def find_block_pairs(X_norm: np.ndarray, r0: int, r1: int, threshold: Optional[float] = None, k: Optional[int] = None
+                     , tile_size: int = TILE_SIZE) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Finds the pairs of rows `r0` to `r1` of X_norm - either the top-k neighbours of each row (scoring at least
+    `threshold`, if given) or every pair above the diagonal scoring at least `threshold`
+    :param X_norm: (n_items, n_features) normalised item vectors
+    :param r0:
+    :param r1:
+    :param threshold: min cosine similarity of a pair
+    :param k: number of neighbours kept per row - None keeps all the pairs above `threshold`
+    :param tile_size: max number of similarity scores held in memory at any one time
+    :return: (rows, cols, scores) of the pairs
+    """
+    row_ids = np.arange(r0, r1, dtype=np.int32)
+
+    if k is not None:
+        # the top k+1 always include the k best neighbours other than the row itself
+        indices, scores = top_k_cosine(X_norm[r0:r1], X_norm, k + 1, tile_size)
+        keep = indices != row_ids[:, None]
+        keep &= np.cumsum(keep, axis=1) <= k
+        if threshold is not None:
+            keep &= scores >= threshold
+        rows = np.broadcast_to(row_ids[:, None], indices.shape)
+        return rows[keep], indices[keep], scores[keep]
+
+    X_rows = X_norm[r0:r1]
+    col_block = max(1, tile_size // (r1 - r0))
+    rows, cols, pair_scores = [], [], []
+    for c0 in range(r0, X_norm.shape[0], col_block):
+        scores = X_rows @ X_norm[c0:c0 + col_block].T
+        keep = scores >= threshold
+        if c0 < r1:
+            # the tile overlaps the diagonal - only keep each pair once
+            keep &= np.arange(c0, c0 + scores.shape[1])[None, :] > row_ids[:, None]
+        tile_rows, tile_cols = np.nonzero(keep)
+        rows.append(row_ids[tile_rows])
+        cols.append((tile_cols + c0).astype(np.int32))
+        pair_scores.append(scores[tile_rows, tile_cols].astype(np.float32))
+
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(pair_scores)
+
+
+def get_block_fpath(blocks_dir: str, r0: int) -> str:
+    return os.path.join(blocks_dir, f"block_{r0:010d}.npz")
+
+
+def run_block(X_norm_fpath: str, blocks_dir: str, r0: int, r1: int, threshold: Optional[float], k: Optional[int]
+              , tile_size: int) -> int:
+    """
+    Finds the pairs of rows `r0` to `r1` (see `find_block_pairs`) and saves them to the block's file
+    :return: number of pairs found
+    """
+    X_norm = np.load(X_norm_fpath, mmap_mode="r")
+    rows, cols, scores = find_block_pairs(X_norm, r0, r1, threshold, k, tile_size)
+
+    block_fpath = get_block_fpath(blocks_dir, r0)
+    with open(block_fpath + PARTIAL_EXT, "wb") as f:
+        np.savez(f, rows=rows, cols=cols, scores=scores)
+    os.replace(block_fpath + PARTIAL_EXT, block_fpath)
+    return len(rows)
+
+
+def find_all_pairs(store_fpath: str, work_dir: str, threshold: Optional[float] = None, k: Optional[int] = None
+                   , block_rows: int = 4096, tile_size: int = TILE_SIZE, n_workers: int = None) -> str:
+    """
+    Finds the similar pairs of items of a feature-store and saves them as a sparse similarity graph. Re-running the
+    job with the same settings resumes it from the blocks still to do - the finished blocks are thrown away if the
+    settings or the feature-store have changed.
+    :param store_fpath: path to the .npy file of the feature-store
+    :param work_dir: the normalised features, the pairs of each block and the graph are saved here
+    :param threshold: min cosine similarity of a pair
+    :param k: number of neighbours kept per item - None keeps all the pairs above `threshold`
+    :param block_rows: number of rows per task
+    :param tile_size: max number of similarity scores held in memory by each worker at any one time
+    :param n_workers: number of processes - None uses all the CPUs
+    :return: path to the graph (see `load_similarity_graph`)
+    """
+    assert threshold is not None or k is not None, "either threshold or k must be given"
+    X = np.load(get_store_paths(store_fpath)[0], mmap_mode="r")
+    job = {"store_fpath": os.path.abspath(store_fpath), "store_mtime": os.path.getmtime(get_store_paths(store_fpath)[0])
+           , "shape": list(X.shape), "threshold": threshold, "k": k, "block_rows": block_rows}
+
+    blocks_dir = os.path.join(work_dir, BLOCKS_DIRNAME)
+    job_fpath = os.path.join(work_dir, JOB_FNAME)
+    graph_fpath = os.path.join(work_dir, GRAPH_FNAME)
+    X_norm_fpath = os.path.join(work_dir, NORMALISED_FNAME)
+    os.makedirs(blocks_dir, exist_ok=True)
+
+    previous_job = None
+    if os.path.exists(job_fpath):
+        with open(job_fpath) as f:
+            previous_job = json.load(f)
+    if previous_job != job:
+        if previous_job is not None:
+            logging.info(f"Settings of the job in {work_dir} have changed - starting it again")
+        for fpath in glob(os.path.join(blocks_dir, "*")) + [graph_fpath, X_norm_fpath]:
+            if os.path.exists(fpath):
+                os.remove(fpath)
+        with open(job_fpath, "w") as f:
+            json.dump(job, f, indent=2)
+
+    if os.path.exists(graph_fpath):
+        return graph_fpath
+    if not os.path.exists(X_norm_fpath):
+        normalise_matrix(X, X_norm_fpath)
+
+    n_items = X.shape[0]
+    block_starts = [r0 for r0 in range(0, n_items, block_rows)
+                    if not os.path.exists(get_block_fpath(blocks_dir, r0))]
+    logging.info(f"{len(block_starts)} of {-(-n_items // block_rows)} blocks of {block_rows} rows to do...")
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        jobs = {executor.submit(run_block, X_norm_fpath, blocks_dir, r0, min(r0 + block_rows, n_items), threshold, k
+                                , tile_size): r0 for r0 in block_starts}
+        for n_done, job_future in enumerate(as_completed(jobs), 1):
+            logging.info(f"Block at row {jobs[job_future]:,} done ({job_future.result():,} pairs) - "
+                         f"{n_done}/{len(jobs)}")
+
+    return save_similarity_graph(blocks_dir, n_items, graph_fpath)
+
+
+def save_similarity_graph(blocks_dir: str, n_items: int, graph_fpath: str) -> str:
+    """
+    Assembles the pairs of every block into an (n_items, n_items) sparse matrix of the pair scores
+    """
+    rows, cols, scores = [], [], []
+    for block_fpath in sorted(glob(os.path.join(blocks_dir, "block_*.npz"))):
+        with np.load(block_fpath) as block:
+            rows.append(block["rows"])
+            cols.append(block["cols"])
+            scores.append(block["scores"])
+
+    graph = sparse.csr_matrix((np.concatenate(scores), (np.concatenate(rows), np.concatenate(cols)))
+                              , shape=(n_items, n_items), dtype=np.float32)
+    with open(graph_fpath + PARTIAL_EXT, "wb") as f:
+        sparse.save_npz(f, graph)
+    os.replace(graph_fpath + PARTIAL_EXT, graph_fpath)
+    return graph_fpath
+
+
+def load_similarity_graph(graph_fpath: str) -> sparse.csr_matrix:
+    """
+    :return: (n_items, n_items) sparse matrix - entry (i, j) holds the cosine similarity of items i & j if they were
+             kept as a pair. Each pair is stored once (i < j) when the pairs were found with a threshold alone.
+    """
+    return sparse.load_npz(graph_fpath).tocsr()
+
+
+def get_clusters(graph: sparse.csr_matrix, threshold: Optional[float] = None) -> np.ndarray:
+    """
+    Clusters the items into the connected components of the similarity graph
+    :param graph: see `load_similarity_graph`
+    :param threshold: only the pairs scoring at least this much connect items - None uses every pair of the graph
+    :return: cluster label of each item - items with no pair are clusters of their own
+    """
+    if threshold is not None:
+        graph = graph.multiply(graph >= threshold).tocsr()
+    return connected_components(graph, directed=False)[1]
@@ -0,0 +1,229 @@
+"""
+Approximate nearest-neighbour (ANN) indexes for cosine similarity searches, written in plain NumPy.
+
+`IVFIndex` is an inverted-file index: the (L2-normalised) items are clustered with spherical k-means into `n_lists`
+coarse clusters and a query only scores the items in its `n_probe` closest clusters instead of every item.
+    - `n_lists` trades build time and recall for query latency (more lists => fewer items per list)
+    - `n_probe` is the recall vs latency knob at query time (n_probe == n_lists is an exact search)
+
+Indexes only store the cluster structure - the normalised feature matrix they were built from has to be passed in
+again when an index is loaded from disk. An index can carry the fingerprint of the feature set's rows (see
+`utils.feature_store.get_index_fingerprint`) so that loading it for a feature set whose rows have since changed fails
+rather than returning the wrong items. That matrix can also be a compressed (float16/int8) one - see
+`utils/compression.py` - in which case search scores are in code units.
+"""
+import os
+import time
+import logging
+from typing import Tuple, List, Dict
+import numpy as np
+import pandas as pd
+from utils.similarity import top_k_cosine, sort_top_k, score_rows, as_float
+from utils.feature_store import get_store_paths, FEATURES_EXT
+
+ANN_INDEX_DIRNAME = "ann" # indexes are saved to <folder of the feature-stores>/ann/<featureset>.<backend>.npz
+
+
+class IVFIndex:
+    name = "ivf"
+    query_params = ("n_probe", ) # params that only affect searching - they can be changed on a loaded index
+
+    def __init__(self, n_lists: int = None, n_probe: int = 8, n_iter: int = 20, train_size_per_list: int = 256
+                 , seed: int = 0):
+        """
+        :param n_lists: number of coarse clusters - defaults to sqrt(n_items)
+        :param n_probe: number of clusters scanned per query
+        :param n_iter: number of k-means iterations used to train the clusters
+        :param train_size_per_list: k-means is trained on a sample of n_lists * train_size_per_list items
+        :param seed:
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.train_size_per_list = train_size_per_list
+        self.seed = seed
+        self.X = None
+        self.centroids = None
+        self.list_items = None # item indices sorted by the cluster they belong to
+        self.list_offsets = None # items of cluster c are list_items[list_offsets[c]:list_offsets[c+1]]
+        self.fingerprint = "" # fingerprint of the rows of the feature set the index was built over
+
+    def train_centroids(self, X: np.ndarray) -> np.ndarray:
+        rng = np.random.default_rng(self.seed)
+        n_train = min(X.shape[0], self.n_lists * self.train_size_per_list)
+        X_train = as_float(X[np.sort(rng.choice(X.shape[0], n_train, replace=False))])
+        centroids = X_train[rng.choice(n_train, self.n_lists, replace=False)].copy()
+
+        for _ in range(self.n_iter):
+            assignments = top_k_cosine(X_train, centroids, 1)[0][:, 0]
+            counts = np.bincount(assignments, minlength=self.n_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, X_train)
+
+            # re-seed empty clusters with random training items
+            empty = counts == 0
+            sums[empty] = X_train[rng.choice(n_train, int(empty.sum()), replace=False)]
+
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            centroids = (sums / norms).astype(X_train.dtype)
+
+        return centroids
+
+    def build(self, X: np.ndarray) -> "IVFIndex":
+        """
+        :param X: (n_items, n_features) L2-normalised feature matrix
+        :return: self
+        """
+        self.X = X
+        if self.n_lists is None:
+            self.n_lists = max(1, int(np.sqrt(X.shape[0])))
+        self.n_lists = min(self.n_lists, X.shape[0])
+
+        self.centroids = self.train_centroids(X)
+        self.set_assignments(top_k_cosine(X, self.centroids, 1)[0][:, 0])
+        return self
+
+    def search(self, Q: np.ndarray, k: int, n_probe: int = None, mask: np.ndarray = None)\
+            -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param Q: (n_queries, n_features) L2-normalised query vectors
+        :param k:
+        :param n_probe: overrides the index's n_probe for this search
+        :param mask: bool mask of the items that can be returned - the others are dropped from the candidates before
+                     they are scored
+        :return: (indices, scores) of shape (n_queries, k) sorted by decreasing similarity - padded with -1/-inf
+                 when the probed clusters hold fewer than k items
+        """
+        n_probe = min(self.n_probe if n_probe is None else n_probe, self.n_lists)
+        probes = top_k_cosine(Q, self.centroids, n_probe)[0]
+
+        top_indices = np.full((Q.shape[0], k), -1, dtype=np.int32)
+        top_scores = np.full((Q.shape[0], k), -np.inf, dtype=np.float32)
+        for q, lists in enumerate(probes):
+            candidates = np.concatenate([self.list_items[self.list_offsets[c]:self.list_offsets[c + 1]]
+                                         for c in lists])
+            if mask is not None:
+                candidates = candidates[mask[candidates]]
+            scores = score_rows(self.X, candidates, Q[q])
+            indices, scores = sort_top_k(scores[None, :], candidates[None, :], k)
+            top_indices[q, :indices.shape[1]] = indices[0]
+            top_scores[q, :scores.shape[1]] = scores[0]
+
+        return top_indices, top_scores
+
+    def get_assignments(self) -> np.ndarray:
+        """
+        :return: the cluster each item belongs to
+        """
+        assignments = np.empty(self.list_items.shape[0], dtype=np.int32)
+        assignments[self.list_items] = np.repeat(np.arange(self.n_lists, dtype=np.int32), np.diff(self.list_offsets))
+        return assignments
+
+    def set_assignments(self, assignments: np.ndarray) -> None:
+        self.list_items = np.argsort(assignments, kind="stable").astype(np.int32)
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=self.n_lists))])
+
+    def update(self, X: np.ndarray, kept_rows: np.ndarray) -> "IVFIndex":
+        """
+        Updates the index in place of a rebuild after items have been removed and/or appended - the existing clusters
+        are kept, removed items are dropped from their lists and appended items are added to their closest cluster.
+        :param X: the new L2-normalised feature matrix - the kept items (in their original order) followed by the
+                  appended ones
+        :param kept_rows: row positions (in the old feature matrix) of the items that were kept
+        :return: self
+        """
+        n_added = X.shape[0] - len(kept_rows)
+        added_assignments = top_k_cosine(X[X.shape[0] - n_added:], self.centroids, 1)[0][:, 0]
+        self.set_assignments(np.concatenate([self.get_assignments()[kept_rows], added_assignments]))
+        self.X = X
+        return self
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        :return: the arrays that make up the index (everything but the feature matrix)
+        """
+        return {"centroids": self.centroids, "list_items": self.list_items, "list_offsets": self.list_offsets
+                , "params": np.array([self.n_lists, self.n_probe, self.n_iter, self.train_size_per_list, self.seed])
+                , "fingerprint": np.array([self.fingerprint])}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], X: np.ndarray) -> "IVFIndex":
+        """
+        Re-creates an index from the arrays returned by `to_arrays` - the arrays are used as they are (not copied)
+        so they can be memory-mapped
+        :param arrays:
+        :param X: the L2-normalised feature matrix the index was built from
+        :return:
+        """
+        n_lists, n_probe, n_iter, train_size_per_list, seed = np.asarray(arrays["params"]).tolist()
+        index = cls(n_lists, n_probe, n_iter, train_size_per_list, seed)
+        index.centroids = arrays["centroids"]
+        index.list_items = arrays["list_items"]
+        index.list_offsets = arrays["list_offsets"]
+        index.fingerprint = str(arrays["fingerprint"][0]) if "fingerprint" in arrays else ""
+
+        if index.list_items.shape[0] != X.shape[0]:
+            raise ValueError(f"index was built over {index.list_items.shape[0]:,} items but X has {X.shape[0]:,}")
+        index.X = X
+        return index
+
+    def save(self, fpath: str) -> None:
+        np.savez(fpath, **self.to_arrays())
+
+    @classmethod
+    def load(cls, fpath: str, X: np.ndarray, fingerprint: str = None) -> "IVFIndex":
+        """
+        :param fpath: path to an index written by `save`
+        :param X: the L2-normalised feature matrix the index was built from
+        :param fingerprint: when given, the fingerprint of the feature set's rows the index must have been built over
+        :return:
+        """
+        with np.load(fpath, allow_pickle=False) as data:
+            index = cls.from_arrays({name: data[name] for name in data.files}, X)
+        if fingerprint is not None and index.fingerprint != fingerprint:
+            raise ValueError(f"{fpath} was built over a different version of the feature set")
+        return index
+
+
+# registry of the available ANN backends - SimilaritySearch looks backends up by name
+ANN_BACKENDS = {IVFIndex.name: IVFIndex}
+
+
+def delete_ann_indexes(store_fpath: str) -> None:
+    """
+    Deletes the saved ANN indexes of a feature-store (of every backend) eg: after its rows have changed
+    """
+    matrix_fpath = get_store_paths(store_fpath)[0]
+    featureset_name = os.path.basename(matrix_fpath)[:-len(FEATURES_EXT)]
+    for backend in ANN_BACKENDS.keys():
+        index_fpath = os.path.join(os.path.dirname(matrix_fpath), ANN_INDEX_DIRNAME, f"{featureset_name}.{backend}.npz")
+        if os.path.exists(index_fpath):
+            logging.info(f"Deleting the stale ANN index {index_fpath}")
+            os.remove(index_fpath)
+
+
+def recall_report(index: IVFIndex, Q: np.ndarray, k: int, n_probe_list: List[int]) -> pd.DataFrame:
+    """
+    Compares the ANN index against a brute-force search for a range of `n_probe` values
+    :param index: a built index
+    :param Q: L2-normalised query vectors
+    :param k:
+    :param n_probe_list:
+    :return: dataframe with recall@k and per-query latency (ms) for the brute-force search and each n_probe
+    """
+    start = time.perf_counter()
+    exact_indices = top_k_cosine(Q, index.X, k)[0]
+    brute_force_ms = 1000 * (time.perf_counter() - start) / Q.shape[0]
+
+    rows = [{"n_probe": "brute-force", f"recall@{k}": 1.0, "latency_ms": brute_force_ms}]
+    for n_probe in n_probe_list:
+        start = time.perf_counter()
+        ann_indices = index.search(Q, k, n_probe=n_probe)[0]
+        latency_ms = 1000 * (time.perf_counter() - start) / Q.shape[0]
+
+        hits = sum(len(np.intersect1d(a, e)) for a, e in zip(ann_indices, exact_indices))
+        rows.append({"n_probe": n_probe, f"recall@{k}": hits / exact_indices.size, "latency_ms": latency_ms})
+        logging.info(f"n_probe={n_probe}: recall@{k}={rows[-1][f'recall@{k}']:.4f} latency={latency_ms:.3f}ms")
+
+    return pd.DataFrame(rows)
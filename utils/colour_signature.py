@@ -0,0 +1,187 @@
+"""
+Colour signatures - a compact description of a flag's colours computed with NumPy & PIL alone (no TensorFlow), used
+as the cheap first stage of a cascade search.
+
+A signature is a joint RGB histogram (`BINS_PER_CHANNEL` bins per channel) of the whole flag followed by one for each
+cell of a `GRID` laid over the flag, so that eg: vertical & horizontal tricolours of the same colours differ. The
+square roots of the normalised histograms are concatenated and L2-normalised, so the dot-product of two signatures
+is their (Hellinger) similarity and signatures are searched like any other normalised features.
+
+The signatures are saved as a feature-store (see `utils/feature_store.py`) in a `signatures` folder next to the
+feature files.
+
+A cascade search shortlists the `shortlist_size` items with the most similar signatures and re-ranks only those with
+a backbone's features - `cascade_report` measures its recall and latency against the full search over the backbone's
+features.
+"""
+import os
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple, Union, BinaryIO
+import numpy as np
+import pandas as pd
+from PIL import Image
+from utils.feature_store import get_stylised_name_from_fpath, INDEX_COLUMNS
+from utils.similarity import sort_top_k, score_rows, top_k_cosine, masked_top_k_cosine
+
+BINS_PER_CHANNEL = 4
+GRID = (2, 2) # (columns, rows)
+DECODE_SIZE = (64, 64) # (width, height) the flags are decoded at - plenty for a few flat colours
+SIGNATURE_DIRNAME = "signatures"
+SIGNATURE_NAME = "ColourSignature"
+
+
+def get_signature_fpath(data_dir: str) -> str:
+    """
+    :param data_dir: folder holding the feature files
+    :return: path to the .npy file of the colour signature feature-store
+    """
+    return os.path.join(data_dir, SIGNATURE_DIRNAME, f"{SIGNATURE_NAME}.npy")
+
+
+def colour_signature(img: np.ndarray, bins: int = BINS_PER_CHANNEL, grid: Tuple[int, int] = GRID) -> np.ndarray:
+    """
+    :param img: uint8 array of shape (height, width, 3)
+    :param bins: number of bins per channel
+    :param grid: (columns, rows) of the cells that get a histogram of their own
+    :return: float32 signature of length bins**3 * (1 + columns * rows)
+    """
+    quantised = img.astype(np.int32) * bins // 256
+    codes = (quantised[..., 0] * bins + quantised[..., 1]) * bins + quantised[..., 2]
+
+    height, width = codes.shape
+    cells = [codes]
+    for r in range(grid[1]):
+        for c in range(grid[0]):
+            cells.append(codes[r * height // grid[1]:(r + 1) * height // grid[1]
+                               , c * width // grid[0]:(c + 1) * width // grid[0]])
+
+    histograms = [np.sqrt(np.bincount(cell.ravel(), minlength=bins**3) / max(cell.size, 1)) for cell in cells]
+    signature = np.concatenate(histograms).astype(np.float32)
+    return signature / np.linalg.norm(signature)
+
+
+def load_colour_signature(img_fpath: Union[str, BinaryIO], decode_size: Tuple[int, int] = DECODE_SIZE
+                          , bins: int = BINS_PER_CHANNEL, grid: Tuple[int, int] = GRID) -> np.ndarray:
+    """
+    :param img_fpath: path to the image - or a file object eg: a BytesIO of an uploaded image
+    :param decode_size: (width, height) the image is decoded at
+    :param bins: see `colour_signature`
+    :param grid: see `colour_signature`
+    """
+    with Image.open(img_fpath) as img:
+        img.draft("RGB", decode_size)
+        return colour_signature(np.asarray(img.convert("RGB").resize(decode_size)), bins, grid)
+
+
+def compute_colour_signatures(img_fpaths: List[str], n_workers: int = None) -> pd.DataFrame:
+    """
+    :param img_fpaths:
+    :param n_workers: number of processes decoding the images - None uses all the CPUs
+    :return: dataframe of signatures indexed by (filename, territory_name) - the same keys as the feature-stores
+    """
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        signatures = list(executor.map(load_colour_signature, img_fpaths, chunksize=32))
+    index = pd.MultiIndex.from_tuples([get_stylised_name_from_fpath(p) for p in img_fpaths], names=INDEX_COLUMNS)
+    return pd.DataFrame(np.vstack(signatures), index=index)
+
+
+def get_signature_to_row(signature_index: pd.MultiIndex, pd_index: pd.MultiIndex) -> np.ndarray:
+    """
+    :param signature_index: (filename, territory_name) index of the signatures
+    :param pd_index: (filename, territory_name) index of a feature set
+    :return: the feature set row of each signature (matched by filename) - -1 for images missing from the feature set
+    """
+    filenames = pd.Index(pd_index.get_level_values("filename"))
+    return filenames.get_indexer(signature_index.get_level_values("filename")).astype(np.int32)
+
+
+def get_signature_mask(mask: np.ndarray, signature_to_row: np.ndarray) -> np.ndarray:
+    """
+    :param mask: bool mask of a feature set's rows eg: the items passing a search's filters
+    :param signature_to_row: see `get_signature_to_row`
+    :return: `mask` mapped onto the signature rows - False for images missing from the feature set
+    """
+    return (signature_to_row >= 0) & mask[signature_to_row]
+
+
+def shortlist(q_signatures: np.ndarray, signatures: np.ndarray, shortlist_size: int, mask: np.ndarray = None)\
+        -> np.ndarray:
+    """
+    :param q_signatures: (n_queries, signature_length) signatures of the queries
+    :param signatures: (n_signatures, signature_length) signatures of the items
+    :param shortlist_size:
+    :param mask: bool mask of the signature rows that can be shortlisted (see `get_signature_mask`) - filtering before
+                 shortlisting, rather than when re-ranking, keeps the shortlist full
+    :return: (n_queries, shortlist_size) signature rows of the items with the most similar signatures - fewer when
+             fewer rows pass the mask
+    """
+    if mask is None:
+        return top_k_cosine(q_signatures, signatures, shortlist_size)[0]
+    return masked_top_k_cosine(q_signatures, signatures, shortlist_size, mask)[0]
+
+
+def rerank(shortlisted: np.ndarray, Q: np.ndarray, X_norm: np.ndarray, signature_to_row: np.ndarray, k: int
+           , mask: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Re-ranks the shortlisted items with a feature set's features
+    :param shortlisted: see `shortlist`
+    :param Q: (n_queries, n_features) queries in the same space as X_norm
+    :param X_norm: the feature set's normalised features (or codes)
+    :param signature_to_row: see `get_signature_to_row`
+    :param k:
+    :param mask: bool mask of the feature set's rows that can be returned
+    :return: (indices, scores) of shape (n_queries, k) sorted by decreasing similarity - padded with -1/-inf when
+             fewer than k shortlisted items are in the feature set
+    """
+    top_indices = np.full((Q.shape[0], k), -1, dtype=np.int32)
+    top_scores = np.full((Q.shape[0], k), -np.inf, dtype=np.float32)
+    for q, signature_rows in enumerate(shortlisted):
+        candidates = signature_to_row[signature_rows]
+        candidates = candidates[candidates >= 0]
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+        scores = score_rows(X_norm, candidates, Q[q])
+        indices, scores = sort_top_k(scores[None, :], candidates[None, :], k)
+        top_indices[q, :indices.shape[1]] = indices[0]
+        top_scores[q, :scores.shape[1]] = scores[0]
+    return top_indices, top_scores
+
+
+def cascade_report(signatures: np.ndarray, X_norm: np.ndarray, signature_to_row: np.ndarray, k: int
+                   , shortlist_sizes: List[int], n_queries: int = 1000, seed: int = 0) -> pd.DataFrame:
+    """
+    Compares the cascade search against the full search over a feature set's features, for a random sample of items
+    :param signatures: (n_signatures, signature_length) signatures of the items
+    :param X_norm: the feature set's normalised features (or codes)
+    :param signature_to_row: see `get_signature_to_row`
+    :param k:
+    :param shortlist_sizes:
+    :param n_queries:
+    :param seed:
+    :return: dataframe with recall@k and per-query latency (ms) of the full search and of each shortlist size
+    """
+    signature_rows = np.flatnonzero(signature_to_row >= 0)
+    signature_rows = np.random.default_rng(seed).choice(signature_rows, min(n_queries, len(signature_rows))
+                                                         , replace=False)
+    queries = signature_to_row[signature_rows]
+
+    start = time.perf_counter()
+    exact_indices = top_k_cosine(X_norm[queries], X_norm, k)[0]
+    full_ms = 1000 * (time.perf_counter() - start) / len(queries)
+
+    rows = [{"shortlist_size": "full", f"recall@{k}": 1.0, "latency_ms": full_ms}]
+    for shortlist_size in shortlist_sizes:
+        start = time.perf_counter()
+        shortlisted = shortlist(signatures[signature_rows], signatures, shortlist_size)
+        cascade_indices = rerank(shortlisted, X_norm[queries], X_norm, signature_to_row, k)[0]
+        latency_ms = 1000 * (time.perf_counter() - start) / len(queries)
+
+        hits = sum(len(np.intersect1d(c, e)) for c, e in zip(cascade_indices, exact_indices))
+        rows.append({"shortlist_size": shortlist_size, f"recall@{k}": hits / exact_indices.size
+                     , "latency_ms": latency_ms})
+        logging.info(f"shortlist_size={shortlist_size}: recall@{k}={rows[-1][f'recall@{k}']:.4f} "
+                     f"latency={latency_ms:.3f}ms")
+
+    return pd.DataFrame(rows)
@@ -0,0 +1,208 @@
+"""
+Compressed feature representations for cosine similarity searches.
+
+A `FeatureCodec` maps raw bottleneck features to compact codes in two optional steps:
+    - PCA: the L2-normalised features are projected onto their top `n_components` principal directions - the PCA is
+      uncentred (a truncated SVD) so that dot-products, and hence cosine similarities, are preserved as well as
+      possible - and re-normalised
+    - scalar quantisation: the projected features are stored as float16, or as int8 with a single global scale
+
+Because the int8 scale is the same for every dimension, the codes can be searched directly: a dot-product of two
+codes is `scale**2` times the dot-product of the vectors they encode, so rankings are unchanged and scores are turned
+back into cosine similarities by multiplying them with `score_scale`.
+
+A compressed feature-store is a regular feature-store (see `utils/feature_store.py`) holding the codes, with the
+codec saved next to it as <name>.codec.npz.
+"""
+import os
+import time
+import logging
+from typing import Optional
+import numpy as np
+import pandas as pd
+from utils.feature_store import load_feature_store, save_feature_store
+from utils.similarity import normalise_rows, top_k_cosine
+
+CODEC_EXT = ".codec.npz"
+COMPRESSION_DTYPES = ("float32", "float16", "int8")
+INT8_MAX = 127
+
+
+class FeatureCodec:
+    def __init__(self, n_components: int = None, dtype: str = "float16", max_fit_rows: int = 100000, seed: int = 0):
+        """
+        :param n_components: number of PCA components to keep - no PCA when None
+        :param dtype: one of "float32", "float16" or "int8"
+        :param max_fit_rows: the PCA & int8 scale are fitted on a random sample of at most this many rows
+        :param seed:
+        """
+        assert dtype in COMPRESSION_DTYPES, f"dtype must be one of {COMPRESSION_DTYPES}"
+        self.n_components = n_components
+        self.dtype = dtype
+        self.max_fit_rows = max_fit_rows
+        self.seed = seed
+        self.components = None # (n_components, n_features) - None when there is no PCA step
+        self.scale = 1.0
+
+    @property
+    def score_scale(self) -> float:
+        """
+        multiply code-space dot-products with this to get cosine similarities
+        """
+        return 1.0 / self.scale**2
+
+    @property
+    def name(self) -> str:
+        return self.dtype if self.components is None else f"pca{self.components.shape[0]}_{self.dtype}"
+
+    def fit(self, X: np.ndarray) -> "FeatureCodec":
+        """
+        :param X: (n_items, n_features) raw features
+        :return: self
+        """
+        rng = np.random.default_rng(self.seed)
+        if X.shape[0] > self.max_fit_rows:
+            X = X[np.sort(rng.choice(X.shape[0], self.max_fit_rows, replace=False))]
+        X_norm = normalise_rows(X, dtype=np.float64)
+
+        if self.n_components is not None:
+            _, _, Vt = np.linalg.svd(X_norm, full_matrices=False)
+            self.components = Vt[:min(self.n_components, Vt.shape[0])].astype(np.float32)
+
+        if self.dtype == "int8":
+            max_abs = float(np.abs(self.project(X_norm)).max())
+            self.scale = INT8_MAX / max_abs if max_abs > 0 else 1.0
+        return self
+
+    def project(self, X: np.ndarray) -> np.ndarray:
+        """
+        :param X: raw features
+        :return: L2-normalised (PCA-projected) float32 features
+        """
+        X_norm = normalise_rows(X)
+        if self.components is None:
+            return X_norm
+        return normalise_rows(X_norm @ self.components.T)
+
+    def to_code_space(self, X: np.ndarray) -> np.ndarray:
+        """
+        Projects raw features into the code space without rounding them - used for queries, which are searched
+        against the codes but don't have to be stored
+        :param X: raw features
+        :return: float32 array
+        """
+        return self.project(X) * np.float32(self.scale)
+
+    def encode(self, X: np.ndarray) -> np.ndarray:
+        """
+        :param X: raw features
+        :return: codes of the codec's dtype
+        """
+        X_code = self.to_code_space(X)
+        if self.dtype == "int8":
+            return np.clip(np.rint(X_code), -INT8_MAX, INT8_MAX).astype(np.int8)
+        return X_code.astype(self.dtype)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """
+        :param codes:
+        :return: the (approximate) L2-normalised, PCA-projected features as float32
+        """
+        return codes.astype(np.float32) / np.float32(self.scale)
+
+    def to_arrays(self):
+        arrays = {"dtype": np.array(self.dtype), "scale": np.array(self.scale)}
+        if self.components is not None:
+            arrays["components"] = self.components
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays) -> "FeatureCodec":
+        codec = cls(dtype=str(np.asarray(arrays["dtype"]).item()))
+        codec.scale = float(np.asarray(arrays["scale"]).item())
+        if "components" in arrays:
+            codec.components = np.asarray(arrays["components"])
+            codec.n_components = codec.components.shape[0]
+        return codec
+
+    def save(self, fpath: str) -> None:
+        np.savez(fpath, **self.to_arrays())
+
+    @classmethod
+    def load(cls, fpath: str) -> "FeatureCodec":
+        with np.load(fpath, allow_pickle=False) as data:
+            return cls.from_arrays({name: data[name] for name in data.files})
+
+
+def get_codec_fpath(store_fpath: str) -> str:
+    return os.path.splitext(store_fpath)[0] + CODEC_EXT
+
+
+def load_codec(store_fpath: str) -> Optional[FeatureCodec]:
+    """
+    :param store_fpath: path to the .npy file of a feature-store
+    :return: the codec of a compressed feature-store, None if the feature-store isn't compressed
+    """
+    codec_fpath = get_codec_fpath(store_fpath)
+    return FeatureCodec.load(codec_fpath) if os.path.exists(codec_fpath) else None
+
+
+def compress_feature_store(store_fpath: str, output_fpath: str, n_components: int = None, dtype: str = "float16"
+                           , chunk_size: int = 65536) -> FeatureCodec:
+    """
+    Fits a codec on a feature-store and writes the encoded features to a compressed feature-store
+    :param store_fpath: path to the .npy file of the feature-store to compress
+    :param output_fpath: path to the .npy file of the compressed feature-store
+    :param n_components: see `FeatureCodec`
+    :param dtype: see `FeatureCodec`
+    :param chunk_size: number of rows encoded at a time
+    :return: the fitted codec
+    """
+    features_df = load_feature_store(store_fpath)
+    X = features_df.values
+    codec = FeatureCodec(n_components, dtype).fit(X)
+
+    logging.info(f"Compressing {store_fpath} to {output_fpath} ({codec.name})...")
+    codes = np.concatenate([codec.encode(X[i:i + chunk_size]) for i in range(0, X.shape[0], chunk_size)])
+
+    save_feature_store(pd.DataFrame(codes, index=features_df.index), output_fpath, dtype=codes.dtype)
+    codec.save(get_codec_fpath(output_fpath))
+    return codec
+
+
+def compression_report(X: np.ndarray, codec: FeatureCodec, k: int, n_queries: int = 1000, seed: int = 0) -> dict:
+    """
+    Compares a search over the codes against the uncompressed cosine search, for a random sample of items
+    :param X: (n_items, n_features) raw features
+    :param codec: a fitted codec
+    :param k:
+    :param n_queries:
+    :param seed:
+    :return: {"codec", "bytes_per_item", "compression_ratio", "recall@k", "mean_score_drift", "max_score_drift",
+              "exact_latency_ms", "compressed_latency_ms"} - score drift is the absolute difference between the
+              cosine similarity reported by the compressed search and the exact one, over the items it returned
+    """
+    X_norm = normalise_rows(X)
+    codes = codec.encode(X)
+    queries = np.random.default_rng(seed).choice(X.shape[0], min(n_queries, X.shape[0]), replace=False)
+
+    start = time.perf_counter()
+    exact_indices = top_k_cosine(X_norm[queries], X_norm, k)[0]
+    exact_latency_ms = 1000 * (time.perf_counter() - start) / len(queries)
+
+    start = time.perf_counter()
+    indices, scores = top_k_cosine(codes[queries], codes, k)
+    compressed_latency_ms = 1000 * (time.perf_counter() - start) / len(queries)
+
+    hits = sum(len(np.intersect1d(a, e)) for a, e in zip(indices, exact_indices))
+    exact_scores = np.einsum("qd,qkd->qk", X_norm[queries], X_norm[indices])
+    drift = np.abs(scores * codec.score_scale - exact_scores)
+
+    report = {"codec": codec.name, "bytes_per_item": codes[0].nbytes
+              , "compression_ratio": X.dtype.itemsize * X.shape[1] / codes[0].nbytes
+              , f"recall@{k}": hits / exact_indices.size, "mean_score_drift": float(drift.mean())
+              , "max_score_drift": float(drift.max()), "exact_latency_ms": exact_latency_ms
+              , "compressed_latency_ms": compressed_latency_ms}
+    logging.info(f"{codec.name}: recall@{k}={report[f'recall@{k}']:.4f} "
+                 f"mean score drift={report['mean_score_drift']:.5f} ({report['compression_ratio']:.1f}x smaller)")
+    return report
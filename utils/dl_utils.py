@@ -1,40 +1,17 @@
-import os
-from typing import Tuple, Any
+from typing import Tuple, Any, Optional, Dict, List
 import logging
+import time
+import threading
 import numpy as np
 import math
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from tensorflow.keras.utils import Sequence
 from PIL import Image
-from urllib.parse import unquote
 from tqdm import tqdm
 import pandas as pd
+from utils.feature_store import save_feature_store, load_feature_store, FeatureStoreWriter, get_stylised_name_from_fpath
+from utils.metrics import timer, timed, increment
 
-def get_stylised_name_from_fpath(fpath:str)-> Tuple[str,str]:
-    """
-    Takes the filepath of a flag and returns an cleansed version of the country name like so:
-    i.e.,
-    ('Flag_of_Australia_%28converted%29.jpg', 'Australia')
-    ('Flag_of_Belgium_%28civil%29.jpg', 'Belgium')
-    ('Flag_of_C%C3%B4te_d%27Ivoire.jpg', "Côte D'Ivoire")
-    ('Flag_of_Canada_%28Pantone%29.jpg', 'Canada')
-    ('Flag_of_the_Democratic_Republic_of_the_Congo.jpg', 'Democratic Republic Of The Congo'))
-    :param fpath:
-    :return:
-    """
-
-    # below we use unquote to get proper name of the country:
-    # eg: "C%C3%B4te_d%27Ivoire' ->"Côte D'Ivoire"
-    base_name = os.path.basename(fpath)
-    unquoted_filename = unquote(os.path.splitext(base_name)[0]).split("_(")[0]
-
-    # replace underscores in name with single-space & capitalise each word
-    territory_name = unquoted_filename.replace("Flag_of_","").replace("_", " ").title()
-
-    # for countries that start with "The ..." replace the "The " at the beginning
-    if territory_name.startswith("The "):
-        territory_name = territory_name[len("The "):]
-
-    return base_name, territory_name
 
 class MySequence(Sequence):
     """
@@ -59,49 +36,195 @@ class MySequence(Sequence):
 
     def __getitem__(self, idx:int, return_file_names: bool =False):
         img_fpaths_batch = self.img_fpaths_list[idx * self.batch_size : (idx + 1) * self.batch_size]
+        filenames_list, X = load_batch(img_fpaths_batch, self.target_size)
 
-        X = []
-        filenames_list=[]
+        if self.return_filenames:
+            return filenames_list, X
+        else:
+            return X
 
-        for img_file in img_fpaths_batch:
-            img = Image.open(img_file).resize(self.target_size)
-            X.append(np.array(img))
 
-            filenames_list.append(get_stylised_name_from_fpath(img_file))
+def load_image(img_file: str, target_size: Tuple[int, int], use_draft: bool = False) -> np.ndarray:
+    """
+    Opens an image and resizes it to `target_size`.
+
+    With `use_draft=True` JPEGs are decoded at a reduced scale (the smallest 1/2, 1/4 or 1/8 scale that is still
+    larger than `target_size`) so a 2100x1400 flag isn't fully decoded just to be resized to 256x256
+    :param img_file:
+    :param target_size: (width, height)
+    :param use_draft:
+    :return: uint8 array of shape (height, width, channels)
+    """
+    img = Image.open(img_file)
+    if use_draft:
+        img.draft("RGB", target_size)
+    return np.array(img.resize(target_size))
+
+
+@timed("featurise.decode")
+def load_batch(img_fpaths_batch: List[str], target_size: Tuple[int, int], use_draft: bool = False)\
+        -> Tuple[List[Tuple[str, str]], np.ndarray]:
+    X = []
+    filenames_list=[]
+
+    for img_file in img_fpaths_batch:
+        X.append(load_image(img_file, target_size, use_draft))
+        filenames_list.append(get_stylised_name_from_fpath(img_file))
+
+    increment("featurise.images_decoded", len(filenames_list))
+    return filenames_list, np.asarray(X)
+
+
+class PrefetchingSequence(MySequence):
+    """
+    Drop-in replacement for MySequence that decodes batches on a pool of threads (or processes) and keeps the next
+    `prefetch` batches decoding in the background while the model works on the current one.
+    """
+
+    def __init__(self, img_fpaths_list: str ,batch_size: int =8, target_size: Tuple[int, int] = (256,256)
+                ,return_filenames: bool =False, n_workers: int = 4, prefetch: int = 8, use_processes: bool = False
+                ,use_draft: bool = False):
+        """
+        :param n_workers: number of threads/processes decoding batches
+        :param prefetch: number of batches decoded ahead of the one requested
+        :param use_processes: decode on a process pool rather than a thread pool
+        :param use_draft: use reduced-scale JPEG decoding (see `load_image`) - it changes the pixels the model sees,
+                          so every image of a feature-store has to be decoded the same way
+        """
+        super().__init__(img_fpaths_list, batch_size, target_size, return_filenames)
+        self.prefetch = prefetch
+        self.use_draft = use_draft
+        self.executor = (ProcessPoolExecutor if use_processes else ThreadPoolExecutor)(max_workers=n_workers)
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.n_images_loaded = 0
+        self.start_time = None
+
+    def submit(self, idx: int):
+        if idx not in self.futures and 0 <= idx < len(self):
+            img_fpaths_batch = self.img_fpaths_list[idx * self.batch_size : (idx + 1) * self.batch_size]
+            self.futures[idx] = self.executor.submit(load_batch, img_fpaths_batch, self.target_size, self.use_draft)
+
+    def __getitem__(self, idx:int, return_file_names: bool =False):
+        with self.lock:
+            if self.start_time is None:
+                self.start_time = time.perf_counter()
+
+            # drop batches that were prefetched but are no longer ahead of us (eg: when keras shuffles)
+            for stale_idx in [i for i in self.futures.keys() if not idx <= i <= idx + self.prefetch]:
+                self.futures.pop(stale_idx).cancel()
+
+            for i in range(idx, idx + self.prefetch + 1):
+                self.submit(i)
+            future = self.futures.pop(idx)
+
+        # time spent waiting here is time the model sat idle because decoding couldn't keep up
+        with timer("featurise.decode_wait"):
+            filenames_list, X = future.result()
+        with self.lock:
+            self.n_images_loaded += len(filenames_list)
 
         if self.return_filenames:
-            return filenames_list, np.asarray(X)
+            return filenames_list, X
         else:
-            return np.asarray(X)
+            return X
+
+    @property
+    def images_per_sec(self) -> float:
+        """images delivered per second since the first batch was requested"""
+        if self.start_time is None:
+            return 0.0
+        return self.n_images_loaded / max(time.perf_counter() - self.start_time, 1e-9)
+
+    def on_epoch_end(self):
+        logging.info(f"Loaded {self.n_images_loaded:,} images at {self.images_per_sec:,.1f} images/sec")
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+            self.futures = {}
+            self.n_images_loaded = 0
+            self.start_time = None
+
+    def close(self):
+        self.executor.shutdown(wait=False)
 
 
-def get_bottleneck_features(datqSeq: MySequence, model: Any) -> pd.DataFrame:
+def get_bottleneck_features(datqSeq: MySequence, model: Any, output_fpath: Optional[str] = None
+                            , stream: bool = False, resume: bool = True) -> pd.DataFrame:
     """
     Helper function to extract features from a model and return them as pd.DataFrame
 
     If your input has a large number of images whose resulting features might not fit in memory
-    then the following approach will result in out of memory errors.
-
-    In that case you'd have to modify the following function to "yield" rather than return
-    the full concatenated dataframe.
-    By turning this into a generator - you can take one batch of images at a time - get their features
-    , write the resulting batch to disk - via appends to file, and process the next batch. This way
-    you can work with limited memory
+    then use `stream=True` - each batch's features are appended to the `output_fpath` feature-store as soon as
+    they are computed and a checkpoint is recorded after every batch, so memory is bounded by a single batch and
+    a re-run (with `resume=True`) carries on from the last finished batch instead of starting over.
     :param datqSeq:
     :param model:
+    :param output_fpath: if provided, the features are also written to this feature-store (.npy) path
+    :param stream: write the features batch by batch to `output_fpath` rather than holding them all in memory,
+                    the returned dataframe is then memory-mapped from the finished feature-store
+    :param resume: only used when streaming - resume from the last checkpoint of `output_fpath` if there is one
     :return:
     """
+    if stream:
+        assert output_fpath is not None, "`output_fpath` is required when streaming features to disk"
+        writer = FeatureStoreWriter(output_fpath, datqSeq.n_images, datqSeq.batch_size, resume=resume)
+
+        for idx in tqdm(range(writer.n_batches, len(datqSeq)), total=len(datqSeq), initial=writer.n_batches):
+            filename_list, img_Xs = datqSeq[idx]
+            with timer("featurise.inference"):
+                features = np.asarray(model(img_Xs))
+            with timer("featurise.write"):
+                writer.append(features, filename_list)
+
+        datqSeq.on_epoch_end()
+        return load_feature_store(writer.finalise())
+
     df_list=[]
     for filename_list, img_Xs in tqdm(datqSeq, total = datqSeq.__len__()):
         pd_index = pd.MultiIndex.from_tuples(filename_list, names=("filename", "territory_name"))
-        bottleneck_features = model(img_Xs)
+        with timer("featurise.inference"):
+            bottleneck_features = model(img_Xs)
 
-        X_df = pd.DataFrame(bottleneck_features.numpy()
+        X_df = pd.DataFrame(np.asarray(bottleneck_features)
                             , index=pd_index
                             , columns = [f"F_{i:06d}" for i in range(bottleneck_features.shape[1])])
         df_list.append(X_df)
 
-    return pd.concat(df_list)
+    datqSeq.on_epoch_end()
+    features_df = pd.concat(df_list)
+    if output_fpath is not None:
+        save_feature_store(features_df, output_fpath)
 
+    return features_df
 
 
+def get_bottleneck_features_multi(datqSeq: MySequence, models: Dict[str, Any], output_fpaths: Dict[str, str]
+                                  , resume: bool = True) -> Dict[str, str]:
+    """
+    Extracts features with several models in a single pass over the images - each batch is decoded & resized once
+    and the same uint8 batch is fed to every model, each model's features are streamed to its own feature-store
+    (see `get_bottleneck_features` with `stream=True`) so memory is bounded by a single batch.
+    :param datqSeq:
+    :param models: {model_name: model}
+    :param output_fpaths: {model_name: feature-store (.npy) path}
+    :param resume: resume each model from the last checkpoint of its feature-store if there is one
+    :return: {model_name: feature-store (.npy) path}
+    """
+    writers = {model_name: FeatureStoreWriter(output_fpaths[model_name], datqSeq.n_images, datqSeq.batch_size
+                                              , resume=resume)
+               for model_name in models.keys()}
+
+    # models may have been checkpointed at different batches - start from the one that is furthest behind
+    start_idx = min(writer.n_batches for writer in writers.values())
+    for idx in tqdm(range(start_idx, len(datqSeq)), total=len(datqSeq), initial=start_idx):
+        filename_list, img_Xs = datqSeq[idx]
+        for model_name, model in models.items():
+            if writers[model_name].n_batches == idx:
+                with timer(f"featurise.inference.{model_name}"):
+                    features = np.asarray(model(img_Xs))
+                with timer("featurise.write"):
+                    writers[model_name].append(features, filename_list)
+
+    datqSeq.on_epoch_end()
+    return {model_name: writer.finalise() for model_name, writer in writers.items()}
@@ -0,0 +1,405 @@
+"""
+Binary feature-store for bottleneck features.
+
+A feature-store is a pair of files that sit side by side:
+    <name>.npy        - contiguous float32 matrix of shape (n_images, n_features), memory-mappable
+    <name>.index.tsv  - tab-separated sidecar holding the (filename, territory_name) key of each row
+
+Loading a feature-store memory-maps the matrix so start-up does not have to parse any text - this replaces the
+csv files which are slow and memory hungry to parse once we have more than a few thousand images.
+"""
+import os
+import csv
+import json
+import hashlib
+import logging
+from urllib.parse import unquote
+from typing import Tuple, List, Dict, Iterable, Optional
+import numpy as np
+import pandas as pd
+
+FEATURES_EXT = ".npy"
+INDEX_EXT = ".index.tsv"
+INDEX_COLUMNS = ["filename", "territory_name"]
+FEATURES_DTYPE = np.float32
+PARTIAL_EXT = ".part"
+CHECKPOINT_EXT = ".checkpoint.json"
+MANIFEST_EXT = ".manifest.json"
+NPY_HEADER_SIZE = 128 # fixed size .npy header reserved by FeatureStoreWriter so the shape can be filled in at the end
+
+
+def get_store_paths(store_fpath: str) -> Tuple[str, str]:
+    """
+    Returns the (matrix, index) file paths of a feature-store.
+    `store_fpath` can either be the path to the .npy file or the path without an extension
+    i.e.,
+    "data/VGG16.npy" -> ("data/VGG16.npy", "data/VGG16.index.tsv")
+    "data/VGG16"     -> ("data/VGG16.npy", "data/VGG16.index.tsv")
+    :param store_fpath:
+    :return:
+    """
+    if store_fpath.endswith(FEATURES_EXT):
+        store_fpath = store_fpath[:-len(FEATURES_EXT)]
+    return f"{store_fpath}{FEATURES_EXT}", f"{store_fpath}{INDEX_EXT}"
+
+
+def get_checkpoint_fpath(store_fpath: str) -> str:
+    """
+    Returns the path of the checkpoint a `FeatureStoreWriter` keeps while it is writing the feature-store
+    """
+    return get_store_paths(store_fpath)[0][:-len(FEATURES_EXT)] + CHECKPOINT_EXT
+
+
+def get_checkpoint_batch_size(store_fpath: str) -> Optional[int]:
+    """
+    Returns the batch size an unfinished feature-store was being written with - a resumed run has to use the same
+    batch size to pick up from its checkpoint - or None if there is no checkpoint
+    """
+    checkpoint_fpath = get_checkpoint_fpath(store_fpath)
+    if not os.path.exists(checkpoint_fpath):
+        return None
+    with open(checkpoint_fpath) as f:
+        return json.load(f)["batch_size"]
+
+
+def is_store_complete(store_fpath: str) -> bool:
+    """
+    True if the feature-store exists and is not in the middle of being (re-)written
+    """
+    return os.path.exists(get_store_paths(store_fpath)[0]) and not os.path.exists(get_checkpoint_fpath(store_fpath))
+
+
+def get_stylised_name_from_fpath(fpath:str)-> Tuple[str,str]:
+    """
+    Takes the filepath of a flag and returns an cleansed version of the country name like so:
+    i.e.,
+    ('Flag_of_Australia_%28converted%29.jpg', 'Australia')
+    ('Flag_of_Belgium_%28civil%29.jpg', 'Belgium')
+    ('Flag_of_C%C3%B4te_d%27Ivoire.jpg', "Côte D'Ivoire")
+    ('Flag_of_Canada_%28Pantone%29.jpg', 'Canada')
+    ('Flag_of_the_Democratic_Republic_of_the_Congo.jpg', 'Democratic Republic Of The Congo'))
+    :param fpath:
+    :return:
+    """
+
+    # below we use unquote to get proper name of the country:
+    # eg: "C%C3%B4te_d%27Ivoire' ->"Côte D'Ivoire"
+    base_name = os.path.basename(fpath)
+    unquoted_filename = unquote(os.path.splitext(base_name)[0]).split("_(")[0]
+
+    # replace underscores in name with single-space & capitalise each word
+    territory_name = unquoted_filename.replace("Flag_of_","").replace("_", " ").title()
+
+    # for countries that start with "The ..." replace the "The " at the beginning
+    if territory_name.startswith("The "):
+        territory_name = territory_name[len("The "):]
+
+    return base_name, territory_name
+
+
+def get_feature_columns(n_features: int) -> list:
+    return [f"F_{i:06d}" for i in range(n_features)]
+
+
+def save_index(index: pd.MultiIndex, index_fpath: str) -> None:
+    index.to_frame(index=False).to_csv(index_fpath, sep="\t", header=True, index=False)
+
+
+def load_index(index_fpath: str) -> pd.MultiIndex:
+    index_df = pd.read_csv(index_fpath, sep="\t", dtype=str, keep_default_na=False)
+    return pd.MultiIndex.from_frame(index_df[INDEX_COLUMNS])
+
+
+def get_index_fingerprint(pd_index: pd.MultiIndex) -> str:
+    """
+    Returns the sha1 of the filenames of a feature set in row order - anything built over the rows of a feature set
+    (eg: an ANN index) is stale when the fingerprint of the feature set has changed
+    """
+    return hashlib.sha1("\n".join(pd_index.get_level_values("filename")).encode("utf-8")).hexdigest()
+
+
+def save_feature_store(features_df: pd.DataFrame, store_fpath: str, dtype=FEATURES_DTYPE) -> None:
+    """
+    Writes a features dataframe (as returned by `get_bottleneck_features`) to a feature-store
+    :param features_df: dataframe indexed by (filename, territory_name) with one column per feature
+    :param store_fpath: path to the .npy file of the feature-store
+    :param dtype: dtype of the stored matrix - only compressed feature-stores use anything but float32
+    :return:
+    """
+    matrix_fpath, index_fpath = get_store_paths(store_fpath)
+    X = np.ascontiguousarray(features_df.values, dtype=dtype)
+    np.save(matrix_fpath, X, allow_pickle=False)
+    save_index(features_df.index, index_fpath)
+
+
+def load_feature_store(store_fpath: str, mmap: bool = True) -> pd.DataFrame:
+    """
+    Loads a feature-store as a dataframe indexed by (filename, territory_name).
+
+    With `mmap=True` the dataframe is backed by a read-only memory-map of the .npy file so no data is copied
+    until it's actually used.
+    :param store_fpath:
+    :param mmap:
+    :return:
+    """
+    matrix_fpath, index_fpath = get_store_paths(store_fpath)
+    X = np.load(matrix_fpath, mmap_mode="r" if mmap else None, allow_pickle=False)
+    pd_index = load_index(index_fpath)
+
+    if X.shape[0] != len(pd_index):
+        raise ValueError(f"{matrix_fpath} has {X.shape[0]:,} rows but {index_fpath} has {len(pd_index):,} keys")
+
+    return pd.DataFrame(X, index=pd_index, columns=get_feature_columns(X.shape[1]), copy=False)
+
+
+def load_features(fpath: str, mmap: bool = True) -> pd.DataFrame:
+    """
+    Loads bottleneck features from either a csv file or a feature-store depending on the file's extension
+    :param fpath:
+    :param mmap: only used for feature-stores
+    :return:
+    """
+    if fpath.endswith(FEATURES_EXT):
+        return load_feature_store(fpath, mmap=mmap)
+    return pd.read_csv(fpath, index_col=INDEX_COLUMNS)
+
+
+def load_features_index(fpath: str) -> pd.MultiIndex:
+    """
+    Loads the (filename, territory_name) keys of a csv file or a feature-store without loading the features
+    """
+    if fpath.endswith(FEATURES_EXT):
+        return load_index(get_store_paths(fpath)[1])
+    return pd.MultiIndex.from_frame(pd.read_csv(fpath, usecols=INDEX_COLUMNS)[INDEX_COLUMNS])
+
+
+def load_features_shape(fpath: str) -> Tuple[Tuple[int, int], np.dtype]:
+    """
+    Reads the shape & dtype of the features of a csv file or a feature-store without loading them - the csv shape
+    assumes one line per row
+    """
+    if fpath.endswith(FEATURES_EXT):
+        X = np.load(get_store_paths(fpath)[0], mmap_mode="r")
+        return X.shape, X.dtype
+    with open(fpath, newline="", encoding="utf-8") as f:
+        n_columns = len(next(csv.reader(f)))
+        n_rows = sum(1 for _ in f)
+    # csv features are parsed as float64
+    return (n_rows, n_columns - len(INDEX_COLUMNS)), np.dtype(np.float64)
+
+
+def convert_csv_to_store(csv_fpath: str, store_fpath: str = None) -> str:
+    """
+    Converts a csv file of bottleneck features into a feature-store placed next to it
+    :param csv_fpath:
+    :param store_fpath: defaults to the csv path with a .npy extension
+    :return: path to the .npy file of the feature-store
+    """
+    if store_fpath is None:
+        store_fpath = os.path.splitext(csv_fpath)[0] + FEATURES_EXT
+
+    logging.info(f"Converting {csv_fpath} to {store_fpath}...")
+    save_feature_store(pd.read_csv(csv_fpath, index_col=INDEX_COLUMNS), store_fpath)
+    return store_fpath
+
+
+def write_npy_header(f, shape: Tuple[int, int], dtype=FEATURES_DTYPE) -> None:
+    """
+    Writes a version 1.0 .npy header padded to exactly NPY_HEADER_SIZE bytes at the current position of `f`
+    """
+    header = repr({"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False
+                   , "shape": tuple(shape)})
+    prefix = b"\x93NUMPY\x01\x00"
+    header_len = NPY_HEADER_SIZE - len(prefix) - 2
+    f.write(prefix + np.uint16(header_len).tobytes() + header.ljust(header_len - 1).encode("latin1") + b"\n")
+
+
+class FeatureStoreWriter:
+    """
+    Appends batches of features to a feature-store on disk so the whole feature matrix never has to be held in memory.
+
+    While writing, rows go to `<name>.npy.part` / `<name>.index.tsv.part` and after every batch a checkpoint
+    (`<name>.checkpoint.json`) records how many batches/rows/bytes have been safely written. If the process dies,
+    a new writer for the same store resumes from the last checkpoint - anything written after it is discarded.
+    `finalise` turns the partial files into the feature-store and removes the checkpoint.
+    """
+
+    def __init__(self, store_fpath: str, n_images: int, batch_size: int, resume: bool = True):
+        """
+        :param store_fpath: path to the .npy file of the feature-store
+        :param n_images: total number of images that will be written - used to check a checkpoint belongs to this run
+        :param batch_size: used to check a checkpoint belongs to this run
+        :param resume: resume from an existing checkpoint, otherwise start from scratch
+        """
+        self.matrix_fpath, self.index_fpath = get_store_paths(store_fpath)
+        self.matrix_part_fpath = self.matrix_fpath + PARTIAL_EXT
+        self.index_part_fpath = self.index_fpath + PARTIAL_EXT
+        self.checkpoint_fpath = get_checkpoint_fpath(store_fpath)
+        self.checkpoint = {"n_images": n_images, "batch_size": batch_size, "n_batches": 0, "n_rows": 0
+                           , "n_features": None, "matrix_bytes": NPY_HEADER_SIZE, "index_bytes": 0}
+
+        if resume and os.path.exists(self.checkpoint_fpath):
+            with open(self.checkpoint_fpath) as f:
+                checkpoint = json.load(f)
+            if (checkpoint["n_images"], checkpoint["batch_size"]) == (n_images, batch_size):
+                self.checkpoint = checkpoint
+                logging.info(f"Resuming {self.matrix_fpath} from batch {checkpoint['n_batches']:,}...")
+            else:
+                logging.warning(f"Ignoring {self.checkpoint_fpath} as it was written for a different set of images")
+
+        if self.checkpoint["n_batches"] == 0:
+            with open(self.matrix_part_fpath, "wb") as f:
+                write_npy_header(f, (0, 0))
+            with open(self.index_part_fpath, "w", newline="", encoding="utf-8") as f:
+                csv.writer(f, delimiter="\t").writerow(INDEX_COLUMNS)
+            self.checkpoint["index_bytes"] = os.path.getsize(self.index_part_fpath)
+
+        # discard anything written after the last checkpoint
+        for fpath, n_bytes in [(self.matrix_part_fpath, self.checkpoint["matrix_bytes"])
+                               , (self.index_part_fpath, self.checkpoint["index_bytes"])]:
+            with open(fpath, "r+b") as f:
+                f.truncate(n_bytes)
+
+    @property
+    def n_batches(self) -> int:
+        """number of batches written so far"""
+        return self.checkpoint["n_batches"]
+
+    def append(self, features: np.ndarray, keys: List[Tuple[str, str]]) -> None:
+        """
+        Appends a batch of features and their (filename, territory_name) keys and checkpoints
+        :param features: (batch_size, n_features) array
+        :param keys:
+        :return:
+        """
+        features = np.ascontiguousarray(features, dtype=FEATURES_DTYPE)
+        if self.checkpoint["n_features"] is None:
+            self.checkpoint["n_features"] = features.shape[1]
+
+        with open(self.matrix_part_fpath, "ab") as f:
+            f.write(features.tobytes())
+            os.fsync(f.fileno())
+        with open(self.index_part_fpath, "a", newline="", encoding="utf-8") as f:
+            csv.writer(f, delimiter="\t").writerows(keys)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.checkpoint["n_batches"] += 1
+        self.checkpoint["n_rows"] += features.shape[0]
+        self.checkpoint["matrix_bytes"] = os.path.getsize(self.matrix_part_fpath)
+        self.checkpoint["index_bytes"] = os.path.getsize(self.index_part_fpath)
+
+        with open(self.checkpoint_fpath + PARTIAL_EXT, "w") as f:
+            json.dump(self.checkpoint, f)
+        os.replace(self.checkpoint_fpath + PARTIAL_EXT, self.checkpoint_fpath)
+
+    def finalise(self) -> str:
+        """
+        Fills in the .npy header and moves the partial files into place
+        :return: path to the .npy file of the feature-store
+        """
+        with open(self.matrix_part_fpath, "r+b") as f:
+            write_npy_header(f, (self.checkpoint["n_rows"], self.checkpoint["n_features"] or 0))
+        os.replace(self.matrix_part_fpath, self.matrix_fpath)
+        os.replace(self.index_part_fpath, self.index_fpath)
+        # there's no checkpoint if nothing was appended
+        if os.path.exists(self.checkpoint_fpath):
+            os.remove(self.checkpoint_fpath)
+        return self.matrix_fpath
+
+
+def hash_file(fpath: str, chunk_size: int = 2**20) -> str:
+    """
+    Returns the sha1 of a file's content
+    """
+    sha1 = hashlib.sha1()
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_manifest_fpath(store_fpath: str) -> str:
+    return get_store_paths(store_fpath)[0][:-len(FEATURES_EXT)] + MANIFEST_EXT
+
+
+def load_manifest(store_fpath: str) -> Dict[str, str]:
+    """
+    Returns the {filename: content hash} manifest of the images a feature-store was extracted from - the manifest
+    is empty if the feature-store (or its manifest) doesn't exist
+    """
+    manifest_fpath = get_manifest_fpath(store_fpath)
+    if not is_store_complete(store_fpath) or not os.path.exists(manifest_fpath):
+        return {}
+    with open(manifest_fpath) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: Dict[str, str], store_fpath: str) -> None:
+    manifest_fpath = get_manifest_fpath(store_fpath)
+    with open(manifest_fpath + PARTIAL_EXT, "w") as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+    os.replace(manifest_fpath + PARTIAL_EXT, manifest_fpath)
+
+
+def get_manifest_changes(manifest: Dict[str, str], img_hashes: Dict[str, str]) -> Tuple[List[str], List[str]]:
+    """
+    Compares a feature-store's manifest with the content hashes of the images currently on disk
+    :param manifest: {filename: content hash} the feature-store was extracted from
+    :param img_hashes: {filename: content hash} of the images on disk
+    :return: (filenames that are new or modified, filenames that have been deleted)
+    """
+    changed = [filename for filename, img_hash in img_hashes.items() if manifest.get(filename) != img_hash]
+    deleted = [filename for filename in manifest.keys() if filename not in img_hashes]
+    return changed, deleted
+
+
+def merge_feature_store(store_fpath: str, delta_fpath: Optional[str], deleted_filenames: Iterable[str]
+                        , chunk_size: int = 65536) -> str:
+    """
+    Merges a feature-store of new/modified images (`delta_fpath`) into an existing feature-store - rows of deleted
+    images and the old rows of modified images are dropped and the delta's rows are appended at the end.
+    The rows are copied `chunk_size` at a time so memory is bounded regardless of the size of the feature-store.
+    If `store_fpath` doesn't exist yet the delta simply becomes the feature-store.
+    :param store_fpath:
+    :param delta_fpath: removed once it has been merged - None when there are only deletions
+    :param deleted_filenames:
+    :param chunk_size:
+    :return: path to the .npy file of the merged feature-store
+    """
+    matrix_fpath, index_fpath = get_store_paths(store_fpath)
+    deleted_filenames = list(deleted_filenames)
+    if delta_fpath is None and not deleted_filenames:
+        # nothing to merge - leave the feature-store as it is
+        return matrix_fpath
+    if delta_fpath is not None and not os.path.exists(matrix_fpath):
+        for source, target in zip(get_store_paths(delta_fpath), (matrix_fpath, index_fpath)):
+            os.replace(source, target)
+        return matrix_fpath
+
+    drop_filenames = set(deleted_filenames)
+    sources = [(store_fpath, drop_filenames)]
+    if delta_fpath is not None:
+        drop_filenames.update(load_index(get_store_paths(delta_fpath)[1]).get_level_values("filename"))
+        sources.append((delta_fpath, set()))
+
+    merged_fpath = matrix_fpath[:-len(FEATURES_EXT)] + ".merged" + FEATURES_EXT
+    writer = FeatureStoreWriter(merged_fpath, 0, 0, resume=False)
+    for source_fpath, source_drop_filenames in sources:
+        source_df = chunk_df = load_feature_store(source_fpath)
+        keep = ~source_df.index.get_level_values("filename").isin(source_drop_filenames)
+        for i in range(0, source_df.shape[0], chunk_size):
+            chunk_df = source_df.iloc[i:i + chunk_size][keep[i:i + chunk_size]]
+            if chunk_df.shape[0]:
+                writer.append(chunk_df.values, chunk_df.index.tolist())
+        del source_df, chunk_df
+
+    writer.finalise()
+    for source, target in zip(get_store_paths(merged_fpath), (matrix_fpath, index_fpath)):
+        os.replace(source, target)
+    if delta_fpath is not None:
+        for fpath in get_store_paths(delta_fpath):
+            os.remove(fpath)
+
+    logging.info(f"Merged {delta_fpath} and {len(set(deleted_filenames)):,} deleted images into {matrix_fpath}")
+    return matrix_fpath
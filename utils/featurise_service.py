@@ -0,0 +1,136 @@
+"""
+In-process featurisation service for query-by-upload.
+
+The featuriser models (see `FeatureExtraction/featuriser.py`) are built once and kept warm, and a single worker
+thread runs them. Concurrent requests are coalesced into micro-batches: the worker takes the first waiting image and
+then keeps collecting images until it has `max_batch_size` of them or `max_wait_ms` has passed since the first one
+arrived, so under load each model call is a reasonably sized batch while a lone request waits at most `max_wait_ms`.
+"""
+import time
+import queue
+import logging
+import threading
+from io import BytesIO
+from concurrent.futures import Future
+from typing import Any, Dict, Tuple
+import numpy as np
+from PIL import Image
+from utils.metrics import timer, increment
+
+
+def decode_image(image_bytes: bytes, target_size: Tuple[int, int] = (256, 256), use_draft: bool = False)\
+        -> np.ndarray:
+    """
+    Decodes an uploaded image the same way `utils.dl_utils.load_image` decodes the flags when featurising them
+    :param image_bytes: contents of any image file PIL can read
+    :param target_size: (width, height)
+    :param use_draft: reduced-scale JPEG decoding - has to match how the feature-stores were featurised
+    :return: uint8 array of shape (height, width, 3)
+    """
+    img = Image.open(BytesIO(image_bytes))
+    if use_draft:
+        img.draft("RGB", target_size)
+    return np.array(img.convert("RGB").resize(target_size))
+
+
+class FeaturiserService:
+    def __init__(self, models: Dict[str, Any], target_size: Tuple[int, int] = (256, 256), max_batch_size: int = 16
+                 , max_wait_ms: float = 10, use_draft: bool = False):
+        """
+        :param models: {model_name: model} - models take a uint8 batch of images (see `build_featuriser_model`)
+        :param target_size: (width, height) images are resized to
+        :param max_batch_size: max number of images per model call
+        :param max_wait_ms: max time the first image of a batch waits for others to join it
+        :param use_draft: decode uploads with reduced-scale JPEG decoding (see `decode_image`)
+        """
+        self.models = models
+        self.target_size = target_size
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.use_draft = use_draft
+        self.requests = queue.Queue()
+        self.thread = None
+
+    def start(self) -> "FeaturiserService":
+        """
+        Warms the models up (so the first request doesn't pay for building their graphs) and starts the worker
+        """
+        dummy_batch = np.zeros((1, self.target_size[1], self.target_size[0], 3), dtype=np.uint8)
+        for model_name, model in self.models.items():
+            logging.info(f"Warming up {model_name}...")
+            model(dummy_batch)
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self) -> None:
+        self.requests.put(None)
+        if self.thread is not None:
+            self.thread.join()
+
+    def submit(self, image_bytes: bytes) -> Future:
+        """
+        :param image_bytes: contents of an image file
+        :return: future of the image's features - {model_name: (n_features, ) array}
+        """
+        future = Future()
+        try:
+            image = decode_image(image_bytes, self.target_size, self.use_draft)
+        except (OSError, ValueError) as e:
+            future.set_exception(e)
+            return future
+
+        self.requests.put((image, future))
+        return future
+
+    def featurise(self, image_bytes: bytes, timeout: float = 60) -> Dict[str, np.ndarray]:
+        """
+        :param image_bytes: contents of an image file
+        :param timeout: seconds
+        :return: {model_name: (n_features, ) array}
+        """
+        return self.submit(image_bytes).result(timeout=timeout)
+
+    def get_batch(self) -> list:
+        """
+        Blocks until a request arrives, then collects more until the batch is full or the first request's deadline
+        passes
+        :return: list of (image, future) - ends with None when the service is closing
+        """
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait_ms / 1000
+        while batch[-1] is not None and len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.requests.get(timeout=max(deadline - time.perf_counter(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self) -> None:
+        closing = False
+        while not closing:
+            batch = self.get_batch()
+            if batch[-1] is None:
+                closing = True
+                batch = batch[:-1]
+            if not batch:
+                continue
+
+            images, futures = zip(*batch)
+            increment("upload.batches")
+            increment("upload.images", len(images))
+            try:
+                X = np.stack(images)
+                features = {}
+                for model_name, model in self.models.items():
+                    with timer("upload.inference"):
+                        features[model_name] = np.asarray(model(X))
+            except Exception as e:
+                logging.exception("Failed to featurise a batch of uploaded images")
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            for i, future in enumerate(futures):
+                future.set_result({model_name: X_model[i] for model_name, X_model in features.items()})
@@ -0,0 +1,191 @@
+"""
+Optimised CPU inference for the featuriser models (see `build_featuriser_model` in `FeatureExtraction/featuriser.py`).
+
+    - `configure_cpu_threads` sets TensorFlow's intra/inter-op thread pools - call it before any model is built
+    - `compile_model` traces the model into a graph once (optionally XLA-compiled) instead of running it eagerly
+    - `convert_to_tflite` converts the model with TensorFlow Lite to float16 weights or int8 (dynamic range
+      quantised) weights, wrapped in `TFLiteModel` so it is called just like the Keras model
+    - `tune_batch_size` picks the batch size with the best throughput
+
+Reduced precision changes the features, so `check_feature_agreement` compares the features of an optimised model
+against the float32 reference ones - per-image cosine agreement and overlap of the top-k neighbours within the
+sample - and `validate_model` tells whether they are within tolerance.
+"""
+import time
+import inspect
+import logging
+from typing import Any, Callable, Dict, List, Tuple
+import numpy as np
+import tensorflow as tf
+from utils.similarity import normalise_rows, top_k_cosine
+
+INFERENCE_PRECISIONS = ("float32", "float16", "int8")
+
+
+def configure_cpu_threads(intra_op_threads: int = None, inter_op_threads: int = None) -> None:
+    """
+    :param intra_op_threads: threads used within a single op (eg: a convolution) - None leaves TensorFlow's default
+    :param inter_op_threads: threads used to run independent ops in parallel - None leaves TensorFlow's default
+    """
+    if intra_op_threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads is not None:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+def compile_model(model: tf.keras.Model, xla: bool = False) -> Callable:
+    """
+    :param model: takes a uint8 batch of images
+    :param xla: also compile the graph with XLA
+    :return: the model traced into a graph - the batch size & image size can vary without re-tracing
+    """
+    kwargs = {"input_signature": [tf.TensorSpec([None, None, None, 3], tf.uint8)]}
+    if xla:
+        # renamed from experimental_compile in newer TensorFlow versions
+        use_jit_compile = "jit_compile" in inspect.signature(tf.function).parameters
+        kwargs["jit_compile" if use_jit_compile else "experimental_compile"] = True
+    return tf.function(lambda X: model(X, training=False), **kwargs)
+
+
+class TFLiteModel:
+    """
+    Runs a TensorFlow Lite model with the same interface as the Keras featuriser models
+    """
+
+    def __init__(self, model_content: bytes, n_threads: int = None):
+        try:
+            self.interpreter = tf.lite.Interpreter(model_content=model_content, num_threads=n_threads)
+        except TypeError: # older TensorFlow versions have no num_threads
+            self.interpreter = tf.lite.Interpreter(model_content=model_content)
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.input_shape = None
+
+    def __call__(self, X: np.ndarray) -> np.ndarray:
+        X = np.asarray(X, dtype=np.uint8)
+        if self.input_shape != X.shape:
+            self.interpreter.resize_tensor_input(self.input_index, X.shape)
+            self.interpreter.allocate_tensors()
+            self.input_shape = X.shape
+        self.interpreter.set_tensor(self.input_index, X)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index).copy()
+
+
+def convert_to_tflite(model: tf.keras.Model, precision: str, n_threads: int = None) -> TFLiteModel:
+    """
+    :param model: takes a uint8 batch of images
+    :param precision: "float16" stores the weights as float16, "int8" quantises the weights to int8 (activations are
+                      quantised on the fly) - "float32" converts the model as it is
+    :param n_threads: threads used by the TensorFlow Lite interpreter
+    :return:
+    """
+    assert precision in INFERENCE_PRECISIONS, f"precision must be one of {INFERENCE_PRECISIONS}"
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if precision != "float32":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if precision == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    return TFLiteModel(converter.convert(), n_threads)
+
+
+def optimise_model(model: tf.keras.Model, precision: str = "float32", xla: bool = False, n_threads: int = None)\
+        -> Callable:
+    """
+    :param model: takes a uint8 batch of images
+    :param precision: "float32" compiles the model into a graph, "float16"/"int8" convert it with TensorFlow Lite
+    :param xla: see `compile_model`
+    :param n_threads: see `convert_to_tflite`
+    :return: a callable taking a uint8 batch of images
+    """
+    if precision == "float32":
+        return compile_model(model, xla)
+    return convert_to_tflite(model, precision, n_threads)
+
+
+def measure_throughput(model: Callable, batch_size: int, target_size: Tuple[int, int] = (256, 256)
+                       , n_batches: int = 3, seed: int = 0) -> float:
+    """
+    :return: images/sec of `model` on random images, after one warm-up batch
+    """
+    X = np.random.default_rng(seed).integers(0, 256, (batch_size, target_size[1], target_size[0], 3), dtype=np.uint8)
+    np.asarray(model(X))
+    start = time.perf_counter()
+    for _ in range(n_batches):
+        np.asarray(model(X))
+    return batch_size * n_batches / (time.perf_counter() - start)
+
+
+def tune_batch_size(models: Dict[str, Callable], candidate_sizes: List[int], target_size: Tuple[int, int] = (256, 256))\
+        -> int:
+    """
+    :param models: {model_name: model} - every batch is fed to all of them, as in `get_bottleneck_features_multi`
+    :param candidate_sizes:
+    :param target_size:
+    :return: the candidate batch size with the highest throughput
+    """
+    def run_all(X):
+        return [np.asarray(model(X)) for model in models.values()]
+
+    throughputs = {}
+    for batch_size in candidate_sizes:
+        throughputs[batch_size] = measure_throughput(run_all, batch_size, target_size)
+        logging.info(f"batch size {batch_size}: {throughputs[batch_size]:,.1f} images/sec")
+    return max(throughputs, key=throughputs.get)
+
+
+def get_sample_neighbours(X_norm: np.ndarray, k: int) -> np.ndarray:
+    """
+    :param X_norm: (n_images, n_features) normalised features
+    :param k: at most n_images - 1
+    :return: (n_images, k) top-k neighbours of each image within the sample - other than the image itself
+    """
+    # the top k+1 always include the k best neighbours other than the row itself (as in `utils.all_pairs`)
+    indices = top_k_cosine(X_norm, X_norm, k + 1)[0]
+    keep = indices != np.arange(X_norm.shape[0])[:, None]
+    keep &= np.cumsum(keep, axis=1) <= k
+    return indices[keep].reshape(X_norm.shape[0], k)
+
+
+def check_feature_agreement(reference: np.ndarray, candidate: np.ndarray, k: int = 10) -> Dict[str, float]:
+    """
+    :param reference: (n_images, n_features) features of the float32 reference model
+    :param candidate: features of the same images from the optimised model
+    :param k:
+    :return: {"mean_cosine", "min_cosine", "topk_overlap"} - cosine similarity of each image's candidate & reference
+             features, and the overlap of each image's top-k neighbours (within the sample, not counting the image
+             itself) under both
+    """
+    reference, candidate = normalise_rows(reference), normalise_rows(candidate)
+    cosine = np.sum(reference * candidate, axis=1)
+
+    k = min(k, reference.shape[0] - 1)
+    if k < 1:
+        overlap = 1.0 # a single image has no neighbours to compare
+    else:
+        reference_topk = get_sample_neighbours(reference, k)
+        candidate_topk = get_sample_neighbours(candidate, k)
+        overlap = np.mean([len(np.intersect1d(r, c)) / k for r, c in zip(reference_topk, candidate_topk)])
+
+    return {"mean_cosine": float(cosine.mean()), "min_cosine": float(cosine.min()), "topk_overlap": float(overlap)}
+
+
+def validate_model(reference_model: Any, candidate_model: Callable, images: np.ndarray, k: int = 10
+                   , min_cosine: float = 0.99, min_topk_overlap: float = 0.9, batch_size: int = 32)\
+        -> Tuple[bool, Dict[str, float]]:
+    """
+    :param reference_model: the float32 Keras model
+    :param candidate_model: its optimised version
+    :param images: uint8 batch of sample images
+    :param k:
+    :param min_cosine: every image's features must have at least this cosine similarity to the reference ones
+    :param min_topk_overlap: mean top-k overlap required
+    :param batch_size: the sample is fed to the models in batches of this many images
+    :return: (whether the candidate is within tolerance, `check_feature_agreement` report)
+    """
+    def featurise(model):
+        return np.concatenate([np.asarray(model(images[i:i + batch_size]))
+                               for i in range(0, len(images), batch_size)])
+
+    report = check_feature_agreement(featurise(reference_model), featurise(candidate_model), k)
+    return report["min_cosine"] >= min_cosine and report["topk_overlap"] >= min_topk_overlap, report
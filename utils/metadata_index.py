@@ -0,0 +1,159 @@
+"""
+Metadata of the items of a feature set and the indexes used to filter similarity searches by it.
+
+Every item has the metadata columns
+    filename        - from the feature set's (filename, territory_name) index
+    territory_name
+    variant         - the part of the filename in brackets eg: "civil" for Flag_of_Belgium_(civil).jpg, "" if none
+plus the columns of the optional tab-separated metadata files next to the feature file - `metadata.tsv` shared by
+all the feature sets in the folder and `<name>.metadata.tsv` of a single feature set (whose columns take precedence),
+each with a `filename` column and one column per attribute (items missing from them get "").
+
+`MetadataIndex` pre-computes, for every column,
+    - a packed bitmap of the rows holding each value, for columns with at most `MAX_BITMAP_VALUES` distinct values
+    - an inverted index (the rows holding each value) for the other columns
+    - the values in sorted order, so the rows of a prefix are a contiguous range found by binary search
+so that a filter is turned into a row mask without scanning the metadata, and the mask is applied inside the top-k
+selection of the search rather than to its results.
+
+Filters are (column, op, value) triples which must all hold - op is one of
+    "==", "!="                   value is a string, or a list of strings to match any of
+    "prefix", "not prefix"       value is a string
+eg: [("variant", "==", ""), ("territory_name", "!=", "France")] only keeps the main flag of each territory other than
+France.
+"""
+import os
+import re
+from typing import List, Optional, Sequence, Tuple, Union
+import numpy as np
+import pandas as pd
+
+METADATA_EXT = ".metadata.tsv"
+SHARED_METADATA_FNAME = "metadata.tsv"
+MAX_BITMAP_VALUES = 256
+FILTER_OPS = ("==", "!=", "prefix", "not prefix")
+# textual form of the ops used by `parse_filter` - longest first so that "!^=" isn't read as "!="
+FILTER_OP_SYMBOLS = {"!^=": "not prefix", "^=": "prefix", "!=": "!=", "==": "=="}
+VARIANT_PATTERN = re.compile(r"_\(([^)]*)\)")
+
+Filter = Tuple[str, str, Union[str, Sequence[str]]]
+
+
+def get_metadata_fpath(feature_fpath: str) -> str:
+    return os.path.splitext(feature_fpath)[0] + METADATA_EXT
+
+
+def get_variant(filename: str) -> str:
+    match = VARIANT_PATTERN.search(filename)
+    return "" if match is None else match.group(1)
+
+
+def load_metadata(feature_fpath: str, pd_index: pd.MultiIndex) -> pd.DataFrame:
+    """
+    :param feature_fpath: csv file or feature-store the items were loaded from
+    :param pd_index: the (filename, territory_name) index of the feature set
+    :return: one row of metadata (all strings) per item, in the same order as `pd_index`
+    """
+    metadata_df = pd_index.to_frame(index=False)
+    metadata_df["variant"] = metadata_df["filename"].map(get_variant)
+
+    for metadata_fpath in (get_metadata_fpath(feature_fpath)
+                           , os.path.join(os.path.dirname(feature_fpath), SHARED_METADATA_FNAME)):
+        if not os.path.exists(metadata_fpath):
+            continue
+        sidecar_df = pd.read_csv(metadata_fpath, sep="\t", dtype=str, keep_default_na=False)
+        sidecar_df = sidecar_df.drop(columns=[c for c in metadata_df.columns if c != "filename"], errors="ignore")
+        metadata_df = metadata_df.merge(sidecar_df.drop_duplicates("filename"), on="filename", how="left")
+    return metadata_df.fillna("")
+
+
+def parse_filter(text: str) -> Filter:
+    """
+    Parses the textual form of a filter eg: "variant==" , "territory_name!=France", "continent==Europe|Asia" or
+    "territory_name^=United" (prefix) - used by the app's search API
+    """
+    for symbol, op in FILTER_OP_SYMBOLS.items():
+        if symbol in text:
+            column, value = text.split(symbol, 1)
+            return column, op, value.split("|") if "|" in value else value
+    raise ValueError(f"filter {text!r} has none of the ops {list(FILTER_OP_SYMBOLS.keys())}")
+
+
+class MetadataIndex:
+    def __init__(self, metadata_df: pd.DataFrame, max_bitmap_values: int = MAX_BITMAP_VALUES):
+        """
+        :param metadata_df: see `load_metadata`
+        :param max_bitmap_values: columns with more distinct values than this get an inverted index instead of bitmaps
+        """
+        self.n_items = metadata_df.shape[0]
+        self.columns = list(metadata_df.columns)
+        self.bitmaps = {} # {column: {value: packed bitmap of its rows}}
+        self.inverted = {} # {column: ({value: position}, rows sorted by value, offsets of each value's rows)}
+        self.sorted_values = {} # {column: (values sorted, the row of each sorted value)}
+
+        for column in self.columns:
+            values = metadata_df[column].astype(str).values
+            codes, uniques = pd.factorize(values)
+            if len(uniques) <= max_bitmap_values:
+                self.bitmaps[column] = {value: np.packbits(codes == code) for code, value in enumerate(uniques)}
+            else:
+                rows = np.argsort(codes, kind="stable").astype(np.int32)
+                offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(uniques)))])
+                self.inverted[column] = ({value: code for code, value in enumerate(uniques)}, rows, offsets)
+
+            order = np.argsort(values, kind="stable").astype(np.int32)
+            self.sorted_values[column] = (values[order].astype(str), order)
+
+    def get_value_mask(self, column: str, value: str) -> np.ndarray:
+        """
+        :return: bool mask of the rows where `column` equals `value`
+        """
+        if column in self.bitmaps:
+            bitmap = self.bitmaps[column].get(value)
+            if bitmap is None:
+                return np.zeros(self.n_items, dtype=bool)
+            return np.unpackbits(bitmap, count=self.n_items).view(bool)
+
+        positions, rows, offsets = self.inverted[column]
+        mask = np.zeros(self.n_items, dtype=bool)
+        if value in positions:
+            code = positions[value]
+            mask[rows[offsets[code]:offsets[code + 1]]] = True
+        return mask
+
+    def get_prefix_mask(self, column: str, prefix: str) -> np.ndarray:
+        """
+        :return: bool mask of the rows where `column` starts with `prefix`
+        """
+        values, order = self.sorted_values[column]
+        start = np.searchsorted(values, prefix, side="left")
+        stop = np.searchsorted(values, prefix + "\U0010ffff", side="left")
+        mask = np.zeros(self.n_items, dtype=bool)
+        mask[order[start:stop]] = True
+        return mask
+
+    def get_mask(self, filters: Optional[List[Filter]]) -> Optional[np.ndarray]:
+        """
+        :param filters: see the module's docstring
+        :return: bool mask of the rows passing all the filters - None if there are no filters
+        """
+        if not filters:
+            return None
+
+        mask = np.ones(self.n_items, dtype=bool)
+        for column, op, value in filters:
+            assert column in self.columns, f"unknown metadata column {column!r} - one of {self.columns}"
+            assert op in FILTER_OPS, f"filter op must be one of {FILTER_OPS}"
+            if op in ("==", "!="):
+                values = [value] if isinstance(value, str) else value
+                column_mask = np.zeros(self.n_items, dtype=bool)
+                for v in values:
+                    column_mask |= self.get_value_mask(column, str(v))
+            else:
+                column_mask = self.get_prefix_mask(column, str(value))
+
+            if op.startswith("!") or op.startswith("not"):
+                mask &= ~column_mask
+            else:
+                mask &= column_mask
+        return mask
@@ -0,0 +1,226 @@
+"""
+Lightweight stage-level instrumentation shared by the featuriser and the app.
+
+Stages are timed with `timer` (a context manager) or `timed` (a decorator) and events are counted with `increment`:
+
+    with timer("search.kneighbors"):
+        ...
+
+    @timed("render.grid")
+    def get_image_grid(...):
+
+Everything is recorded on the module-level `METRICS` registry, which keeps a count, total and the most recent samples
+of each stage so `snapshot` can report percentiles. When metrics are disabled - the default unless the
+FLAG_SIMILARITY_METRICS environment variable is set to 1, see `enable`/`disable` - timers do nothing beyond checking
+a flag, so they can stay in the hot paths.
+
+`SamplingProfiler` is an opt-in sampling profiler: a background thread periodically records the Python stack of every
+other thread, and the samples are written out as collapsed stacks which flame graph tools read directly.
+"""
+import os
+import sys
+import time
+import threading
+import functools
+from collections import deque, Counter
+from typing import Callable, Dict, List, Tuple
+import numpy as np
+import pandas as pd
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer:
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics: "Metrics", stage: str):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    def __init__(self, enabled: bool = False, max_samples: int = 1024):
+        """
+        :param enabled:
+        :param max_samples: number of most recent samples kept per stage for the percentiles
+        """
+        self.enabled = enabled
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counts = Counter()
+            self.totals = Counter()
+            self.samples = {}
+            self.counters = Counter()
+            self.start_time = time.time()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self.lock:
+            self.counts[stage] += 1
+            self.totals[stage] += seconds
+            if stage not in self.samples:
+                self.samples[stage] = deque(maxlen=self.max_samples)
+            self.samples[stage].append(seconds)
+
+    def timer(self, stage: str):
+        """
+        :param stage:
+        :return: context manager that records how long its block took under `stage`
+        """
+        return Timer(self, stage) if self.enabled else NULL_TIMER
+
+    def timed(self, stage: str) -> Callable:
+        """
+        :param stage:
+        :return: decorator that records how long each call of the decorated function took under `stage`
+        """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def increment(self, counter: str, n: int = 1) -> None:
+        if self.enabled:
+            with self.lock:
+                self.counters[counter] += n
+
+    def snapshot(self) -> Dict:
+        """
+        :return: {"uptime_seconds", "stages": {stage: {"count", "total_ms", "mean_ms", "p50_ms", "p99_ms", "max_ms"}},
+                  "counters": {counter: count}} - percentiles & max are over the most recent samples
+        """
+        with self.lock:
+            stages = {}
+            for stage, samples in self.samples.items():
+                recent_ms = 1000 * np.asarray(samples)
+                stages[stage] = {"count": self.counts[stage], "total_ms": 1000 * self.totals[stage]
+                                 , "mean_ms": 1000 * self.totals[stage] / self.counts[stage]
+                                 , "p50_ms": float(np.percentile(recent_ms, 50))
+                                 , "p99_ms": float(np.percentile(recent_ms, 99)), "max_ms": float(recent_ms.max())}
+            return {"uptime_seconds": time.time() - self.start_time, "stages": stages
+                    , "counters": dict(self.counters)}
+
+    def summary(self) -> str:
+        """
+        :return: a table of the stages (slowest in total first) followed by the counters
+        """
+        snapshot = self.snapshot()
+        if not snapshot["stages"] and not snapshot["counters"]:
+            return "no metrics recorded"
+
+        lines = []
+        if snapshot["stages"]:
+            stages = pd.DataFrame.from_dict(snapshot["stages"], orient="index").sort_values("total_ms"
+                                                                                          , ascending=False)
+            lines.append(stages.to_string(float_format=lambda x: f"{x:,.2f}"))
+        lines.extend(f"{counter}: {count:,}" for counter, count in sorted(snapshot["counters"].items()))
+        return "\n".join(lines)
+
+
+METRICS = Metrics(enabled=os.environ.get("FLAG_SIMILARITY_METRICS", "0") == "1")
+timer = METRICS.timer
+timed = METRICS.timed
+increment = METRICS.increment
+
+
+def enable() -> None:
+    METRICS.enabled = True
+
+
+def disable() -> None:
+    METRICS.enabled = False
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.005):
+        """
+        :param interval: seconds between samples
+        """
+        self.interval = interval
+        self.stacks = Counter()
+        self.n_samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def sample(self) -> None:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == threading.get_ident():
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+        self.n_samples += 1
+
+    def run(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self) -> "SamplingProfiler":
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> "SamplingProfiler":
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def top(self, n: int = 20) -> List[Tuple[str, int]]:
+        """
+        :param n:
+        :return: the `n` functions that were on top of the stack most often, with their sample counts
+        """
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return leaves.most_common(n)
+
+    def collapsed_stacks(self) -> str:
+        """
+        :return: one "frame;frame;...;frame count" line per distinct stack (the format flame graph tools read)
+        """
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def save(self, fpath: str) -> None:
+        with open(fpath, "w") as f:
+            f.write(self.collapsed_stacks())
@@ -0,0 +1,111 @@
+"""
+Publish read-only arrays to a folder once so that many processes can memory-map them instead of each holding its own
+copy - eg: several app worker processes serving searches over the same feature matrices.
+
+Every publish writes the arrays as .npy files, along with a `published.json` describing them, into a new version
+folder inside the publish folder and then atomically replaces the `CURRENT` pointer file naming the version to
+attach to. Attaching reads the pointer once and loads everything from that version, so an attach racing a publish
+sees either the old or the new version in full. The previous version is kept so attaches that read the pointer just
+before it moved on can still finish - any other versions (older ones or those of interrupted publishes) are removed.
+
+Put the folder on a RAM-backed filesystem (eg: /dev/shm on Linux) to keep the pages in shared memory - the OS page
+cache shares them across processes either way, so memory stays flat as workers are added and attaching is
+near-instant.
+"""
+import os
+import json
+import time
+import shutil
+import logging
+from glob import glob
+from typing import Dict, Optional, Tuple
+import numpy as np
+import pandas as pd
+from utils.feature_store import save_index, load_index
+
+METADATA_FILENAME = "published.json"
+POINTER_FILENAME = "CURRENT"
+VERSION_PREFIX = "v"
+PARTIAL_EXT = ".part"
+
+
+def get_current_version_dir(publish_dir: str) -> Optional[str]:
+    """
+    :return: the folder of the version the pointer file currently names - None if nothing was published
+    """
+    pointer_fpath = os.path.join(publish_dir, POINTER_FILENAME)
+    if not os.path.exists(pointer_fpath):
+        return None
+    with open(pointer_fpath) as f:
+        return os.path.join(publish_dir, f.read().strip())
+
+
+def is_published(publish_dir: str) -> bool:
+    return get_current_version_dir(publish_dir) is not None
+
+
+def publish_arrays(publish_dir: str, arrays: Dict[str, np.ndarray], indexes: Dict[str, pd.MultiIndex]
+                   , metadata: dict) -> None:
+    """
+    Writes the arrays & indexes into a new version folder of `publish_dir` and points `publish_dir` at it, replacing
+    whatever was published there before - processes attaching at the same time never see a half-written version.
+    :param publish_dir:
+    :param arrays: {name: array}
+    :param indexes: {name: (filename, territory_name) index}
+    :param metadata: any json-serialisable information the attaching processes need
+    :return:
+    """
+    version = f"{VERSION_PREFIX}{time.time_ns()}"
+    version_dir = os.path.join(publish_dir, version)
+    os.makedirs(version_dir)
+
+    for name, X in arrays.items():
+        np.save(os.path.join(version_dir, f"{name}.npy"), np.ascontiguousarray(X), allow_pickle=False)
+    for name, pd_index in indexes.items():
+        save_index(pd_index, os.path.join(version_dir, f"{name}.index.tsv"))
+
+    with open(os.path.join(version_dir, METADATA_FILENAME), "w") as f:
+        json.dump({**metadata, "arrays": list(arrays.keys()), "indexes": list(indexes.keys())}, f, indent=2)
+
+    previous_dir = get_current_version_dir(publish_dir)
+    pointer_fpath = os.path.join(publish_dir, POINTER_FILENAME)
+    with open(pointer_fpath + PARTIAL_EXT, "w") as f:
+        f.write(version)
+    os.replace(pointer_fpath + PARTIAL_EXT, pointer_fpath)
+
+    # processes that already attached keep their memory-maps of the old files - they stay valid until closed (on
+    # Windows the files of an attached version can't be removed yet, so they are left for a later publish)
+    for old_dir in glob(os.path.join(publish_dir, f"{VERSION_PREFIX}*")):
+        if old_dir not in (version_dir, previous_dir):
+            shutil.rmtree(old_dir, ignore_errors=True)
+    logging.info(f"Published {len(arrays):,} arrays and {len(indexes):,} indexes to {version_dir}")
+
+
+def attach_arrays(publish_dir: str, max_attempts: int = 3) -> Tuple[Dict[str, np.ndarray], Dict[str, pd.MultiIndex], dict]:
+    """
+    Memory-maps (read-only) the version currently published to `publish_dir`
+    :param publish_dir:
+    :param max_attempts: a version can be removed while it's being attached to when it's published over twice in the
+                         meantime - the attach is then retried with the latest version
+    :return: (arrays, indexes, metadata)
+    """
+    for attempt in range(1, max_attempts + 1):
+        version_dir = get_current_version_dir(publish_dir)
+        if version_dir is None:
+            raise FileNotFoundError(f"nothing has been published to {publish_dir}")
+        try:
+            return attach_version(version_dir)
+        except FileNotFoundError:
+            if attempt == max_attempts or get_current_version_dir(publish_dir) == version_dir:
+                raise
+            logging.info(f"{version_dir} was removed while attaching to it - attaching to the latest version")
+
+
+def attach_version(version_dir: str) -> Tuple[Dict[str, np.ndarray], Dict[str, pd.MultiIndex], dict]:
+    with open(os.path.join(version_dir, METADATA_FILENAME)) as f:
+        metadata = json.load(f)
+
+    arrays = {name: np.load(os.path.join(version_dir, f"{name}.npy"), mmap_mode="r", allow_pickle=False)
+              for name in metadata["arrays"]}
+    indexes = {name: load_index(os.path.join(version_dir, f"{name}.index.tsv")) for name in metadata["indexes"]}
+    return arrays, indexes, metadata
@@ -0,0 +1,206 @@
+"""
+Helpers for cosine similarity searches that never materialise the full N x N similarity matrix.
+
+The features are L2-normalised once so that cosine similarity becomes a plain dot-product, the dot-products are then
+computed one (row-block x column-block) tile at a time and only the top-k scores of each row are kept. Blocks of
+vectors that have to be copied to be scored - gathered rows, or compressed (float16/int8) codes upcast to float32 -
+are also bounded in bytes, so searching compressed codes never holds more than a block of them decoded.
+"""
+from typing import Tuple
+import numpy as np
+
+# max number of similarity scores held in memory at any one time (~256MB of float32)
+TILE_SIZE = 2**26
+# max bytes of vectors gathered or decoded to float32 at any one time
+TILE_BYTES = 2**26
+# masks selecting less than this fraction of the items are searched by gathering the selected items tile by tile
+GATHER_FRACTION = 0.25
+
+
+def normalise_rows(X: np.ndarray, dtype=np.float32) -> np.ndarray:
+    """
+    L2-normalises each row of X - rows with zero norm are left as zeros
+    :param X:
+    :param dtype:
+    :return: a new (contiguous) array
+    """
+    X = np.array(X, dtype=dtype, order="C")
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    X /= norms
+    return X
+
+
+def is_float(X: np.ndarray) -> bool:
+    return X.dtype in (np.float32, np.float64)
+
+
+def as_float(X: np.ndarray) -> np.ndarray:
+    """
+    Upcasts compressed (float16/int8) matrices to float32 so that matrix products go through BLAS and can't overflow
+    - float32/float64 matrices are returned as they are
+    """
+    return X if is_float(X) else X.astype(np.float32)
+
+
+def get_block_rows(X: np.ndarray, tile_bytes: int = TILE_BYTES) -> int:
+    """
+    :return: number of rows of X whose float copy (see `as_float`) fits in `tile_bytes`
+    """
+    return max(1, tile_bytes // (max(X.shape[1], 1) * max(X.dtype.itemsize, 4)))
+
+
+def score_rows(X: np.ndarray, rows: np.ndarray, q: np.ndarray, tile_bytes: int = TILE_BYTES) -> np.ndarray:
+    """
+    Scores the given rows of X against a single query - the rows are gathered (and decoded) a block at a time
+    :param X: (n_items, n_features) normalised item vectors (or codes)
+    :param rows: rows of X to score
+    :param q: (n_features, ) normalised query vector in the same space as X
+    :param tile_bytes: see `get_block_rows`
+    :return: float32 scores of shape (len(rows), )
+    """
+    q = as_float(q)
+    block_rows = get_block_rows(X, tile_bytes)
+    return np.concatenate([(as_float(X[rows[r0:r0 + block_rows]]) @ q).astype(np.float32, copy=False)
+                           for r0 in range(0, len(rows), block_rows)] or [np.empty(0, dtype=np.float32)])
+
+
+def sort_top_k(scores: np.ndarray, indices: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Selects the top-k scores of each row with a partial sort, the selected scores are then fully sorted in
+    descending order - ties are broken by the lower index.
+    :param scores: (n_rows, n_candidates) scores
+    :param indices: (n_rows, n_candidates) item indices that the scores belong to
+    :param k:
+    :return: (indices, scores) both of shape (n_rows, min(k, n_candidates))
+    """
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        indices = np.take_along_axis(indices, part, axis=1)
+
+    order = np.lexsort((indices, -scores), axis=1)
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+def top_k_cosine(Q: np.ndarray, X: np.ndarray, k: int, tile_size: int = TILE_SIZE, rows: np.ndarray = None
+                 , mask: np.ndarray = None, tile_bytes: int = TILE_BYTES) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the k most similar rows of X for each row of Q using blocked matrix products.
+    Both Q and X must already be L2-normalised (see `normalise_rows`) - or be compressed codes in the same code space
+    (see `utils.compression.FeatureCodec`) in which case the scores are in code units.
+
+    Memory is bounded by `tile_size` similarity scores (plus `tile_bytes` of gathered/decoded vectors) regardless of
+    how many rows Q or X have.
+    :param Q: (n_queries, n_features) normalised query vectors
+    :param X: (n_items, n_features) normalised item vectors
+    :param k:
+    :param tile_size:
+    :param rows: only search these rows of X - they are gathered one tile at a time
+    :param mask: bool mask of the rows of X that can be returned - the others score -inf, so k should be at most
+                 the number of rows the mask selects (see `masked_top_k_cosine`)
+    :param tile_bytes: max bytes of the blocks of Q and X that have to be copied to be scored
+    :return: (indices, scores) - int32 and float32 arrays of shape (n_queries, k), sorted by decreasing similarity
+    """
+    n_queries, n_items = Q.shape[0], X.shape[0] if rows is None else len(rows)
+    k = min(k, n_items)
+    if k == 0:
+        return np.empty((n_queries, 0), dtype=np.int32), np.empty((n_queries, 0), dtype=np.float32)
+
+    # pick the column block first so that a single row can always see the whole of X when it fits in a tile - unless
+    # the blocks of X are copies (gathered or decoded) in which case they're bounded by bytes too
+    col_block = max(k, min(n_items, tile_size))
+    if rows is not None or not is_float(X):
+        col_block = min(col_block, max(k, get_block_rows(X, tile_bytes)))
+    row_block = max(1, tile_size // col_block)
+    if not is_float(Q):
+        row_block = min(row_block, get_block_rows(Q, tile_bytes))
+
+    top_indices = np.empty((n_queries, k), dtype=np.int32)
+    top_scores = np.empty((n_queries, k), dtype=np.float32)
+
+    for r0 in range(0, n_queries, row_block):
+        Q_block = as_float(Q[r0:r0 + row_block])
+        best_indices = np.empty((Q_block.shape[0], 0), dtype=np.int32)
+        best_scores = np.empty((Q_block.shape[0], 0), dtype=np.float32)
+
+        for c0 in range(0, n_items, col_block):
+            if rows is None:
+                X_block = X[c0:c0 + col_block]
+                tile_indices = np.arange(c0, c0 + X_block.shape[0], dtype=np.int32)
+            else:
+                tile_indices = rows[c0:c0 + col_block].astype(np.int32)
+                X_block = X[tile_indices]
+            scores = (Q_block @ as_float(X_block).T).astype(np.float32, copy=False)
+            if mask is not None:
+                scores = np.where(mask[tile_indices], scores, np.float32(-np.inf))
+            indices = np.broadcast_to(tile_indices, scores.shape)
+
+            # merge this tile's candidates with the best ones seen so far
+            best_indices, best_scores = sort_top_k(np.hstack([best_scores, scores])
+                                                   , np.hstack([best_indices, indices]), k)
+
+        top_indices[r0:r0 + row_block] = best_indices
+        top_scores[r0:r0 + row_block] = best_scores
+
+    return top_indices, top_scores
+
+
+def masked_top_k_cosine(Q: np.ndarray, X: np.ndarray, k: int, mask: np.ndarray, tile_size: int = TILE_SIZE)\
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    `top_k_cosine` over the rows of X selected by `mask` - selective masks only score the selected rows, the others
+    score every row and drop the unselected ones inside each tile's top-k selection
+    :return: (indices, scores) of shape (n_queries, min(k, number of selected rows))
+    """
+    rows = np.flatnonzero(mask)
+    k = min(k, len(rows))
+    if len(rows) < GATHER_FRACTION * X.shape[0]:
+        return top_k_cosine(Q, X, k, tile_size, rows=rows)
+    return top_k_cosine(Q, X, k, tile_size, mask=mask)
+
+
+def update_top_k_cosine(X: np.ndarray, top_indices: np.ndarray, top_scores: np.ndarray, kept_rows: np.ndarray
+                        , k: int, tile_size: int = TILE_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Updates a top-k table (as returned by `top_k_cosine(X_old, X_old, k)`) after items have been removed and/or
+    appended, without recomputing it from scratch:
+        - kept items whose top-k are all still there only need to be compared against the appended items
+        - kept items that lost one of their top-k, and the appended items, are searched against every item
+    :param X: the new normalised feature matrix - the kept items (in their original order) followed by the
+              appended ones
+    :param top_indices: the old top-k table
+    :param top_scores:
+    :param kept_rows: row positions (in the old feature matrix) of the items that were kept
+    :param k:
+    :param tile_size:
+    :return: (indices, scores) - the top-k table of X
+    """
+    n_kept, n_items = len(kept_rows), X.shape[0]
+    k = min(k, n_items)
+
+    # position of each old item in the new feature matrix (-1 if it was removed)
+    remap = np.full(top_indices.shape[0], -1, dtype=np.int32)
+    remap[kept_rows] = np.arange(n_kept, dtype=np.int32)
+    kept_indices, kept_scores = remap[top_indices[kept_rows]], top_scores[kept_rows]
+
+    new_indices = np.empty((n_items, k), dtype=np.int32)
+    new_scores = np.empty((n_items, k), dtype=np.float32)
+
+    stale = (kept_indices < 0).any(axis=1) | (kept_indices.shape[1] < k)
+    fresh_rows = np.concatenate([np.flatnonzero(stale), np.arange(n_kept, n_items)])
+    if len(fresh_rows):
+        new_indices[fresh_rows], new_scores[fresh_rows] = top_k_cosine(X[fresh_rows], X, k, tile_size)
+
+    valid_rows = np.flatnonzero(~stale)
+    if len(valid_rows) and n_items > n_kept:
+        added_indices, added_scores = top_k_cosine(X[valid_rows], X[n_kept:], k, tile_size)
+        new_indices[valid_rows], new_scores[valid_rows] = sort_top_k(
+            np.hstack([kept_scores[valid_rows], added_scores]), np.hstack([kept_indices[valid_rows]
+                                                                           , added_indices + n_kept]), k)
+    elif len(valid_rows):
+        new_indices[valid_rows] = kept_indices[valid_rows, :k]
+        new_scores[valid_rows] = kept_scores[valid_rows, :k]
+
+    return new_indices, new_scores
@@ -0,0 +1,135 @@
+"""
+Packed thumbnail archive - all the thumbnails of one size in a single file so the renderer memory-maps one file
+instead of opening a file per thumbnail.
+
+An archive is a single file, thumbnails_<size>.bin, laid out as:
+    the encoded (jpg) thumbnails concatenated into one blob
+    a tab-separated index holding the (filename, offset, n_bytes) of each thumbnail
+    a fixed size footer - ARCHIVE_MAGIC followed by the offset and the length of the index
+The index travels in the same file as the blob so an archive is replaced with a single rename and a reader never
+pairs a new blob with an old index.
+
+The archives are written by `Visualisation/resize_images.py` and read by `get_image_grid` in
+`Visualisation/viz_utils.py`.
+"""
+import os
+import csv
+import struct
+from io import BytesIO, StringIO
+from typing import Iterable, List, Tuple
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+ARCHIVE_EXT = ".bin"
+ARCHIVE_INDEX_COLUMNS = ["filename", "offset", "n_bytes"]
+ARCHIVE_MAGIC = b"FLAGTHB1"
+ARCHIVE_FOOTER = struct.Struct("<8sQQ") # magic, index offset, index n_bytes
+PARTIAL_EXT = ".part"
+
+
+def get_thumbnail_archive_fpath(thumbnail_dir: str, size: int) -> str:
+    return os.path.join(thumbnail_dir, f"thumbnails_{size}{ARCHIVE_EXT}")
+
+
+def read_archive_footer(archive_fpath: str) -> Tuple[int, int]:
+    """
+    :param archive_fpath: path to the .bin file of the archive
+    :return: (offset, n_bytes) of the index - raises ValueError if the file isn't an archive in this format
+    """
+    with open(archive_fpath, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() < ARCHIVE_FOOTER.size:
+            raise ValueError(f"{archive_fpath} is too short to be a thumbnail archive")
+        f.seek(-ARCHIVE_FOOTER.size, os.SEEK_END)
+        magic, index_offset, index_n_bytes = ARCHIVE_FOOTER.unpack(f.read(ARCHIVE_FOOTER.size))
+    if magic != ARCHIVE_MAGIC:
+        raise ValueError(f"{archive_fpath} is not a thumbnail archive - repack it with resize_images.py")
+    return index_offset, index_n_bytes
+
+
+def is_thumbnail_archive(archive_fpath: str) -> bool:
+    """
+    :return: True if `archive_fpath` exists and is an archive in the current format
+    """
+    try:
+        read_archive_footer(archive_fpath)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def write_thumbnail_archive(archive_fpath: str, thumbnails: Iterable[Tuple[str, bytes]]) -> str:
+    """
+    Writes an archive under a temporary name and then renames it into place, so a renderer that has the previous
+    archive memory-mapped keeps reading a consistent copy of it
+    :param archive_fpath: path to the .bin file of the archive
+    :param thumbnails: (filename, encoded thumbnail) pairs
+    :return: archive_fpath
+    """
+    offset = 0
+    index_buffer = StringIO()
+    writer = csv.writer(index_buffer, delimiter="\t", lineterminator="\n")
+    writer.writerow(ARCHIVE_INDEX_COLUMNS)
+    with open(archive_fpath + PARTIAL_EXT, "wb") as blob_file:
+        for filename, thumbnail_bytes in thumbnails:
+            blob_file.write(thumbnail_bytes)
+            writer.writerow([filename, offset, len(thumbnail_bytes)])
+            offset += len(thumbnail_bytes)
+        index_bytes = index_buffer.getvalue().encode("utf-8")
+        blob_file.write(index_bytes)
+        blob_file.write(ARCHIVE_FOOTER.pack(ARCHIVE_MAGIC, offset, len(index_bytes)))
+
+    os.replace(archive_fpath + PARTIAL_EXT, archive_fpath)
+    return archive_fpath
+
+
+def pack_thumbnail_archive(img_fpaths: List[str], archive_fpath: str) -> str:
+    """
+    Packs already encoded thumbnail files into an archive, keyed by their filenames
+    :param img_fpaths:
+    :param archive_fpath: path to the .bin file of the archive
+    :return: archive_fpath
+    """
+    def read_thumbnails():
+        for img_fpath in img_fpaths:
+            with open(img_fpath, "rb") as f:
+                yield os.path.basename(img_fpath), f.read()
+
+    return write_thumbnail_archive(archive_fpath, read_thumbnails())
+
+
+class ThumbnailArchive:
+    def __init__(self, archive_fpath: str):
+        """
+        :param archive_fpath: path to the .bin file of the archive
+        """
+        self.archive_fpath = archive_fpath
+        index_offset, index_n_bytes = read_archive_footer(archive_fpath)
+        # the footer is always there, so the file is never empty and can always be memory-mapped
+        self.blob = np.memmap(archive_fpath, dtype=np.uint8, mode="r")
+        index_df = pd.read_csv(BytesIO(self.blob[index_offset:index_offset + index_n_bytes].tobytes()), sep="\t"
+                               , dtype={"filename": str}, keep_default_na=False)
+        self.index = {filename: (offset, n_bytes)
+                      for filename, offset, n_bytes in index_df[ARCHIVE_INDEX_COLUMNS].itertuples(index=False)}
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.index
+
+    def get_bytes(self, filename: str) -> memoryview:
+        """
+        :return: the encoded thumbnail - a view of the memory-map, nothing is copied
+        """
+        offset, n_bytes = self.index[filename]
+        return memoryview(self.blob[offset:offset + n_bytes])
+
+    def open_image(self, filename: str) -> Image:
+        """
+        :return: the decoded thumbnail
+        """
+        with Image.open(BytesIO(self.get_bytes(filename))) as img:
+            img.load()
+            return img